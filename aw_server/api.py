@@ -1,27 +1,38 @@
-from typing import Dict, List, Any, Optional
+from typing import Dict, Iterable, Iterator, List, Any, Optional, Tuple
 from datetime import datetime, timedelta, timezone
 from socket import gethostname
 from pathlib import Path
 from uuid import uuid4
+import atexit
 import functools
+import threading
+import time
 import json
 import logging
-from aw_datastore.storages.peewee import UserModel
 import iso8601
-import pytz
 
 from aw_core.models import Event
 from aw_core.log import get_log_file_path
 from aw_core.dirs import get_data_dir
 
-from aw_query import query2
 from aw_transform import heartbeat_merge
 
 from .__about__ import __version__
 
 from .exceptions import BadRequest, NotFound, Unauthorized
+from .validation import parse_event
 
-from .tracker_report import TrackerReport
+from .tracker_report import TrackerReport, user_buckets
+from .heartbeat_buffer import HeartbeatBuffer
+from .importer import Checkpoint as ImportCheckpoint, Importer, open_upload
+from .last_event_cache import LastEventCache
+from .last_use import LastUseTracker
+from .live_report import LiveReport
+from .query_cache import QueryCache
+from .query_executor import QueryExecutor
+from .query_plan import string_literals
+from .user_cache import FileInvalidation, UserCache
+from . import bulk, export
 
 
 logger = logging.getLogger(__name__)
@@ -52,16 +63,135 @@ def check_bucket_exists(f):
 
 
 class ServerAPI:
-    def __init__(self, db, testing) -> None:
+    def __init__(
+        self,
+        db,
+        testing,
+        heartbeat_flush_interval: float = 0,
+        last_event_cache_size: int = 10000,
+        last_event_cache_ttl: float = 3600,
+        heartbeat_warmup_hours: float = 0,
+        query_cache_entries: int = 1000,
+        query_cache_max_mb: float = 64,
+        query_cache_ttl: float = 300,
+        query_executor: str = "thread",
+        query_workers: int = 8,
+        query_max_parallel: int = 4,
+        report_workers: int = 8,
+        report_user_timeout: float = 60,
+        live_report_reconcile_interval: float = 0,
+        last_used_flush_interval: float = 0,
+        user_cache_size: int = 10000,
+        user_cache_ttl: float = 300,
+        user_invalidation_file: str = "",
+        import_batch_size: int = 1000,
+    ) -> None:
         self.db = db
         self.testing = testing
-        self.last_event = {}  # type: dict
-        user_data = {}
-        users = self.db.get_all_users()
-        for user in users:
-            user_data[user['device_id']] = user
-        self.user_data = user_data
-        self.tracker_report = TrackerReport(db=db, query2=self.query2)
+        self.last_event = LastEventCache(
+            max_size=last_event_cache_size, ttl=last_event_cache_ttl
+        )
+        # Write-behind mode for heartbeats, disabled when the interval is 0
+        self.heartbeat_buffer = None  # type: Optional[HeartbeatBuffer]
+        if heartbeat_flush_interval > 0:
+            self.heartbeat_buffer = HeartbeatBuffer(
+                db, heartbeat_flush_interval, bucket_lock=self.last_event.lock
+            )
+            self.heartbeat_buffer.start()
+            atexit.register(self.heartbeat_buffer.close)
+        # Results of query2 for periods that have ended, disabled when the budget is 0
+        self.query_cache = None  # type: Optional[QueryCache]
+        if query_cache_entries > 0 and query_cache_max_mb > 0:
+            self.query_cache = QueryCache(
+                max_entries=query_cache_entries,
+                max_bytes=int(query_cache_max_mb * 1024 * 1024),
+                ttl=query_cache_ttl,
+            )
+        # How the timeperiods of a query2 call are evaluated, see QueryExecutor
+        self.query_executor = QueryExecutor(
+            db,
+            testing,
+            mode=query_executor,
+            workers=query_workers,
+            max_parallel=query_max_parallel,
+        )
+        # Imports are inserted in transactions of this many events, with their progress kept here
+        self.import_batch_size = import_batch_size
+        self.import_checkpoint_dir = str(
+            Path(get_data_dir("aw-server")) / ("imports-testing" if testing else "imports")
+        )
+        # Users by device_id, loaded as they authenticate
+        self.user_cache = UserCache(
+            self._load_user,
+            max_size=user_cache_size,
+            ttl=user_cache_ttl,
+            invalidation=FileInvalidation(user_invalidation_file)
+            if user_invalidation_file
+            else None,
+        )
+        # Write-behind updates of last_used_at, write-through when the interval is 0
+        self.last_use = LastUseTracker(flush_interval=last_used_flush_interval)
+        if last_used_flush_interval > 0:
+            self.last_use.start()
+            atexit.register(self.last_use.close)
+        # Running totals of today's reports, disabled when the interval is 0
+        self.live_report = None  # type: Optional[LiveReport]
+        if live_report_reconcile_interval > 0:
+            self.live_report = LiveReport(reconcile_interval=live_report_reconcile_interval)
+        self.tracker_report = TrackerReport(
+            db=db,
+            query2=self.query2,
+            workers=report_workers,
+            user_timeout=report_user_timeout,
+            live_report=self.live_report,
+        )
+
+        # Preload the last event of recently active buckets so that watchers
+        # reconnecting after a restart don't each trigger their own get(limit=1)
+        self.warmup_status = {"state": "disabled", "loaded": 0, "total": 0}
+        # Buckets written while the warm-up runs, whose last event it must not restore
+        self._written_during_warmup = None  # type: Optional[set]
+        if heartbeat_warmup_hours > 0:
+            self.warmup_status["state"] = "pending"
+            self._written_during_warmup = set()
+            threading.Thread(
+                target=self._warm_up,
+                args=(timedelta(hours=heartbeat_warmup_hours), self._written_during_warmup),
+                name="heartbeat-warmup",
+                daemon=True,
+            ).start()
+
+    def _warm_up(self, window: timedelta, written: set) -> None:
+        status = self.warmup_status
+        status["state"] = "running"
+        started = time.monotonic()
+        try:
+            last_events = bulk.get_last_events(self.db, datetime.now(timezone.utc) - window)
+        except Exception as e:
+            status["state"] = "failed"
+            self._written_during_warmup = None
+            logger.exception(f"Heartbeat warm-up failed: {e}")
+            return
+
+        # Oldest first, so that the most recently active buckets survive if the cache overflows
+        items = sorted(last_events.items(), key=lambda item: item[1].timestamp)
+        status["total"] = len(items)
+        logger.info(f"Warming up last events of {len(items)} buckets")
+        for i, (bucket_id, event) in enumerate(items, start=1):
+            with self.last_event.lock(bucket_id):
+                # Buckets written during the warm-up have a newer last event than
+                # the one read, or don't have it anymore (deleted), keep them as they are
+                if bucket_id not in written and bucket_id not in self.last_event:
+                    self.last_event.set(bucket_id, event)
+            status["loaded"] = i
+            if i % 1000 == 0:
+                logger.info(f"Warmed up {i}/{len(items)} buckets")
+        self._written_during_warmup = None
+        status["state"] = "done"
+        status["duration"] = round(time.monotonic() - started, 3)
+        logger.info(
+            f"Heartbeat warm-up done: {len(items)} buckets in {status['duration']}s"
+        )
 
     def get_info(self) -> Dict[str, Dict]:
         """Get server info"""
@@ -70,6 +200,7 @@ class ServerAPI:
             "version": __version__,
             "testing": self.testing,
             "device_id": get_device_id(),
+            "heartbeat_warmup": dict(self.warmup_status),
         }
         return payload
 
@@ -94,22 +225,90 @@ class ServerAPI:
         return bucket.metadata()
 
     @check_bucket_exists
-    def export_bucket(self, bucket_id: str) -> Dict[str, Any]:
-        """Export a bucket to a dataformat consistent across versions, including all events in it."""
-        bucket = self.get_bucket_metadata(bucket_id)
-        bucket["events"] = self.get_events(bucket_id, limit=-1)
-        # Scrub event IDs
-        for event in bucket["events"]:
-            del event["id"]
+    def export_bucket(
+        self,
+        bucket_id: str,
+        since: Optional[datetime] = None,
+        cursor: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """
+        Export a bucket to a dataformat consistent across versions, including all events in it.
+
+        With since (a datetime) or cursor (from an earlier export), only the events that
+        changed since are exported, with their ids, and the bucket gets a "cursor" for the
+        next export. See export.Incremental.
+        """
+        if since is None and cursor is None:
+            bucket = self.get_bucket_metadata(bucket_id)
+            bucket["events"] = self.get_events(bucket_id, limit=-1)
+            # Scrub event IDs
+            for event in bucket["events"]:
+                del event["id"]
+            return bucket
+        incremental = export.Incremental(self.db, since, cursor)
+        bucket = self._export_changes(bucket_id, incremental)
+        bucket["cursor"] = incremental.cursor()
         return bucket
 
-    def export_all(self) -> Dict[str, Any]:
-        """Exports all buckets and their events to a format consistent across versions"""
+    def export_all(
+        self, since: Optional[datetime] = None, cursor: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """
+        Exports all buckets and their events to a format consistent across versions
+
+        With since or cursor the export is incremental, like export_bucket, and returns
+        {"buckets": {...}, "cursor": ...}.
+        """
         buckets = self.get_buckets()
-        exported_buckets = {}
-        for bid in buckets.keys():
-            exported_buckets[bid] = self.export_bucket(bid)
-        return exported_buckets
+        if since is None and cursor is None:
+            exported_buckets = {}
+            for bid in buckets.keys():
+                exported_buckets[bid] = self.export_bucket(bid)
+            return exported_buckets
+        incremental = export.Incremental(self.db, since, cursor)
+        return {
+            "buckets": {bid: self._export_changes(bid, incremental) for bid in buckets},
+            "cursor": incremental.cursor(),
+        }
+
+    def _export_changes(self, bucket_id: str, incremental: "export.Incremental") -> Dict[str, Any]:
+        self.flush_heartbeats(bucket_id)
+        bucket = self.get_bucket_metadata(bucket_id)
+        bucket["events"] = [
+            event.to_json_dict()
+            for page in incremental.pages(bucket_id, 1000)
+            for event in page
+        ]
+        return bucket
+
+    def iter_export(
+        self,
+        bucket_ids: Optional[List[str]] = None,
+        format: str = "json",
+        since: Optional[datetime] = None,
+        cursor: Optional[str] = None,
+    ) -> Iterator[str]:
+        """
+        Like export_all (or export_bucket for each of bucket_ids), but yields
+        the export in chunks as events are read, see export.py for the formats.
+        """
+        incremental = None
+        if since is not None or cursor is not None:
+            incremental = export.Incremental(self.db, since, cursor)
+        if bucket_ids is None:
+            bucket_ids = list(self.get_buckets().keys())
+        else:
+            existing = self.db.buckets()
+            for bucket_id in bucket_ids:
+                if bucket_id not in existing:
+                    raise NotFound(
+                        "NoSuchBucket", "There's no bucket named {}".format(bucket_id)
+                    )
+        if self.heartbeat_buffer is not None:
+            self.heartbeat_buffer.flush_buckets(bucket_ids)
+        return export.iter_export(
+            self.db, bucket_ids, self.get_bucket_metadata, format, incremental=incremental
+        )
 
     def import_bucket(self, bucket_data: Any):
         bucket_id = bucket_data["id"]
@@ -128,13 +327,41 @@ class ServerAPI:
         )
         self.create_events(
             bucket_id,
-            [Event(**e) if isinstance(e, dict) else e for e in bucket_data["events"]],
+            [parse_event(e) if isinstance(e, dict) else e for e in bucket_data["events"]],
         )
 
     def import_all(self, buckets: Dict[str, Any]):
         for bid, bucket in buckets.items():
             self.import_bucket(bucket)
 
+    def import_stream(
+        self, f, format: Optional[str] = None, import_id: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """
+        Imports an upload (an export document or NDJSON, optionally gzipped) as it's read,
+        in batches. Pass the import_id of a failed import to resume it, see importer.py.
+        """
+        importer = Importer(
+            self,
+            self.import_checkpoint_dir,
+            batch_size=self.import_batch_size,
+            import_id=import_id,
+        )
+        logger.info(f"Starting import {importer.import_id}")
+        stats = importer.run(open_upload(f, format))
+        logger.info(f"Import {importer.import_id} done: {stats}")
+        return stats
+
+    def get_import_status(self, import_id: str) -> Dict[str, Any]:
+        """
+        Get the events committed so far of each bucket of an unfinished import,
+        the checkpoint of an import is removed once it's done
+        """
+        checkpoint = ImportCheckpoint(self.import_checkpoint_dir, import_id)
+        if not checkpoint.committed:
+            raise NotFound("NoSuchImport", f"There's no unfinished import with id {import_id}")
+        return {"import_id": import_id, "committed": checkpoint.committed}
+
     def create_bucket(
         self,
         bucket_id: str,
@@ -163,7 +390,12 @@ class ServerAPI:
     @check_bucket_exists
     def delete_bucket(self, bucket_id: str) -> None:
         """Delete a bucket"""
-        self.db.delete_bucket(bucket_id)
+        with self.last_event.lock(bucket_id):
+            if self.heartbeat_buffer is not None:
+                self.heartbeat_buffer.discard(bucket_id)
+            self.last_event.pop(bucket_id)
+            self.db.delete_bucket(bucket_id)
+            self._events_changed(bucket_id)
         logger.debug("Deleted bucket '{}'".format(bucket_id))
         return None
 
@@ -177,6 +409,7 @@ class ServerAPI:
         logger.debug(
             f"Received get request for event {event_id} in bucket '{bucket_id}'"
         )
+        self.flush_heartbeats(bucket_id)
         event = self.db[bucket_id].get_by_id(event_id)
         return event.to_json_dict() if event else None
 
@@ -192,6 +425,7 @@ class ServerAPI:
         logger.debug("Received get request for events in bucket '{}'".format(bucket_id))
         if limit is None:  # Let limit = None also mean "no limit"
             limit = -1
+        self.flush_heartbeats(bucket_id)
         events = [
             event.to_json_dict() for event in self.db[bucket_id].get(limit, start, end)
         ]
@@ -202,7 +436,13 @@ class ServerAPI:
         """Create events for a bucket. Can handle both single events and multiple ones.
 
         Returns the inserted event when a single event was inserted, otherwise None."""
-        return self.db[bucket_id].insert(events)
+        with self.last_event.lock(bucket_id):
+            self.flush_heartbeats(bucket_id)
+            # The inserted events might be newer than the cached last event
+            self.last_event.pop(bucket_id)
+            inserted = self.db[bucket_id].insert(events)
+            self._events_changed(bucket_id, events)
+            return inserted
 
     @check_bucket_exists
     def get_eventcount(
@@ -212,12 +452,19 @@ class ServerAPI:
         logger.debug(
             "Received get request for eventcount in bucket '{}'".format(bucket_id)
         )
+        self.flush_heartbeats(bucket_id)
         return self.db[bucket_id].get_eventcount(start, end)
 
     @check_bucket_exists
     def delete_event(self, bucket_id: str, event_id) -> bool:
         """Delete a single event from a bucket"""
-        return self.db[bucket_id].delete(event_id)
+        with self.last_event.lock(bucket_id):
+            self.flush_heartbeats(bucket_id)
+            self.last_event.pop(bucket_id)
+            deleted = self.db[bucket_id].delete(event_id)
+            # The range of the deleted event is unknown here
+            self._events_changed(bucket_id)
+            return deleted
 
     @check_bucket_exists
     def heartbeat(self, bucket_id: str, heartbeat: Event, pulsetime: float) -> Event:
@@ -261,62 +508,261 @@ class ServerAPI:
         #           That way we could double check that the event has been applied
         #           and if it hasn't we simply replace it with the updated counterpart.
 
-        last_event = None
-        if bucket_id not in self.last_event:
-            last_events = self.db[bucket_id].get(limit=1)
-            if len(last_events) > 0:
-                last_event = last_events[0]
-        else:
-            last_event = self.last_event[bucket_id]
-
-        if last_event:
-            if last_event.data == heartbeat.data:
-                merged = heartbeat_merge(last_event, heartbeat, pulsetime)
-                if merged is not None:
-                    # Heartbeat was merged into last_event
-                    logger.debug(
-                        "Received valid heartbeat, merging. (bucket: {})".format(
-                            bucket_id
+        # Held across the read-merge-write so concurrent heartbeats to the same bucket can't interleave
+        with self.last_event.lock(bucket_id):
+            last_event = self._get_last_event(bucket_id)
+
+            if last_event:
+                if last_event.data == heartbeat.data:
+                    merged = heartbeat_merge(last_event, heartbeat, pulsetime)
+                    if merged is not None:
+                        # Heartbeat was merged into last_event
+                        logger.debug(
+                            "Received valid heartbeat, merging. (bucket: {})".format(
+                                bucket_id
+                            )
+                        )
+                        self.last_event.set(bucket_id, merged)
+                        if self.heartbeat_buffer is not None:
+                            self.heartbeat_buffer.put(bucket_id, merged)
+                        else:
+                            self.db[bucket_id].replace_last(merged)
+                        self._events_changed(bucket_id, [merged])
+                        return merged
+                    else:
+                        logger.info(
+                            "Received heartbeat after pulse window, inserting as new event. (bucket: {})".format(
+                                bucket_id
+                            )
                         )
-                    )
-                    self.last_event[bucket_id] = merged
-                    self.db[bucket_id].replace_last(merged)
-                    return merged
                 else:
-                    logger.info(
-                        "Received heartbeat after pulse window, inserting as new event. (bucket: {})".format(
+                    logger.debug(
+                        "Received heartbeat with differing data, inserting as new event. (bucket: {})".format(
                             bucket_id
                         )
                     )
             else:
-                logger.debug(
-                    "Received heartbeat with differing data, inserting as new event. (bucket: {})".format(
+                logger.info(
+                    "Received heartbeat, but bucket was previously empty, inserting as new event. (bucket: {})".format(
                         bucket_id
                     )
                 )
-        else:
-            logger.info(
-                "Received heartbeat, but bucket was previously empty, inserting as new event. (bucket: {})".format(
-                    bucket_id
-                )
+
+            if self.heartbeat_buffer is not None:
+                self.heartbeat_buffer.insert(bucket_id, heartbeat)
+            else:
+                self.db[bucket_id].insert(heartbeat)
+            self.last_event.set(bucket_id, heartbeat)
+            self._events_changed(bucket_id, [heartbeat])
+            return heartbeat
+
+    def heartbeats(
+        self, heartbeats: List[Tuple[str, Event, float]]
+    ) -> List[Dict[str, Any]]:
+        """
+        Batched version of heartbeat, takes an ordered list of (bucket_id, heartbeat, pulsetime).
+
+        Heartbeats are merged in memory with the same rules as single heartbeats,
+        after which each bucket is written at most once for the updated last event
+        and once for a bulk insert of the new events.
+
+        Returns one result per heartbeat, in the same order, with a status of
+        "merged", "inserted" or "error".
+        """
+        results = [None] * len(heartbeats)  # type: List[Any]
+        by_bucket = {}  # type: Dict[str, List[int]]
+        for i, (bucket_id, _, _) in enumerate(heartbeats):
+            by_bucket.setdefault(bucket_id, []).append(i)
+
+        for bucket_id, indices in by_bucket.items():
+            with self.last_event.lock(bucket_id):
+                try:
+                    bucket_results = self._merge_heartbeats(
+                        bucket_id, [heartbeats[i][1:] for i in indices]
+                    )
+                except KeyError:
+                    bucket_results = [
+                        {
+                            "bucket_id": bucket_id,
+                            "status": "error",
+                            "type": "NoSuchBucket",
+                            "message": "There's no bucket named {}".format(bucket_id),
+                        }
+                        for _ in indices
+                    ]
+                except Exception as e:
+                    # Reported for the heartbeats of this bucket only, as the
+                    # buckets before it are written already
+                    logger.exception(f"Batched heartbeats failed (bucket: {bucket_id}): {e}")
+                    # The cached last event may have been merged into before the failure
+                    self.last_event.pop(bucket_id)
+                    bucket_results = [
+                        {
+                            "bucket_id": bucket_id,
+                            "status": "error",
+                            "type": "HeartbeatFailed",
+                            "message": str(e),
+                        }
+                        for _ in indices
+                    ]
+            for i, result in zip(indices, bucket_results):
+                results[i] = result
+
+        return results
+
+    def _merge_heartbeats(
+        self, bucket_id: str, heartbeats: List[Tuple[Event, float]]
+    ) -> List[Dict[str, Any]]:
+        """Merges and writes a batch of heartbeats for a single bucket, see heartbeats"""
+        self.flush_heartbeats(bucket_id)
+        last_event = self._get_last_event(bucket_id)
+
+        # The stored last event only needs to be replaced if something merged into it
+        stored_last_event = last_event
+        replace_last = False
+        new_events = []  # type: List[Event]
+        results = []
+        for heartbeat, pulsetime in heartbeats:
+            merged = None
+            if last_event is not None and last_event.data == heartbeat.data:
+                merged = heartbeat_merge(last_event, heartbeat, pulsetime)
+            if merged is not None:
+                # Merged in place, merged is last_event
+                last_event = merged
+                if not new_events:
+                    replace_last = True
+                status = "merged"
+            else:
+                new_events.append(heartbeat)
+                last_event = heartbeat
+                status = "inserted"
+            results.append(
+                {
+                    "bucket_id": bucket_id,
+                    "status": status,
+                    "event": last_event.to_json_dict(),
+                }
             )
 
-        self.db[bucket_id].insert(heartbeat)
-        self.last_event[bucket_id] = heartbeat
-        return heartbeat
+        changed = list(new_events)
+        if replace_last and stored_last_event is not None:
+            changed.insert(0, stored_last_event)
+            if self.heartbeat_buffer is not None and not new_events:
+                self.heartbeat_buffer.put(bucket_id, stored_last_event)
+            else:
+                self.db[bucket_id].replace_last(stored_last_event)
+        if new_events:
+            self.db[bucket_id].insert(new_events)
+        if last_event is not None:
+            self.last_event.set(bucket_id, last_event)
+        self._events_changed(bucket_id, changed)
+        logger.debug(
+            "Received {} batched heartbeats, inserted {} new events (bucket: {})".format(
+                len(heartbeats), len(new_events), bucket_id
+            )
+        )
+        return results
+
+    def _get_last_event(self, bucket_id: str) -> Optional[Event]:
+        last_event = self.last_event.get(bucket_id)
+        if last_event is None and self.heartbeat_buffer is not None:
+            # Evicted from the cache while a merge was still buffered
+            last_event = self.heartbeat_buffer.get(bucket_id)
+        if last_event is None:
+            last_events = self.db[bucket_id].get(limit=1)
+            if len(last_events) > 0:
+                last_event = last_events[0]
+        if last_event is not None:
+            self.last_event.set(bucket_id, last_event)
+        return last_event
+
+    def flush_heartbeats(self, bucket_id: Optional[str] = None) -> None:
+        """Write buffered heartbeats to the database (all buckets if bucket_id is None)"""
+        if self.heartbeat_buffer is not None:
+            self.heartbeat_buffer.flush(bucket_id)
+
+    def flush_heartbeats_matching(self, names: Iterable[str]) -> None:
+        """
+        Write the buffered heartbeats of the buckets whose id contains any of names,
+        which covers the bucket ids a query names and those find_bucket matches.
+        """
+        if self.heartbeat_buffer is None:
+            return
+        names = list(names)
+        self.heartbeat_buffer.flush_buckets(
+            [b for b in self.heartbeat_buffer.pending() if any(name in b for name in names)]
+        )
+
+    def _events_changed(self, bucket_id: str, events: Optional[List[Event]] = None) -> None:
+        """
+        Updates what's derived from the events of a bucket after events were written to it.
+        events is None when events were removed, or the changed range isn't known.
 
-    def query2(self, name, query, timeperiods, cache):
-        result = []
-        for timeperiod in timeperiods:
+        Called with the lock of the bucket held, once the write is done: a query
+        that starts before then takes a query cache token older than the write,
+        so its result isn't cached if it overlaps the written range.
+        """
+        written = self._written_during_warmup
+        if written is not None:
+            written.add(bucket_id)
+        if self.live_report is not None:
+            if events is None:
+                self.live_report.discard(bucket_id)
+            else:
+                self.live_report.add_events(bucket_id, events)
+        if self.query_cache is None:
+            return
+        # Drop cached query results overlapping the written events (all of them if events is None)
+        if events is None:
+            self.query_cache.invalidate()
+        elif events:
+            self.query_cache.invalidate(
+                min(e.timestamp for e in events),
+                max(e.timestamp + e.duration for e in events),
+            )
+
+    def query2(self, name, query, timeperiods, cache, params=None):
+        query = str().join(query)
+        # Make sure the query sees the buffered heartbeats of the buckets it names
+        self.flush_heartbeats_matching(
+            list(string_literals(query))
+            + [v for v in (params or {}).values() if isinstance(v, str)]
+        )
+        use_cache = cache and self.query_cache is not None
+        token = self.query_cache.token() if use_cache else 0
+        now = datetime.now(timezone.utc)
+        result = [None] * len(timeperiods)  # type: List[Any]
+        # Periods that weren't cached, as (index in result, cache key or None)
+        uncached = []  # type: List[Tuple[int, Any]]
+        tasks = []
+        for i, timeperiod in enumerate(timeperiods):
             period = timeperiod.split("/")[
                 :2
             ]  # iso8601 timeperiods are separated by a slash
             starttime = iso8601.parse_date(period[0])
             endtime = iso8601.parse_date(period[1])
-            query = str().join(query)
-            result.append(query2.query(name, query, starttime, endtime, self.db))
+            key = None
+            # Only periods that have ended can't change without a write into them
+            if use_cache and endtime < now:
+                key = self.query_cache.key(name, query, starttime, endtime, params)
+                result[i] = self.query_cache.get(key)
+                if result[i] is not None:
+                    continue
+            uncached.append((i, key))
+            tasks.append((name, query, starttime, endtime, params))
+
+        for (i, key), period_result in zip(uncached, self.query_executor.run(tasks)):
+            result[i] = period_result
+            if key is not None:
+                self.query_cache.put(key, period_result, token)
         return result
 
+    def get_query_cache_stats(self) -> Dict[str, Any]:
+        """Get hit rate and size of the query result cache"""
+        if self.query_cache is None:
+            return {"enabled": False}
+        return {"enabled": True, **self.query_cache.stats()}
+
     # TODO: Right now the log format on disk has to be JSON, this is hard to read by humans...
     def get_log(self):
         """Get the server log in json format"""
@@ -326,21 +772,32 @@ class ServerAPI:
                 payload.append(json.loads(line))
         return payload, 200
 
+    def _get_user(self, query):
+        user = self.db.get_user(query)
+        if isinstance(user, (str, bytes)):
+            user = json.loads(user)
+        return user
+
+    def _load_user(self, device_id):
+        user = self._get_user({"device_id": device_id})
+        if user is not None and '_id' in user:
+            del user['_id']
+        return user
+
     def save_user(self, user):
         """Save token to db"""
-        try:
-            old_user = json.loads(self.db.get_user({"mezon_user_id": user['mezon_user_id']}))
-        except:
-            old_user = self.db.get_user({"mezon_user_id": user['mezon_user_id']})
-            
+        old_user = self._get_user({"mezon_user_id": user['mezon_user_id']})
+
         if old_user is not None and 'device_id' in old_user:
             if old_user['device_id'] == user['device_id']:
-                self.user_data[old_user['device_id']] = user
+                # Stored as well, the cache may not keep it until it's used
+                self.db.save_user(user)
+                self.user_cache.put(user['device_id'], user)
                 return old_user
             else:
-                del self.user_data[old_user['device_id']]
+                self.user_cache.invalidate(old_user['device_id'])
 
-        self.user_data[user['device_id']] = user
+        self.user_cache.put(user['device_id'], user)
         
         self.db.save_user(user)
         if '_id' in user:
@@ -348,58 +805,81 @@ class ServerAPI:
     
         return user
     
-    def get_user_token(self, device_id) -> str:
-        return self.user_data[device_id]["access_token"] if device_id in self.user_data else None
+    def get_user_token(self, device_id) -> Optional[str]:
+        user = self.user_cache.get(device_id)
+        return user["access_token"] if user is not None else None
     
-    def delete_user_token(self, device_id):
-        if device_id in self.user_data:
-            user = self.user_data[device_id]
-            del self.user_data[device_id]
-            return True
-        return False
+    def delete_user_token(self, device_id) -> bool:
+        """Logs a device out, returns whether it had a token"""
+        user = self.user_cache.get(device_id)
+        if user is None or not user.get("access_token"):
+            return False
+        # Revoked in the database, so it stays revoked when the user is loaded again
+        user = dict(user, access_token=None)
+        self.db.save_user(user)
+        self.user_cache.put(device_id, user)
+        return True
     
     def get_user_by_email(self, email) -> str:
-        user = self.db.get_user({"email": email})
-        return json.loads(user)
+        return self._get_user({"email": email})
     
-    def get_user_by_token(self, device_id, token) -> str:
-        if device_id in self.user_data and self.user_data[device_id]["access_token"] == token:
-            self.update_user_last_use(device_id)
-            return self.user_data[device_id]
+    def get_user_by_token(self, device_id, token) -> Optional[dict]:
+        user = self.user_cache.get(device_id)
+        if user is not None and user["access_token"] == token:
+            self.last_use.touch(user)
+            return user
         return None
 
     def get_user_report(self, email, day=None):
         report = self.tracker_report.report_user(email, day)
+        return self._format_report(report, day)
+
+    def _format_report(self, report, day=None):
         report["spent_time"] = str(timedelta(seconds=report["spent_time"]))
         report["call_time"] = str(timedelta(seconds=report["call_time"]))
         report["active_time"] = str(timedelta(seconds=report["active_time"]))
         report["date"] = day or report["date"]
         return report
 
+    def iter_users_report(self, emails, day=None):
+        """Yields (index in emails, report) of each user as soon as it's done, see get_user_report"""
+        # The reports are computed on events read straight from the database
+        self._flush_user_heartbeats(emails)
+        for i, report in self.tracker_report.report_emails(emails, day):
+            yield i, self._format_report(report, day)
+
+    def _flush_user_heartbeats(self, emails: Optional[List[str]]) -> None:
+        """Flushes the buffered heartbeats of the buckets of the users (everyone if emails is None)"""
+        if emails is None:
+            self.flush_heartbeats()
+        else:
+            self.flush_heartbeats_matching(
+                name for email in emails for name in user_buckets(email).values()
+            )
+
+    def get_users_report(self, emails, day=None):
+        reports = sorted(self.iter_users_report(emails, day), key=lambda item: item[0])
+        return [report for _, report in reports]
+
+    def get_report_range(self, start, end, emails=None, group="day"):
+        """Reports of the users (everyone if emails is None) from start to end, see TrackerReport.report_range"""
+        self._flush_user_heartbeats(emails)
+        reports = self.tracker_report.report_range(start, end, emails, group)
+        for report in reports:
+            for key in ("spent_time", "call_time", "active_time"):
+                report[key] = str(timedelta(seconds=report[key]))
+        return reports
+
     def report_all(self, day = None):
         report = self.tracker_report.report(day)
         return report
 
+    def iter_report_all(self, day = None):
+        """Like report_all, but yields (index, report) as each user is done"""
+        return self.tracker_report.iter_report(day)
+
     def update_user_last_use(self, device_id):
-        today = datetime.now(timezone.utc).replace(tzinfo=pytz.utc).astimezone(pytz.timezone('Asia/Saigon')).date()
-        user = self.user_data[device_id]
-        last_used_at = user.get('last_used_at', None)
-        if last_used_at == None:
-            last_used_at = datetime.now(timezone.utc).isoformat()
-            user['last_used_at'] = last_used_at
-            self.user_data[device_id] = user
-            UserModel.update(last_used_at=datetime.fromisoformat(last_used_at)).where(UserModel.mezon_user_id == user['mezon_user_id']).execute()
-        else:
-            if not isinstance(last_used_at, str):
-                last_used_at = last_used_at.isoformat()
-
-            user_login_day = datetime.fromisoformat(last_used_at).replace(tzinfo=pytz.utc).astimezone(pytz.timezone('Asia/Saigon')).date()
-            
-            if (today - user_login_day).days != 0:
-                last_used_at = datetime.now(timezone.utc).isoformat()
-                user['last_used_at'] = last_used_at
-                self.user_data[device_id] = user
-                UserModel.update(last_used_at=datetime.fromisoformat(last_used_at)).where(UserModel.mezon_user_id == user['mezon_user_id']).execute()
-                pass
-            else:
-                user['last_used_at'] = last_used_at
\ No newline at end of file
+        """Sets last_used_at of the user on its first use of the day, see LastUseTracker"""
+        user = self.user_cache.get(device_id)
+        if user is not None:
+            self.last_use.touch(user)
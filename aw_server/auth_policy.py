@@ -0,0 +1,82 @@
+from typing import Iterable, Mapping, Optional
+
+# Decisions of AuthPolicy.decide
+REJECT = "reject"
+ALLOW = "allow"
+BEARER = "bearer"
+
+# Routes that don't need a token, by path (without trailing slash) and method,
+# where None stands for any method
+PUBLIC_ROUTES = {
+    "/api/0/auth/callback": None,
+}
+# Paths under these prefixes are public for the given method
+PUBLIC_PREFIXES = {
+    "POST": ("/api/0/auth",),
+}
+
+
+def trusted_origins(application_domain: str) -> frozenset:
+    return frozenset(
+        [
+            f"http://{application_domain}",
+            f"https://{application_domain}",
+            "http://localhost:27180",
+        ]
+    )
+
+
+class AuthPolicy:
+    """
+    Decides how a request is authorised, built once when the app is created.
+
+    Requests are rejected if their path mentions a DESKTOP host, allowed
+    without a token if they come from a trusted origin, go to a public route or
+    carry the secret key, and otherwise need a bearer token.
+    """
+
+    def __init__(
+        self,
+        origins: Iterable[str],
+        secret_key: Optional[str],
+        public_routes: Mapping[str, Optional[Iterable[str]]] = PUBLIC_ROUTES,
+        public_prefixes: Mapping[str, Iterable[str]] = PUBLIC_PREFIXES,
+    ) -> None:
+        self.origins = frozenset(origins)
+        self.secret_key = secret_key
+        self.public_routes = {
+            path: None if methods is None else frozenset(methods)
+            for path, methods in public_routes.items()
+        }
+        # A prefix matches the path itself and everything below it
+        self.public_prefixes = {
+            method: (frozenset(prefixes), tuple(prefix + "/" for prefix in prefixes))
+            for method, prefixes in public_prefixes.items()
+        }
+
+    def is_public(self, method: str, path: str) -> bool:
+        path = path.rstrip("/") or "/"
+        if path in self.public_routes:
+            methods = self.public_routes[path]
+            if methods is None or method in methods:
+                return True
+        if method not in self.public_prefixes:
+            return False
+        prefixes, below = self.public_prefixes[method]
+        return path in prefixes or path.startswith(below)
+
+    def decide(self, method: str, path: str, environ: Mapping[str, str]) -> str:
+        """Decides on a request from its method, path and WSGI environ (for the headers)"""
+        if "DESKTOP" in path:
+            return REJECT
+        if (
+            environ.get("HTTP_ORIGIN", "") in self.origins
+            or self.is_public(method, path)
+            or "HTTP_SECRET" in environ
+            or (
+                self.secret_key is not None
+                and environ.get("HTTP_X_SECRET_KEY") == self.secret_key
+            )
+        ):
+            return ALLOW
+        return BEARER
@@ -0,0 +1,237 @@
+"""
+Backfill of the stored daily reports.
+
+Computes and saves the report of every user for a range of days on a pool of
+worker threads. Reports that are already stored are skipped, and with a
+checkpoint file every (day, user) saved is recorded as it's done, so an
+interrupted backfill picks up where it stopped when run again.
+
+Usage:
+
+    python -m aw_server.backfill --start 2024/01/01 --end 2024/03/31 --checkpoint backfill.txt
+"""
+import argparse
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import date, datetime, timedelta
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+from aw_core.log import setup_logging
+from aw_datastore import get_storage_methods
+from aw_datastore.datastore import Datastore
+from aw_query.exceptions import QueryException
+
+from .config import config
+from .tracker_report import (
+    TrackerReport,
+    cal_timeperiods,
+    datastore_query2,
+    make_report,
+    str_to_date,
+)
+
+logger = logging.getLogger(__name__)
+
+DAY_FORMAT = "%Y/%m/%d"
+
+# (day, email, wfh)
+BackfillTask = Tuple[str, str, bool]
+
+
+def days_between(start: date, end: date) -> List[str]:
+    """Days from start to end, both included, formatted for TrackerReport"""
+    return [
+        (start + timedelta(days=i)).strftime(DAY_FORMAT)
+        for i in range((end - start).days + 1)
+    ]
+
+
+class Checkpoint:
+    """(day, email) pairs that have been saved, kept in an append-only file"""
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        self.path = path
+        self.done = set()  # type: Set[Tuple[str, str]]
+        self._file = None
+        if path is None:
+            return
+        try:
+            with open(path) as f:
+                for line in f:
+                    day, _, email = line.rstrip("\n").partition("\t")
+                    if email:
+                        self.done.add((day, email))
+        except FileNotFoundError:
+            pass
+        self._file = open(path, "a")
+
+    def __contains__(self, key: Tuple[str, str]) -> bool:
+        return key in self.done
+
+    def add(self, day: str, email: str) -> None:
+        self.done.add((day, email))
+        if self._file is not None:
+            self._file.write(f"{day}\t{email}\n")
+            self._file.flush()
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class Progress:
+    """Logs throughput and an estimate of the time left every ``interval`` seconds"""
+
+    def __init__(self, total: int, interval: float = 10, log: Callable[[str], None] = print) -> None:
+        self.total = total
+        self.interval = interval
+        self.log = log
+        self.done = 0
+        self.started = time.monotonic()
+        self._last_log = self.started
+
+    def update(self, n: int = 1) -> None:
+        self.done += n
+        now = time.monotonic()
+        if now - self._last_log >= self.interval or self.done == self.total:
+            self._last_log = now
+            self.log(self.summary())
+
+    def summary(self) -> str:
+        elapsed = time.monotonic() - self.started
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        left = self.total - self.done
+        eta = timedelta(seconds=int(left / rate)) if rate > 0 else "?"
+        return f"{self.done}/{self.total} reports, {rate:.1f}/s, ETA {eta}"
+
+
+def list_tasks(
+    tracker_report: TrackerReport, days: List[str], checkpoint: Checkpoint
+) -> Iterator[Tuple[str, List[BackfillTask], int]]:
+    """Yields (day, tasks, skipped) with the users of each day whose report isn't stored yet"""
+    storage = tracker_report.db.storage_strategy
+    for day in days:
+        users = storage.get_use_tracker(str_to_date(day))
+        all_emails = list(dict.fromkeys(user["email"].split("@")[0] for user in users))
+        emails = [email for email in all_emails if (day, email) not in checkpoint]
+        stored = tracker_report.get_stored_reports(emails, str_to_date(day))
+        tasks = [(day, email, False) for email in emails if email not in stored]
+        yield day, tasks, len(all_emails) - len(tasks)
+
+
+def compute_report(tracker_report: TrackerReport, task: BackfillTask) -> dict:
+    day, email, wfh = task
+    try:
+        spent_time, call_time = tracker_report.get_times(email, cal_timeperiods(day))
+    except QueryException as e:
+        # Like report_user, a user without buckets gets an empty report
+        logger.debug(f"No report for {email} on {day}: {e}")
+        spent_time = timedelta()
+        call_time = timedelta()
+    rec = make_report(email, day, wfh, spent_time, call_time)
+    tracker_report.db.storage_strategy.save_report(rec)
+    return rec
+
+
+def backfill(
+    tracker_report: TrackerReport,
+    days: List[str],
+    workers: int = 8,
+    checkpoint: Optional[Checkpoint] = None,
+    log: Callable[[str], None] = print,
+    progress_interval: float = 10,
+) -> Dict[str, int]:
+    """
+    Computes and saves the missing reports of days, returns the number of
+    reports "saved", "skipped" (already stored) and "failed".
+    Failed reports aren't checkpointed, so they are retried by the next run.
+    """
+    checkpoint = checkpoint or Checkpoint()
+    tasks = []  # type: List[BackfillTask]
+    skipped = 0
+    for day, day_tasks, day_skipped in list_tasks(tracker_report, days, checkpoint):
+        tasks.extend(day_tasks)
+        skipped += day_skipped
+    log(f"Backfilling {len(tasks)} reports over {len(days)} days, {skipped} already stored")
+
+    stats = {"saved": 0, "skipped": skipped, "failed": 0}
+    progress = Progress(len(tasks), interval=progress_interval, log=log)
+    queued = iter(tasks)
+    pending = {}
+    with ThreadPoolExecutor(max(1, workers), thread_name_prefix="backfill") as pool:
+        # Keep the queue short so an interrupted backfill doesn't leave much running
+        for task in queued:
+            pending[pool.submit(compute_report, tracker_report, task)] = task
+            if len(pending) >= 2 * workers:
+                break
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                day, email, _ = pending.pop(future)
+                try:
+                    future.result()
+                except Exception as e:
+                    stats["failed"] += 1
+                    log(f"Report of {email} on {day} failed: {e}")
+                else:
+                    stats["saved"] += 1
+                    checkpoint.add(day, email)
+                progress.update()
+                for task in queued:
+                    pending[pool.submit(compute_report, tracker_report, task)] = task
+                    break
+    log(f"Backfill done: {stats['saved']} saved, {stats['skipped']} skipped, {stats['failed']} failed")
+    return stats
+
+
+def open_tracker_report(testing: bool = False) -> TrackerReport:
+    storage_method = get_storage_methods()["peewee"]
+    db = Datastore(storage_method, testing=testing)
+    return TrackerReport(db=db, query2=datastore_query2(db))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Computes and stores missing daily reports")
+    parser.add_argument("--start", required=True, help="First day, as YYYY/MM/dd")
+    parser.add_argument("--end", help="Last day, as YYYY/MM/dd (default: yesterday)")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=int(config["server"].get("report_workers", 8)),
+        help="Reports computed at once",
+    )
+    parser.add_argument(
+        "--checkpoint", help="File recording the saved reports, to resume an interrupted backfill"
+    )
+    parser.add_argument("--testing", action="store_true", help="Use the testing database")
+    args = parser.parse_args()
+    start = datetime.strptime(args.start, DAY_FORMAT).date()
+    yesterday = date.today() - timedelta(days=1)
+    end = datetime.strptime(args.end, DAY_FORMAT).date() if args.end else yesterday
+    if end > yesterday:
+        # Stored reports are never recomputed, a day's report is only final once it's over
+        parser.error(f"--end must be before today, at most {yesterday.strftime(DAY_FORMAT)}")
+
+    setup_logging(
+        "aw-server-backfill",
+        testing=args.testing,
+        verbose=False,
+        log_stderr=True,
+        log_file=False,
+    )
+    checkpoint = Checkpoint(args.checkpoint)
+    try:
+        backfill(
+            open_tracker_report(args.testing),
+            days_between(start, end),
+            workers=args.workers,
+            checkpoint=checkpoint,
+        )
+    finally:
+        checkpoint.close()
+
+
+if __name__ == "__main__":
+    main()
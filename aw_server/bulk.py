@@ -0,0 +1,351 @@
+"""
+Bulk reads that span many buckets in a single database query.
+
+The Datastore API only reads one bucket at a time, which is fine for the web UI
+but not for work that touches every bucket at once (warming caches, reports).
+These helpers query the peewee models directly when the peewee storage is used,
+and fall back to reading bucket by bucket for other storage methods.
+"""
+import contextlib
+import copy
+import json
+import logging
+from datetime import date, datetime, timedelta
+from typing import Any, ContextManager, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from aw_core.models import Event
+from aw_datastore.storages.peewee import BucketModel, EventModel, PeeweeStorage
+from peewee import fn
+
+logger = logging.getLogger(__name__)
+
+# SQLite limits the number of variables in a query (999 before 3.32)
+_max_in_size = 500
+
+
+def _is_peewee(db) -> bool:
+    return isinstance(db.storage_strategy, PeeweeStorage)
+
+
+def transaction(db) -> ContextManager:
+    """A database transaction with the peewee storage, a no-op with other storage methods"""
+    if _is_peewee(db):
+        return db.storage_strategy.db.atomic()
+    return contextlib.nullcontext()
+
+
+def _last_events_query(q, since: Optional[datetime] = None):
+    """Restricts q, a select of EventModel, to the last event of every bucket"""
+    latest = EventModel.select(
+        EventModel.bucket.alias("bucket_key"),
+        fn.MAX(EventModel.timestamp).alias("timestamp"),
+    )
+    if since is not None:
+        latest = latest.where(EventModel.timestamp >= since)
+    latest = latest.group_by(EventModel.bucket).alias("latest")
+    return (
+        q.join(BucketModel, on=(EventModel.bucket == BucketModel.key))
+        .join(
+            latest,
+            on=(
+                (EventModel.bucket == latest.c.bucket_key)
+                & (EventModel.timestamp == latest.c.timestamp)
+            ),
+        )
+        .order_by(EventModel.id)
+    )
+
+
+def get_last_events(db, since: datetime) -> Dict[str, Event]:
+    """
+    Returns the last event of every bucket that has an event starting after ``since``,
+    as a dict {bucket_id: event}.
+    """
+    if not _is_peewee(db):
+        last_events = {}
+        for bucket_id in db.buckets():
+            events = db[bucket_id].get(limit=1)
+            if events and events[0].timestamp >= since:
+                last_events[bucket_id] = events[0]
+        return last_events
+
+    q = _last_events_query(
+        EventModel.select(EventModel, BucketModel.id.alias("bucket_name")), since
+    ).objects()  # type: Iterable[Any]
+    # Ordered by id so that if several events share the last timestamp,
+    # the one inserted last wins.
+    return {row.bucket_name: Event(**EventModel.json(row)) for row in q}
+
+
+def _round_range(
+    starttime: Optional[datetime], endtime: Optional[datetime]
+) -> Tuple[Optional[datetime], Optional[datetime]]:
+    """Rounds a range to milliseconds, outwards, like Bucket.get does"""
+    if starttime:
+        starttime = starttime.replace(microsecond=1000 * (starttime.microsecond // 1000))
+    if endtime:
+        milliseconds = 1 + endtime.microsecond // 1000
+        endtime = endtime.replace(microsecond=(1000 * milliseconds) % 1000000) + timedelta(
+            seconds=milliseconds // 1000
+        )
+    return starttime, endtime
+
+
+def _trim(event: Event, starttime: Optional[datetime], endtime: Optional[datetime]) -> Event:
+    """Cuts an event to the range, like PeeweeStorage.get_events does"""
+    if starttime and event.timestamp < starttime:
+        end = event.timestamp + event.duration
+        event.timestamp = starttime
+        event.duration = end - starttime
+    if endtime and event.timestamp + event.duration > endtime:
+        event.duration = endtime - event.timestamp
+    return event
+
+
+def get_events(
+    db,
+    bucket_ids: Iterable[str],
+    starttime: Optional[datetime],
+    endtime: Optional[datetime],
+) -> Dict[str, List[Event]]:
+    """
+    Returns the events of several buckets within a range, as a dict {bucket_id: events}
+    with the events of each bucket sorted like Bucket.get (descending by timestamp).
+    Buckets that don't exist are left out.
+    """
+    bucket_ids = list(bucket_ids)
+    if not _is_peewee(db):
+        existing = db.buckets()
+        return {
+            bucket_id: db[bucket_id].get(starttime=starttime, endtime=endtime)
+            for bucket_id in bucket_ids
+            if bucket_id in existing
+        }
+
+    starttime, endtime = _round_range(starttime, endtime)
+    events = {}  # type: Dict[str, List[Event]]
+    for i in range(0, len(bucket_ids), _max_in_size):
+        q = (
+            EventModel.select(EventModel, BucketModel.id.alias("bucket_name"))
+            .join(BucketModel, on=(EventModel.bucket == BucketModel.key))
+            .where(BucketModel.id.in_(bucket_ids[i : i + _max_in_size]))
+            .order_by(EventModel.timestamp.desc())
+        )
+        q = db.storage_strategy._where_range(q, starttime, endtime).objects()
+        for row in q:
+            event = _trim(Event(**EventModel.json(row)), starttime, endtime)
+            events.setdefault(row.bucket_name, []).append(event)
+    return events
+
+
+def _event_rows(q) -> List[Tuple[int, datetime, float, str]]:
+    """Runs a query selecting the id, timestamp, duration and datastr of events"""
+    return list(q.tuples())
+
+
+def iter_event_pages(db, bucket_id: str, page_size: int = 1000) -> Iterator[List[Event]]:
+    """
+    Yields all events of a bucket in pages of up to ``page_size`` events,
+    sorted by timestamp (ascending). With the peewee storage each page is a
+    keyset query on the (bucket, timestamp) index, continuing after the
+    (timestamp, id) of the previous page, so memory stays flat and every page
+    costs the same whatever the size of the bucket.
+    """
+    if not _is_peewee(db):
+        events = db[bucket_id].get(limit=-1)[::-1]
+        for i in range(0, len(events), page_size):
+            yield events[i : i + page_size]
+        return
+
+    bucket_key = db.storage_strategy.bucket_keys[bucket_id]
+    q = (
+        EventModel.select(
+            EventModel.id, EventModel.timestamp, EventModel.duration, EventModel.datastr
+        )
+        .where(EventModel.bucket == bucket_key)
+        .order_by(EventModel.timestamp, EventModel.id)
+        .limit(page_size)
+    )
+    page_q = q
+    while True:
+        rows = _event_rows(page_q)
+        if not rows:
+            return
+        yield [
+            Event(id=id, timestamp=timestamp, duration=float(duration), data=json.loads(datastr))
+            for id, timestamp, duration, datastr in rows
+        ]
+        if len(rows) < page_size:
+            return
+        last_id, last_timestamp = rows[-1][0], rows[-1][1]
+        page_q = q.where(
+            (EventModel.timestamp >= last_timestamp)
+            & (
+                (EventModel.timestamp > last_timestamp)
+                | (EventModel.id > last_id)
+            )
+        )
+
+
+def max_event_id(db) -> int:
+    """
+    The highest event id of the database with the peewee storage, 0 with other
+    storage methods, which number the events of each bucket from 0.
+    """
+    if not _is_peewee(db):
+        return 0
+    return EventModel.select(fn.MAX(EventModel.id)).scalar() or 0
+
+
+def last_event_ids(db) -> Dict[str, int]:
+    """
+    The id of the last event of every bucket with the peewee storage, as a
+    dict {bucket_id: id}, empty with other storage methods (see max_event_id).
+    """
+    if not _is_peewee(db):
+        return {}
+    q = _last_events_query(
+        EventModel.select(EventModel.id, BucketModel.id.alias("bucket_name"))
+    ).tuples()  # type: Iterable[Any]
+    # Ordered by id, like get_last_events
+    return {bucket_name: id for id, bucket_name in q}
+
+
+def iter_changed_event_pages(
+    db,
+    bucket_id: str,
+    after_id: Optional[int] = None,
+    last_id: Optional[int] = None,
+    since: Optional[datetime] = None,
+    page_size: int = 1000,
+) -> Iterator[List[Event]]:
+    """
+    Yields the events of a bucket that changed since an earlier read, in pages
+    sorted by id (ascending):
+
+     - with ``after_id`` (see max_event_id), events with a higher id, and
+       those heartbeats may have extended in place: from the event that was
+       last at the earlier read, ``last_id`` (see last_event_ids), on, and the
+       last event. With other storage methods than peewee ids aren't global,
+       so every event is returned.
+     - with ``since``, events that end at or after ``since``
+    """
+    if not _is_peewee(db):
+        events = sorted(
+            db[bucket_id].get(limit=-1, starttime=since if after_id is None else None),
+            key=lambda e: e.id or 0,
+        )
+        for i in range(0, len(events), page_size):
+            yield events[i : i + page_size]
+        return
+
+    bucket_key = db.storage_strategy.bucket_keys[bucket_id]
+    q = (
+        EventModel.select(
+            EventModel.id, EventModel.timestamp, EventModel.duration, EventModel.datastr
+        )
+        .where(EventModel.bucket == bucket_key)
+        .order_by(EventModel.id)
+        .limit(page_size)
+    )
+    if after_id is not None:
+        # replace_last (and so heartbeats) updates one of the events with the
+        # latest timestamp, without changing its timestamp. Since the earlier
+        # read that's the event that was last then, or one inserted or made
+        # last (by a delete) since.
+        last_timestamp = EventModel.select(fn.MAX(EventModel.timestamp)).where(
+            EventModel.bucket == bucket_key
+        )
+        changed = (EventModel.id > after_id) | (EventModel.timestamp == last_timestamp)
+        if last_id is not None:
+            was_last = EventModel.select(EventModel.timestamp).where(
+                (EventModel.bucket == bucket_key) & (EventModel.id == last_id)
+            )
+            changed = changed | (EventModel.timestamp >= was_last)
+        q = q.where(changed)
+    if since is not None:
+        q = db.storage_strategy._where_range(q, since, None)
+    page_q = q
+    while True:
+        rows = _event_rows(page_q)
+        if not rows:
+            return
+        yield [
+            Event(id=id, timestamp=timestamp, duration=float(duration), data=json.loads(datastr))
+            for id, timestamp, duration, datastr in rows
+        ]
+        if len(rows) < page_size:
+            return
+        page_q = q.where(EventModel.id > rows[-1][0])
+
+
+def get_reports(db, start: date, end: date, emails: Iterable[str]) -> List[dict]:
+    """
+    Returns the stored daily reports of the given users (emails without domain)
+    from start to end, inclusive. With the peewee storage they're read with one
+    query per ``_max_in_size`` users, otherwise user by user and day by day.
+    """
+    emails = list(emails)
+    storage = db.storage_strategy
+    if not _is_peewee(db):
+        reports = []
+        day = start
+        while day <= end:
+            for email in emails:
+                report = storage.get_report(email=email, day=day)
+                if report:
+                    reports.append(report)
+            day += timedelta(days=1)
+        return reports
+
+    from aw_datastore.storages.peewee import ReportModel  # type: ignore
+
+    q = ReportModel.select().where((ReportModel.date >= start) & (ReportModel.date <= end))
+    reports = []
+    for i in range(0, len(emails), _max_in_size):
+        reports.extend(q.where(ReportModel.email.in_(emails[i : i + _max_in_size])).dicts())
+    return reports
+
+
+class _PrefetchedBucket:
+    def __init__(self, bucket_id: str, events: List[Event]) -> None:
+        self.bucket_id = bucket_id
+        self.events = events
+
+    def metadata(self) -> dict:
+        return {"id": self.bucket_id}
+
+    def get(
+        self,
+        limit: int = -1,
+        starttime: Optional[datetime] = None,
+        endtime: Optional[datetime] = None,
+    ) -> List[Event]:
+        starttime, endtime = _round_range(starttime, endtime)
+        events = [
+            _trim(copy.deepcopy(e), starttime, endtime)
+            for e in self.events
+            if (starttime is None or starttime <= e.timestamp + e.duration)
+            and (endtime is None or e.timestamp <= endtime)
+        ]
+        return events if limit < 0 else events[:limit]
+
+
+class PrefetchedDatastore:
+    """
+    Read-only stand-in for a Datastore holding events fetched up front (see get_events),
+    so that queries over many buckets don't each go to the database.
+    Only what query2 needs to read buckets is implemented.
+    """
+
+    def __init__(self, events: Dict[str, List[Event]]) -> None:
+        self._buckets = {
+            bucket_id: _PrefetchedBucket(bucket_id, bucket_events)
+            for bucket_id, bucket_events in events.items()
+        }
+
+    def buckets(self) -> Dict[str, dict]:
+        return {bucket_id: b.metadata() for bucket_id, b in self._buckets.items()}
+
+    def __getitem__(self, bucket_id: str) -> _PrefetchedBucket:
+        return self._buckets[bucket_id]
@@ -0,0 +1,124 @@
+"""
+Compression of responses, negotiated with Accept-Encoding.
+
+Event lists, query results, exports and reports are large and repeat the same
+app names and titles over and over, so they compress very well. Responses are
+compressed with gzip, or zstd when the zstandard package is installed and the
+client accepts it.
+
+Responses smaller than ``min_size`` bytes, like the ones to heartbeats, aren't
+compressed since that would cost more CPU than it saves bandwidth. Streamed
+responses (exports, streamed reports) have no known size and are compressed
+chunk by chunk as they're sent, each chunk flushed so clients still get
+results as they come.
+"""
+import gzip
+import logging
+import zlib
+from typing import Iterable, Iterator, Optional
+
+from flask import Flask, request
+from werkzeug.wrappers import Response
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+HAS_ZSTD = zstandard is not None
+
+logger = logging.getLogger(__name__)
+
+COMPRESSIBLE_MIMETYPES = frozenset(
+    [
+        "application/json",
+        "application/x-ndjson",
+        "application/javascript",
+        "text/html",
+        "text/plain",
+        "text/css",
+    ]
+)
+
+
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    """The encoding to use for an Accept-Encoding header, None for no compression"""
+    accepted = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name.strip().lower()] = q
+    for encoding in (["zstd"] if HAS_ZSTD else []) + ["gzip"]:
+        q = accepted.get(encoding, accepted.get("*", 0.0))
+        if q > 0:
+            return encoding
+    return None
+
+
+def _compress(data: bytes, encoding: str, level: int) -> bytes:
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def _compress_stream(chunks: Iterable, encoding: str, level: int) -> Iterator[bytes]:
+    if encoding == "zstd":
+        compressor = zstandard.ZstdCompressor(level=level).compressobj()
+        flush_mode = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+    else:
+        # 16 + MAX_WBITS for a gzip header and trailer
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        flush_mode = zlib.Z_SYNC_FLUSH
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        if not chunk:
+            continue
+        data = compressor.compress(chunk) + compressor.flush(flush_mode)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+class Compression:
+    def __init__(self, min_size: int = 1024, level: int = 6, zstd_level: int = 3) -> None:
+        self.min_size = min_size
+        self.level = level
+        self.zstd_level = zstd_level
+
+    def init_app(self, app: Flask) -> None:
+        app.after_request(self.after_request)
+
+    def after_request(self, response: Response) -> Response:
+        if (
+            response.status_code < 200
+            or response.status_code in (204, 304)
+            or response.direct_passthrough
+            or "Content-Encoding" in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES
+        ):
+            return response
+        response.vary.add("Accept-Encoding")
+        encoding = choose_encoding(request.headers.get("Accept-Encoding", ""))
+        if encoding is None:
+            return response
+        level = self.zstd_level if encoding == "zstd" else self.level
+
+        if response.is_streamed:
+            response.response = _compress_stream(response.response, encoding, level)
+            response.headers.pop("Content-Length", None)
+        else:
+            if response.content_length is not None and response.content_length < self.min_size:
+                return response
+            data = response.get_data()
+            if len(data) < self.min_size:
+                return response
+            response.set_data(_compress(data, encoding, level))
+        response.headers["Content-Encoding"] = encoding
+        return response
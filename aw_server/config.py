@@ -9,12 +9,57 @@ cors_origins = "*"
 secret = "secret"
 mongo_url = "mongodb://localhost:27017/"
 application_domain = "tracker.komu.vn"
+# Seconds merged heartbeats may be held in memory before being written (0 = write-through)
+heartbeat_flush_interval = 0
+# Max number of buckets to keep the last event of, and seconds before an idle bucket is evicted
+last_event_cache_size = 10000
+last_event_cache_ttl = 3600
+# Preload the last event of buckets active within this many hours at startup (0 = disabled)
+heartbeat_warmup_hours = 24
+# Cached query results for periods that have ended, by count and size (0 = disabled)
+query_cache_entries = 1000
+query_cache_max_mb = 64
+# Seconds a cached result is kept (0 = until invalidated). Only writes of this process invalidate
+# results, with several processes sharing the database this bounds how stale they can be
+query_cache_ttl = 300
+# How to evaluate the timeperiods of a query: "serial", "thread" or "process"
+query_executor = "thread"
+# Size of the query pool, and max periods of a single request evaluated at once
+query_workers = 8
+query_max_parallel = 4
+# Users reported on at once, and seconds before the report of a single user is given up on
+report_workers = 8
+report_user_timeout = 60
+# Keep today's reports up to date from incoming events, recomputing them at this interval in seconds (0 = disabled)
+live_report_reconcile_interval = 900
+# Seconds updates of users' last_used_at may be held in memory before being written (0 = write-through)
+last_used_flush_interval = 10
+# Max number of users kept in memory, and seconds before a user is loaded from the database again
+user_cache_size = 10000
+user_cache_ttl = 300
+# File through which processes sharing the database tell each other about saved and deleted tokens ("" = disabled)
+user_invalidation_file = ""
+# Don't store the user of token-authenticated requests in the session cookie, only browser logins get one
+stateless_auth = true
+# Events inserted per transaction when importing
+import_batch_size = 1000
+# Compress responses of at least this many bytes with gzip, or zstd if installed (0 = disabled)
+compression_min_size = 1024
+compression_level = 6
+# JSON encoder of responses and exports: orjson, json (stdlib) or auto (orjson if installed)
+json_backend = "auto"
 
 [oauth2]
 auth_url = "oauth2.mezon.ai"
 client_id = ""
 client_secret = ""
 redirect_uri = "https://tracker-api.komu.vn/api/0/auth/callback"
+# Idle connections kept alive, and max calls to the OAuth2 server at once
+pool_size = 8
+max_concurrency = 16
+# Seconds to wait for a connection and for a response
+connect_timeout = 5
+read_timeout = 10
 
 [server.custom_static]
 
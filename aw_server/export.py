@@ -0,0 +1,182 @@
+"""
+Streaming export of buckets.
+
+An export used to be built as one dict holding every event of every bucket and
+then dumped into one string, which for a large database doesn't fit in memory.
+These generators yield the export piece by piece instead, reading the events
+of each bucket a page at a time (see bulk.iter_event_pages), so that they can
+be sent as a chunked response.
+
+Two formats are supported:
+
+ - "json", the same document as before: {"buckets": {bucket_id: {...metadata, "events": [...]}}}
+ - "ndjson", one JSON object per line: {"bucket": {...metadata}} for each
+   bucket, followed by one {"event": {...}} line per event of that bucket
+
+An export can be incremental (see Incremental), to only get the events that
+changed since an earlier export. Events then keep their ids, so they can be
+matched with the ones exported before, and the export ends with a cursor to
+pass to the next one: as a "cursor" key of the document, or a last
+{"cursor": ...} line of NDJSON.
+"""
+import base64
+import binascii
+import json
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from aw_core.models import Event
+
+from . import bulk
+from .serialization import dumps
+
+FORMATS = {
+    "json": "application/json",
+    "ndjson": "application/x-ndjson",
+}
+
+
+def _event_dict(event: Event, keep_id: bool = False) -> Dict[str, Any]:
+    # Not to_json_dict, the serialiser formats the timestamp and duration itself
+    data = dict(event)
+    # Scrub event IDs
+    if not keep_id:
+        data.pop("id", None)
+    return data
+
+
+def encode_cursor(after_id: int, last_ids: Dict[str, int]) -> str:
+    cursor = {"id": after_id, "last": last_ids}
+    return base64.urlsafe_b64encode(json.dumps(cursor, separators=(",", ":")).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[int, Dict[str, int]]:
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, ValueError):
+        raise ValueError(f"Invalid cursor: {cursor}")
+    if (
+        not isinstance(data, dict)
+        or not isinstance(data.get("id"), int)
+        or data["id"] < 0
+        or not isinstance(data.get("last"), dict)
+        or not all(isinstance(i, int) for i in data["last"].values())
+    ):
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return data["id"], data["last"]
+
+
+class Incremental:
+    """
+    Selects the events of an incremental export: with ``cursor``, those
+    inserted or extended since the export that returned it (see
+    bulk.iter_changed_event_pages), otherwise those that end after ``since``,
+    or all of them without ``since``.
+
+    The cursor holds the highest event id of the database when the export
+    started, so events written during the export are in the next one too, and
+    the id of the last event of each bucket then, as heartbeats may extend it
+    until a later event is inserted. Exports with a cursor miss:
+
+     - deleted events, and events updated by id that are neither the last of
+       their bucket nor were when the cursor was made
+     - events inserted after the newest events were deleted, as SQLite may
+       reuse their ids
+
+    Other storage methods than peewee don't have global ids, with them an
+    export with a cursor has all the events.
+    """
+
+    def __init__(self, db, since: Optional[datetime] = None, cursor: Optional[str] = None) -> None:
+        self.db = db
+        self.since = since
+        self.after_id = None  # type: Optional[int]
+        self.last_ids = {}  # type: Dict[str, int]
+        if cursor:
+            self.after_id, self.last_ids = decode_cursor(cursor)
+        # The last events are read after the id, so that a last event missing
+        # from them has a higher id
+        with bulk.transaction(db):
+            self.next_id = bulk.max_event_id(db)
+            self.next_last_ids = bulk.last_event_ids(db)
+
+    def pages(self, bucket_id: str, page_size: int) -> Iterator[List[Event]]:
+        return bulk.iter_changed_event_pages(
+            self.db,
+            bucket_id,
+            after_id=self.after_id,
+            last_id=self.last_ids.get(bucket_id),
+            since=self.since if self.after_id is None else None,
+            page_size=page_size,
+        )
+
+    def cursor(self) -> str:
+        return encode_cursor(self.next_id, self.next_last_ids)
+
+
+def _pages(db, bucket_id: str, page_size: int, incremental: Optional[Incremental]):
+    if incremental is None:
+        return bulk.iter_event_pages(db, bucket_id, page_size)
+    return incremental.pages(bucket_id, page_size)
+
+
+def iter_export_json(
+    db,
+    bucket_ids: Iterable[str],
+    metadata: Callable[[str], Dict[str, Any]],
+    page_size: int = 1000,
+    incremental: Optional[Incremental] = None,
+) -> Iterator[str]:
+    """Yields the export of buckets as chunks of a JSON document, a page of events per chunk"""
+    yield '{"buckets": {'
+    for i, bucket_id in enumerate(bucket_ids):
+        bucket = dict(metadata(bucket_id))
+        bucket.pop("events", None)
+        # The metadata object without its closing brace, followed by the events
+        head = dumps(bucket)[:-1]
+        separator = ", " if len(bucket) else ""
+        yield f'{", " if i else ""}{dumps(bucket_id)}: {head}{separator}"events": ['
+        first = True
+        for page in _pages(db, bucket_id, page_size, incremental):
+            chunk = dumps([_event_dict(e, incremental is not None) for e in page])[1:-1]
+            yield chunk if first else ", " + chunk
+            first = False
+        yield "]}"
+    if incremental is None:
+        yield "}}"
+    else:
+        yield f'}}, "cursor": {dumps(incremental.cursor())}}}'
+
+
+def iter_export_ndjson(
+    db,
+    bucket_ids: Iterable[str],
+    metadata: Callable[[str], Dict[str, Any]],
+    page_size: int = 1000,
+    incremental: Optional[Incremental] = None,
+) -> Iterator[str]:
+    """Yields the export of buckets as NDJSON, a page of events per chunk"""
+    for bucket_id in bucket_ids:
+        bucket = dict(metadata(bucket_id))
+        bucket.pop("events", None)
+        yield dumps({"bucket": bucket}) + "\n"
+        for page in _pages(db, bucket_id, page_size, incremental):
+            yield "".join(
+                dumps({"event": _event_dict(e, incremental is not None)}) + "\n"
+                for e in page
+            )
+    if incremental is not None:
+        yield dumps({"cursor": incremental.cursor()}) + "\n"
+
+
+def iter_export(
+    db,
+    bucket_ids: List[str],
+    metadata: Callable[[str], Dict[str, Any]],
+    format: str = "json",
+    page_size: int = 1000,
+    incremental: Optional[Incremental] = None,
+) -> Iterator[str]:
+    if format == "ndjson":
+        return iter_export_ndjson(db, bucket_ids, metadata, page_size, incremental)
+    return iter_export_json(db, bucket_ids, metadata, page_size, incremental)
@@ -0,0 +1,140 @@
+import logging
+import threading
+from typing import Callable, Dict, Iterable, List, Optional
+
+from aw_core.models import Event
+
+logger = logging.getLogger(__name__)
+
+
+class HeartbeatBuffer:
+    """
+    Write-behind buffer for merged heartbeats.
+
+    A heartbeat that merges into the last event of a bucket only extends that
+    event's duration, so instead of issuing a replace_last for every pulse the
+    merged event is kept here and written once per flush interval.
+
+    Pending events are written:
+     - by the background flusher, at most ``flush_interval`` seconds after they were buffered
+     - before a new event is inserted into the same bucket (the data changed)
+     - before the bucket is read from, so reads always see the merged state
+     - on close (server shutdown)
+
+    The durability window is therefore bounded by ``flush_interval``: a crash
+    loses at most that many seconds of heartbeat merges, never whole events.
+
+    Writes to a bucket hold the lock that ``bucket_lock`` returns for it, so a
+    flush can't replace_last an event that was inserted after the pending one.
+    Buckets are flushed one at a time, each under its own lock, so a flush only
+    holds up heartbeats to the bucket it's writing. ServerAPI passes the shard
+    locks of its LastEventCache, which heartbeats already hold.
+    """
+
+    def __init__(
+        self,
+        db,
+        flush_interval: float,
+        bucket_lock: Optional[Callable[[str], threading.RLock]] = None,
+    ) -> None:
+        if flush_interval <= 0:
+            raise ValueError("flush_interval must be positive")
+        self.db = db
+        self.flush_interval = flush_interval
+        self._pending: Dict[str, Event] = {}
+        # Only guards _pending, never held while writing
+        self._lock = threading.Lock()
+        self._bucket_locks = [threading.RLock() for _ in range(64)]
+        self.bucket_lock = bucket_lock or self._striped_lock
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        # Statistics, mostly useful for benchmarking
+        self.buffered = 0
+        self.coalesced = 0
+        self.writes = 0
+
+    def _striped_lock(self, bucket_id: str) -> threading.RLock:
+        return self._bucket_locks[hash(bucket_id) % len(self._bucket_locks)]
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(
+            target=self._run, name="heartbeat-flusher", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.exception(f"Failed to flush buffered heartbeats: {e}")
+
+    def put(self, bucket_id: str, event: Event) -> None:
+        """Buffer ``event`` as the new state of the last event in the bucket."""
+        with self._lock:
+            if bucket_id in self._pending:
+                self.coalesced += 1
+            self._pending[bucket_id] = event
+            self.buffered += 1
+
+    def get(self, bucket_id: str) -> Optional[Event]:
+        return self._pending.get(bucket_id)
+
+    def pending(self) -> List[str]:
+        """The buckets with a buffered heartbeat"""
+        with self._lock:
+            return list(self._pending)
+
+    def insert(self, bucket_id: str, event: Event) -> None:
+        """Insert a new event, writing out the pending one for the bucket first."""
+        with self.bucket_lock(bucket_id):
+            self.flush(bucket_id)
+            self.db[bucket_id].insert(event)
+
+    def flush(self, bucket_id: Optional[str] = None) -> int:
+        """
+        Write pending events to the database.
+        Flushes only ``bucket_id`` if given, otherwise every bucket.
+        Returns the number of events written.
+        """
+        return self.flush_buckets(self.pending() if bucket_id is None else [bucket_id])
+
+    def flush_buckets(self, bucket_ids: Iterable[str]) -> int:
+        """Write the pending events of ``bucket_ids``, returns the number of events written"""
+        written = 0
+        for bucket_id in bucket_ids:
+            if bucket_id not in self._pending:
+                continue
+            with self.bucket_lock(bucket_id):
+                # Taken under the bucket lock, so nothing can be inserted
+                # into the bucket between here and the write
+                with self._lock:
+                    event = self._pending.pop(bucket_id, None)
+                if event is None:
+                    continue
+                try:
+                    self.db[bucket_id].replace_last(event)
+                except KeyError:
+                    # Bucket was deleted after the heartbeat was buffered
+                    logger.warning(f"Dropping buffered heartbeat for missing bucket {bucket_id}")
+                    continue
+                written += 1
+                self.writes += 1
+        if written:
+            logger.debug(f"Flushed {written} buffered heartbeat(s)")
+        return written
+
+    def discard(self, bucket_id: str) -> None:
+        with self._lock:
+            self._pending.pop(bucket_id, None)
+
+    def close(self) -> None:
+        """Stop the background flusher and write everything that is still pending."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
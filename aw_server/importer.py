@@ -0,0 +1,349 @@
+"""
+Streaming import of buckets.
+
+Uploads are parsed incrementally, one event at a time, and events are inserted
+in batches of ``batch_size``, each in its own transaction. An upload can be:
+
+ - an export document, {"buckets": {bucket_id: {...metadata, "events": [...]}}}
+ - NDJSON as produced by the ndjson export format, a {"bucket": {...}} line
+   for each bucket followed by {"event": {...}} lines for its events
+
+either of which may be gzip-compressed.
+
+Every import has an id, and the number of events of each bucket committed so
+far is recorded in a checkpoint file named after it. If an import fails, the
+same upload can be sent again with its import id to resume it: events that
+were already committed are skipped. The checkpoint is removed once the import
+is done.
+"""
+import gzip
+import io
+import json
+import logging
+import os
+import re
+import time
+import uuid
+import zlib
+from datetime import datetime
+from typing import IO, Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import iso8601
+
+from aw_core.models import Event
+
+from . import bulk
+from .exceptions import BadRequest
+from .validation import parse_event
+
+logger = logging.getLogger(__name__)
+
+_CHUNK_SIZE = 64 * 1024
+# Largest single value (an event, or bucket metadata) that is read
+_MAX_VALUE_SIZE = 16 * 1024 * 1024
+_WHITESPACE = " \t\n\r"
+_REQUIRED_METADATA = ("id", "type", "client", "hostname", "created")
+_GZIP_MAGIC = b"\x1f\x8b"
+
+# ("bucket", metadata) or ("event", event data)
+ImportItem = Tuple[str, Dict[str, Any]]
+
+
+class _JSONStream:
+    """Reads JSON values one at a time from a text stream, holding only what's not parsed yet"""
+
+    def __init__(self, f: IO[str]) -> None:
+        self.f = f
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self) -> bool:
+        if self.eof:
+            return False
+        chunk = self.f.read(_CHUNK_SIZE)
+        if not chunk:
+            self.eof = True
+            return False
+        if len(self.buffer) - self.pos > _MAX_VALUE_SIZE:
+            raise ValueError(f"Found a value larger than {_MAX_VALUE_SIZE} bytes")
+        self.buffer = self.buffer[self.pos :] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        """The next character that isn't whitespace, "" at the end"""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ""
+
+    def expect(self, char: str) -> None:
+        found = self.peek()
+        if found != char:
+            raise ValueError(f"Expected {char!r} but found {found!r}")
+        self.pos += 1
+
+    def value(self) -> Any:
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if self._fill():
+                    continue
+                raise
+            # A number at the end of the buffer could go on in the next chunk
+            if end == len(self.buffer) and self._fill():
+                continue
+            self.pos = end
+            return value
+
+    def members(self) -> Iterator[str]:
+        """Iterates over the keys of an object, the caller reads each value"""
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            if not isinstance(key, str):
+                raise ValueError("Expected an object key")
+            self.expect(":")
+            yield key
+            if self.peek() == ",":
+                self.pos += 1
+                continue
+            self.expect("}")
+            return
+
+    def elements(self) -> Iterator[Any]:
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.peek() == ",":
+                self.pos += 1
+                continue
+            self.expect("]")
+            return
+
+
+def iter_export_document(f: IO[str]) -> Iterator[ImportItem]:
+    """Yields the buckets and events of an export document as they're parsed"""
+    stream = _JSONStream(f)
+    for key in stream.members():
+        if key != "buckets":
+            stream.value()
+            continue
+        for bucket_id in stream.members():
+            metadata = {"id": bucket_id}  # type: Dict[str, Any]
+            started = False
+            held = []  # type: List[Dict[str, Any]]
+            for field in stream.members():
+                if field != "events":
+                    metadata[field] = stream.value()
+                    continue
+                if all(k in metadata for k in _REQUIRED_METADATA):
+                    started = True
+                    yield "bucket", metadata
+                    for event in stream.elements():
+                        yield "event", event
+                else:
+                    # The metadata comes after the events, so they have to be held
+                    held.extend(stream.elements())
+            if not started:
+                yield "bucket", metadata
+                for event in held:
+                    yield "event", event
+
+
+def iter_ndjson(f: IO[str]) -> Iterator[ImportItem]:
+    for n, line in enumerate(f, 1):
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        if "event" in item:
+            yield "event", item["event"]
+        elif "bucket" in item:
+            yield "bucket", item["bucket"]
+        elif "cursor" in item:
+            # Ends incremental exports
+            continue
+        else:
+            raise ValueError(f"Line {n} is neither a bucket nor an event")
+
+
+class _RawStream(io.RawIOBase):
+    """Lets a BufferedReader read from any object with a read method, like werkzeug's streams"""
+
+    def __init__(self, f: Any) -> None:
+        self.f = f
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b: Any) -> int:
+        data = self.f.read(len(b))
+        b[: len(data)] = data
+        return len(data)
+
+
+def open_upload(f: Any, format: Optional[str] = None) -> Iterator[ImportItem]:
+    """
+    Yields the buckets and events of an upload. Gzip compression is detected,
+    and the format (json or ndjson) too unless given.
+    """
+    stream = io.BufferedReader(_RawStream(f), _CHUNK_SIZE)  # type: Any
+    if stream.peek(2)[:2] == _GZIP_MAGIC:
+        stream = gzip.GzipFile(fileobj=stream)
+    if format is None:
+        # An export document starts with {"buckets", NDJSON with {"bucket"
+        head = stream.peek(64)[:64].decode("utf-8", errors="ignore")
+        match = re.match(r'\s*\{\s*"(buckets?)"', head)
+        format = "ndjson" if match is not None and match.group(1) == "bucket" else "json"
+    text = io.TextIOWrapper(stream, encoding="utf-8")
+    if format == "ndjson":
+        return iter_ndjson(text)
+    return iter_export_document(text)
+
+
+class Checkpoint:
+    """Events committed so far of each bucket of an import, kept in a JSON file"""
+
+    def __init__(self, directory: str, import_id: str) -> None:
+        if not re.fullmatch(r"[\w-]+", import_id):
+            raise BadRequest("InvalidImportId", f"Invalid import id: {import_id}")
+        self.path = os.path.join(directory, f"{import_id}.json")
+        self.committed = {}  # type: Dict[str, int]
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+            self.committed = state["committed"]
+        except FileNotFoundError:
+            pass
+
+    def save(self) -> None:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"committed": self.committed}, f)
+        os.replace(tmp_path, self.path)
+
+    def remove(self) -> None:
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class Importer:
+    """
+    Imports the buckets and events of an upload in batches, see the module docstring.
+
+    ``progress`` is called with the stats after every batch.
+    """
+
+    def __init__(
+        self,
+        api,
+        checkpoint_dir: str,
+        batch_size: int = 1000,
+        import_id: Optional[str] = None,
+        progress: Optional[Callable[[Dict[str, Any]], None]] = None,
+    ) -> None:
+        self.api = api
+        self.batch_size = max(1, batch_size)
+        self.import_id = import_id or uuid.uuid4().hex
+        self.checkpoint = Checkpoint(checkpoint_dir, self.import_id)
+        self.progress = progress
+        self.stats = {
+            "import_id": self.import_id,
+            "buckets": 0,
+            "events": 0,
+            "skipped": 0,
+        }  # type: Dict[str, Any]
+        self._last_log = time.monotonic()
+
+    def _create_bucket(self, metadata: Dict[str, Any]) -> str:
+        missing = [k for k in _REQUIRED_METADATA if k not in metadata]
+        if missing:
+            raise BadRequest(
+                "InvalidImport", f"Bucket {metadata.get('id')} is missing {', '.join(missing)}"
+            )
+        bucket_id = metadata["id"]
+        if bucket_id in self.api.db.buckets():
+            if bucket_id in self.checkpoint.committed:
+                # Resuming, the bucket was created by the failed attempt
+                return bucket_id
+            raise BadRequest("BucketExists", f"Bucket {bucket_id} already exists")
+        created = metadata["created"]
+        self.api.db.create_bucket(
+            bucket_id,
+            type=metadata["type"],
+            client=metadata["client"],
+            hostname=metadata["hostname"],
+            created=created if isinstance(created, datetime) else iso8601.parse_date(created),
+        )
+        self.checkpoint.committed[bucket_id] = 0
+        self.checkpoint.save()
+        return bucket_id
+
+    def _insert(self, bucket_id: str, batch: List[Event]) -> None:
+        with bulk.transaction(self.api.db):
+            self.api.create_events(bucket_id, batch)
+        # Only recorded once committed, so a failed batch is retried as a whole
+        self.checkpoint.committed[bucket_id] += len(batch)
+        self.checkpoint.save()
+        self.stats["events"] += len(batch)
+        if self.progress is not None:
+            self.progress(self.stats)
+        now = time.monotonic()
+        if now - self._last_log >= 10:
+            self._last_log = now
+            logger.info(f"Import {self.import_id}: {self.stats}")
+
+    def run(self, items: Iterator[ImportItem]) -> Dict[str, Any]:
+        bucket_id = None  # type: Optional[str]
+        to_skip = 0
+        batch = []  # type: List[Event]
+        try:
+            for kind, data in items:
+                if kind == "bucket":
+                    if batch:
+                        self._insert(bucket_id, batch)  # type: ignore
+                        batch = []
+                    bucket_id = self._create_bucket(data)
+                    to_skip = self.checkpoint.committed[bucket_id]
+                    self.stats["buckets"] += 1
+                    continue
+                if bucket_id is None:
+                    raise BadRequest("InvalidImport", "Found an event before any bucket")
+                if to_skip > 0:
+                    to_skip -= 1
+                    self.stats["skipped"] += 1
+                    continue
+                if isinstance(data, dict):
+                    # Incremental exports keep event ids, which would update events here
+                    data.pop("id", None)
+                # Anything but an event object fails here too, before it reaches a batch
+                batch.append(parse_event(data))
+                if len(batch) >= self.batch_size:
+                    self._insert(bucket_id, batch)
+                    batch = []
+            if batch:
+                self._insert(bucket_id, batch)  # type: ignore
+        except (ValueError, EOFError, gzip.BadGzipFile, zlib.error) as e:
+            raise BadRequest(
+                "InvalidImport",
+                f"Failed to read the upload after {self.stats['events']} events: {e}. "
+                f"Send it again with import_id={self.import_id} to resume.",
+            )
+        self.checkpoint.remove()
+        return self.stats
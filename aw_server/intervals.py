@@ -0,0 +1,136 @@
+"""
+Vectorised evaluation of the report query.
+
+REPORT_QUERY spends most of its time in flood, filter_period_intersect and
+sum_durations, which work on one Event object at a time. A day of afk
+heartbeats can be tens of thousands of events, so here events are turned into
+arrays of start and end times (integer microseconds) and the same operations
+are done with NumPy:
+
+ - flooding events that all have the same data, like the afk statuses, comes
+   down to a union of the intervals where gaps of up to ``pulsetime`` are
+   filled, which is what aw_transform.flood does for equal data
+ - intersecting two such unions and summing durations are done with
+   searchsorted and prefix sums
+
+Flooding events with differing data (window events) splits gaps at their
+midpoint and gives later events precedence, which isn't worth vectorising for
+the few hundred window events of a day, so that still uses aw_transform.flood.
+
+VECTORISED_REPORT_QUERY calls the engine as the query2 function
+``report_times``, which only the plan of that query can call (see
+query_plan), user queries can't. NumPy is optional, without it ``HAS_NUMPY``
+is False and reports use the plain query.
+"""
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Tuple
+
+from aw_core.models import Event
+from aw_query.functions import q2_typecheck
+from aw_transform import flood
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None  # type: ignore
+
+HAS_NUMPY = np is not None
+
+CALL_TITLE = "KomuTracker - Google Chrome"
+
+# Same as REPORT_QUERY in tracker_report, evaluated with the functions of QUERY_FUNCTIONS
+VECTORISED_REPORT_QUERY = """
+RETURN = report_times(query_bucket(afk_bucket), query_bucket(find_bucket(window_bucket)));
+"""
+
+_epoch = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_us = timedelta(microseconds=1)
+
+
+def to_arrays(events: List[Event]) -> Tuple["np.ndarray", "np.ndarray"]:
+    """Start and end times of events in microseconds since the epoch, sorted like flood sorts them"""
+    starts = np.fromiter(
+        ((e.timestamp - _epoch) // _us for e in events), dtype=np.int64, count=len(events)
+    )
+    durations = np.fromiter(
+        (e.duration // _us for e in events), dtype=np.int64, count=len(events)
+    )
+    order = np.lexsort((durations, starts))
+    starts = starts[order]
+    return starts, starts + durations[order]
+
+
+def flood_union(
+    starts: "np.ndarray", ends: "np.ndarray", pulsetime: float = 5
+) -> Tuple["np.ndarray", "np.ndarray"]:
+    """
+    The time covered by flood(events) for events with equal data, as sorted,
+    non-overlapping intervals. Takes sorted arrays from to_arrays.
+    """
+    if len(starts) == 0:
+        return starts, ends
+    # An event continues the current interval unless it starts more than
+    # pulsetime after the latest end seen so far
+    latest_end = np.maximum.accumulate(ends)
+    gap = starts[1:] - latest_end[:-1]
+    new = np.flatnonzero(gap > int(pulsetime * 1000000)) + 1
+    first = np.concatenate(([0], new))
+    last = np.concatenate((new - 1, [len(starts) - 1]))
+    union_starts, union_ends = starts[first], latest_end[last]
+    # flood drops events without duration, they only count when joined to others
+    keep = union_ends > union_starts
+    return union_starts[keep], union_ends[keep]
+
+
+def intersection_duration(
+    a_starts: "np.ndarray", a_ends: "np.ndarray", b_starts: "np.ndarray", b_ends: "np.ndarray"
+) -> int:
+    """
+    Microseconds covered by both a and b, like sum_durations(filter_period_intersect(a, b)).
+    Both must be sorted and non-overlapping.
+    """
+    if len(a_starts) == 0 or len(b_starts) == 0:
+        return 0
+    # For each interval of a, the intervals of b overlapping it are b[lo:hi]
+    lo = np.searchsorted(b_ends, a_starts, side="right")
+    hi = np.searchsorted(b_starts, a_ends, side="left")
+    overlapping = lo < hi
+    lo, hi = lo[overlapping], hi[overlapping]
+    a_starts, a_ends = a_starts[overlapping], a_ends[overlapping]
+    cumulative = np.concatenate(([0], np.cumsum(b_ends - b_starts)))
+    total = cumulative[hi] - cumulative[lo]
+    # Cut the parts of the first and last overlapping interval of b that stick out of a
+    total -= np.maximum(0, a_starts - b_starts[lo])
+    total -= np.maximum(0, b_ends[hi - 1] - a_ends)
+    return int(total.sum())
+
+
+def report_times(
+    afk_events: List[Event], window_events: List[Event], pulsetime: float = 5
+) -> Dict[str, timedelta]:
+    """Computes the same spent and call time as REPORT_QUERY in tracker_report"""
+    not_afk = flood_union(
+        *to_arrays([e for e in afk_events if e.data.get("status") == "not-afk"]),
+        pulsetime=pulsetime,
+    )
+    afk = flood_union(
+        *to_arrays([e for e in afk_events if e.data.get("status") == "afk"]),
+        pulsetime=pulsetime,
+    )
+    # Window events differ in data, see the module docstring
+    calls = to_arrays(
+        [e for e in flood(window_events, pulsetime) if e.data.get("title") == CALL_TITLE]
+    )
+    return {
+        "spent_time": timedelta(microseconds=int((not_afk[1] - not_afk[0]).sum())),
+        "call_time": timedelta(microseconds=intersection_duration(*calls, *afk)),
+    }
+
+
+@q2_typecheck
+def q2_report_times(afk_events: list, window_events: list) -> Dict[str, timedelta]:
+    return report_times(afk_events, window_events)
+
+
+# The query2 functions VECTORISED_REPORT_QUERY can call on top of the usual ones
+QUERY_FUNCTIONS = {"report_times": q2_report_times}
@@ -0,0 +1,118 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from aw_core.models import Event
+
+
+class _Shard:
+    def __init__(self) -> None:
+        self.lock = threading.RLock()
+        # bucket_id -> (event, last access), least recently used first
+        self.entries = OrderedDict()  # type: OrderedDict[str, Tuple[Event, float]]
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+class LastEventCache:
+    """
+    Bounded cache of the last event in each bucket, used to merge heartbeats
+    without reading the bucket from the database.
+
+    Buckets are spread over a fixed number of shards, each with its own lock,
+    so concurrent heartbeats only contend when their buckets share a shard.
+    The shard lock is also exposed through lock() so that a heartbeat can hold
+    it across the read-merge-write of its bucket.
+
+    Idle buckets are evicted when a shard exceeds its share of ``max_size``
+    (least recently used first) or when they haven't been accessed for ``ttl`` seconds.
+    """
+
+    def __init__(self, max_size: int = 10000, ttl: float = 3600, shards: int = 64) -> None:
+        self.ttl = ttl
+        self._shards = [_Shard() for _ in range(shards)]
+        self._shard_size = max(1, -(-max_size // shards))
+
+    def _shard(self, bucket_id: str) -> _Shard:
+        return self._shards[hash(bucket_id) % len(self._shards)]
+
+    def lock(self, bucket_id: str) -> threading.RLock:
+        """The (reentrant) lock guarding the shard that bucket_id belongs to"""
+        return self._shard(bucket_id).lock
+
+    def get(self, bucket_id: str) -> Optional[Event]:
+        shard = self._shard(bucket_id)
+        now = time.monotonic()
+        with shard.lock:
+            entry = shard.entries.get(bucket_id)
+            if entry is not None and now - entry[1] > self.ttl:
+                del shard.entries[bucket_id]
+                shard.evictions += 1
+                entry = None
+            if entry is None:
+                shard.misses += 1
+                return None
+            shard.hits += 1
+            shard.entries[bucket_id] = (entry[0], now)
+            shard.entries.move_to_end(bucket_id)
+            return entry[0]
+
+    def set(self, bucket_id: str, event: Event) -> None:
+        shard = self._shard(bucket_id)
+        now = time.monotonic()
+        with shard.lock:
+            shard.entries[bucket_id] = (event, now)
+            shard.entries.move_to_end(bucket_id)
+            self._evict(shard, now)
+
+    def pop(self, bucket_id: str) -> Optional[Event]:
+        shard = self._shard(bucket_id)
+        with shard.lock:
+            entry = shard.entries.pop(bucket_id, None)
+            return entry[0] if entry is not None else None
+
+    def _evict(self, shard: _Shard, now: float) -> None:
+        entries = shard.entries
+        while len(entries) > self._shard_size:
+            entries.popitem(last=False)
+            shard.evictions += 1
+        # Entries are ordered by last access, so expired ones are at the front
+        while entries:
+            bucket_id, (_, accessed) = next(iter(entries.items()))
+            if now - accessed <= self.ttl:
+                break
+            del entries[bucket_id]
+            shard.evictions += 1
+
+    def expire(self) -> None:
+        """Evict every entry that has outlived the TTL"""
+        now = time.monotonic()
+        for shard in self._shards:
+            with shard.lock:
+                self._evict(shard, now)
+
+    def clear(self) -> None:
+        for shard in self._shards:
+            with shard.lock:
+                shard.entries.clear()
+
+    def __contains__(self, bucket_id: str) -> bool:
+        shard = self._shard(bucket_id)
+        with shard.lock:
+            entry = shard.entries.get(bucket_id)
+            return entry is not None and time.monotonic() - entry[1] <= self.ttl
+
+    def __len__(self) -> int:
+        return sum(len(shard.entries) for shard in self._shards)
+
+    def stats(self) -> Dict[str, int]:
+        hits = sum(shard.hits for shard in self._shards)
+        misses = sum(shard.misses for shard in self._shards)
+        return {
+            "size": len(self),
+            "hits": hits,
+            "misses": misses,
+            "evictions": sum(shard.evictions for shard in self._shards),
+        }
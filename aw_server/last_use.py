@@ -0,0 +1,138 @@
+import logging
+import threading
+import time
+from datetime import date, datetime, timezone
+from typing import Callable, Dict, Optional
+
+import pytz
+
+logger = logging.getLogger(__name__)
+
+TIMEZONE = pytz.timezone("Asia/Saigon")
+
+
+def write_last_used_at(last_used: Dict[str, datetime]) -> None:
+    """Sets last_used_at of several users, by mezon_user_id, in a single UPDATE"""
+    from aw_datastore.storages.peewee import UserModel
+    from peewee import Case
+
+    UserModel.update(
+        last_used_at=Case(UserModel.mezon_user_id, list(last_used.items()))
+    ).where(UserModel.mezon_user_id.in_(list(last_used))).execute()
+
+
+def _day(dt) -> date:
+    if isinstance(dt, str):
+        dt = datetime.fromisoformat(dt)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(TIMEZONE).date()
+
+
+class LastUseTracker:
+    """
+    Write-behind tracking of when users last used the tracker.
+
+    last_used_at is the time of the first authenticated request of each day
+    (in Asia/Saigon), so a user only needs a write once a day. touch() checks
+    that with a dict lookup and a float comparison, and the writes that are
+    needed are kept in memory and written by a background flusher every
+    ``flush_interval`` seconds, in one statement for all users.
+    With a ``flush_interval`` of 0, touch() writes straight away.
+    """
+
+    def __init__(
+        self,
+        flush_interval: float = 10,
+        write: Callable[[Dict[str, datetime]], None] = write_last_used_at,
+    ) -> None:
+        self.flush_interval = flush_interval
+        self.write = write
+        # Day of the last use of each user, by mezon_user_id
+        self._last_day = {}  # type: Dict[str, date]
+        self._pending = {}  # type: Dict[str, datetime]
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None  # type: Optional[threading.Thread]
+        self._today = date.min
+        self._today_ends = 0.0
+
+        self.touches = 0
+        self.writes = 0
+
+    def start(self) -> None:
+        if self._thread is not None or self.flush_interval <= 0:
+            return
+        self._thread = threading.Thread(
+            target=self._run, name="last-use-flusher", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.exception(f"Failed to write last use of users: {e}")
+
+    def today(self) -> date:
+        if time.time() >= self._today_ends:
+            now = datetime.now(TIMEZONE)
+            self._today = now.date()
+            midnight = TIMEZONE.localize(datetime.combine(self._today, datetime.min.time()))
+            self._today_ends = midnight.timestamp() + 24 * 3600
+        return self._today
+
+    def touch(self, user: dict) -> None:
+        """Records a use by user, updating its last_used_at if it's the first use today"""
+        self.touches += 1
+        today = self.today()
+        user_id = user["mezon_user_id"]
+        last_day = self._last_day.get(user_id)
+        if last_day == today:
+            return
+        if last_day is None and user.get("last_used_at"):
+            # Not seen by this process yet
+            last_day = _day(user["last_used_at"])
+            self._last_day[user_id] = last_day
+            if last_day == today:
+                return
+
+        now = datetime.now(timezone.utc)
+        user["last_used_at"] = now.isoformat()
+        with self._lock:
+            self._last_day[user_id] = today
+            self._pending[user_id] = now
+        if self.flush_interval <= 0:
+            self.flush()
+
+    def forget(self, user_id: str) -> None:
+        """Drops what's known about a user, for when it's saved again"""
+        self._last_day.pop(user_id, None)
+
+    def flush(self) -> int:
+        """Writes pending updates, returns the number of users updated"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        try:
+            self.write(pending)
+        except Exception:
+            # Try again on the next flush, unless newer uses came in meanwhile
+            with self._lock:
+                for user_id, dt in pending.items():
+                    self._pending.setdefault(user_id, dt)
+            raise
+        self.writes += 1
+        return len(pending)
+
+    def close(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        try:
+            self.flush()
+        except Exception as e:
+            logger.exception(f"Failed to write last use of users: {e}")
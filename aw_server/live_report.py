@@ -0,0 +1,217 @@
+"""
+Running totals of today's reports, kept up to date as events come in.
+
+Reports of past days are computed once and stored, but today's report changes
+with every heartbeat, so it used to be recomputed from the raw events on every
+request. Instead, once a user's report for today has been computed, LiveReport
+follows the writes to the user's afk and window buckets and adds the new time
+to the computed totals, so the next request is a lookup.
+
+The running totals approximate REPORT_QUERY: events are unioned with gaps of
+up to ``pulsetime`` closed, like flood does for events with equal data. To
+correct any drift, totals are only trusted for ``reconcile_interval`` seconds
+after which the report is computed from the events again.
+"""
+import bisect
+import logging
+import threading
+import time
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import iso8601
+
+from aw_core.models import Event
+
+logger = logging.getLogger(__name__)
+
+AFK_BUCKET_PREFIX = "aw-watcher-afk_"
+WINDOW_BUCKET_PREFIX = "aw-watcher-window_"
+CALL_TITLE = "KomuTracker - Google Chrome"
+
+
+class _Intervals:
+    """Union of intervals in seconds since the epoch, with gaps of up to ``bridge`` seconds closed"""
+
+    def __init__(self, bridge: float) -> None:
+        self.bridge = bridge
+        self.starts = []  # type: List[float]
+        self.ends = []  # type: List[float]
+        self.total = 0.0
+
+    def add(self, start: float, end: float) -> None:
+        if end < start:
+            return
+        # Intervals within reach of [start, end] are merged into it. Since they
+        # don't overlap, both starts and ends are sorted.
+        i = bisect.bisect_left(self.ends, start - self.bridge)
+        j = bisect.bisect_right(self.starts, end + self.bridge)
+        if i < j:
+            start = min(start, self.starts[i])
+            end = max(end, self.ends[j - 1])
+            self.total -= sum(self.ends[k] - self.starts[k] for k in range(i, j))
+            del self.starts[i:j]
+            del self.ends[i:j]
+        self.starts.insert(i, start)
+        self.ends.insert(i, end)
+        self.total += end - start
+
+    def intersection(self, other: "_Intervals") -> float:
+        """Total length of the time covered by both"""
+        total = 0.0
+        i = j = 0
+        while i < len(self.starts) and j < len(other.starts):
+            start = max(self.starts[i], other.starts[j])
+            end = min(self.ends[i], other.ends[j])
+            if end > start:
+                total += end - start
+            if self.ends[i] < other.ends[j]:
+                i += 1
+            else:
+                j += 1
+        return total
+
+
+class _UserDay:
+    """Today's report of a user: computed totals plus the time covered by events written since"""
+
+    def __init__(
+        self,
+        day: date,
+        start: float,
+        end: float,
+        spent_time: timedelta,
+        call_time: timedelta,
+        pulsetime: float,
+    ) -> None:
+        self.day = day
+        self.start = start
+        self.end = end
+        self.spent_time = spent_time
+        self.call_time = call_time
+        self.not_afk = _Intervals(pulsetime)
+        self.afk = _Intervals(pulsetime)
+        self.calls = _Intervals(pulsetime)
+        self.reconciled_at = time.monotonic()
+        self._call_seconds = 0.0
+        self._calls_changed = False
+
+    def add(self, intervals: _Intervals, event: Event) -> None:
+        start = event.timestamp.timestamp()
+        end = min(start + event.duration.total_seconds(), self.end)
+        start = max(start, self.start)
+        if end > start:
+            intervals.add(start, end)
+
+    def add_afk(self, events: Iterable[Event]) -> None:
+        for e in events:
+            status = e.data.get("status")
+            if status == "not-afk":
+                self.add(self.not_afk, e)
+            elif status == "afk":
+                self.add(self.afk, e)
+                self._calls_changed = True
+
+    def add_window(self, events: Iterable[Event]) -> None:
+        for e in events:
+            if e.data.get("title") == CALL_TITLE:
+                self.add(self.calls, e)
+                self._calls_changed = True
+
+    def times(self) -> Tuple[timedelta, timedelta]:
+        if self._calls_changed:
+            self._call_seconds = self.calls.intersection(self.afk)
+            self._calls_changed = False
+        return (
+            self.spent_time + timedelta(seconds=self.not_afk.total),
+            self.call_time + timedelta(seconds=self._call_seconds),
+        )
+
+
+class LiveReport:
+    def __init__(self, reconcile_interval: float = 900, pulsetime: float = 5) -> None:
+        self.reconcile_interval = reconcile_interval
+        self.pulsetime = pulsetime
+        self._users = {}  # type: Dict[str, _UserDay]
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _user(bucket_id: str) -> Tuple[Optional[str], bool]:
+        """Returns (email, is_afk_bucket) of a watcher bucket, or (None, False) for other buckets"""
+        if bucket_id.startswith(AFK_BUCKET_PREFIX):
+            return bucket_id[len(AFK_BUCKET_PREFIX):], True
+        if bucket_id.startswith(WINDOW_BUCKET_PREFIX):
+            return bucket_id[len(WINDOW_BUCKET_PREFIX):], False
+        return None, False
+
+    def add_events(self, bucket_id: str, events: List[Event]) -> None:
+        """Adds events written to a bucket to the report of its user, if it's being followed"""
+        email, is_afk = self._user(bucket_id)
+        if email is None:
+            return
+        with self._lock:
+            user = self._users.get(email)
+            if user is None:
+                return
+            if is_afk:
+                user.add_afk(events)
+            else:
+                user.add_window(events)
+
+    def discard(self, bucket_id: str) -> None:
+        """Stops following the user of a bucket, for when events were deleted"""
+        email, _ = self._user(bucket_id)
+        if email is not None:
+            with self._lock:
+                self._users.pop(email, None)
+
+    def get(self, email: str, day: date) -> Optional[Tuple[timedelta, timedelta]]:
+        """
+        Returns (spent_time, call_time) of the user on day if it's followed
+        and was reconciled recently, otherwise None.
+        """
+        with self._lock:
+            user = self._users.get(email)
+            if (
+                user is None
+                or user.day != day
+                or time.monotonic() - user.reconciled_at > self.reconcile_interval
+            ):
+                self.misses += 1
+                return None
+            self.hits += 1
+            return user.times()
+
+    def reconcile(
+        self,
+        email: str,
+        day: date,
+        timeperiod: str,
+        since: datetime,
+        spent_time: timedelta,
+        call_time: timedelta,
+    ) -> None:
+        """
+        Starts following the report of a user on day (today) from the result of
+        REPORT_QUERY over timeperiod, computed from the events written before ``since``.
+        """
+        start, end = [iso8601.parse_date(dt).timestamp() for dt in timeperiod.split("/")[:2]]
+        user = _UserDay(
+            day,
+            max(start, since.timestamp()),
+            end,
+            spent_time,
+            call_time,
+            self.pulsetime,
+        )
+        with self._lock:
+            self._users[email] = user
+
+    def clear(self) -> None:
+        with self._lock:
+            self._users.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {"users": len(self._users), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,189 @@
+import http.client
+import json
+import logging
+import socket
+import threading
+import time
+import urllib.parse
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Errors from a kept-alive connection the server closed meanwhile, after which
+# the request is sent again, once, on a new connection
+_STALE_CONNECTION_ERRORS = (
+    http.client.RemoteDisconnected,
+    http.client.CannotSendRequest,
+    ConnectionResetError,
+    BrokenPipeError,
+)
+
+
+class OAuth2Client:
+    """
+    Client for the token and userinfo endpoints of the Mezon OAuth2 server.
+
+    Connections are kept alive and reused, up to ``pool_size`` idle ones, so a
+    wave of logins doesn't pay a TLS handshake per call. Every call is bounded
+    by ``connect_timeout`` and ``read_timeout``, and at most
+    ``max_concurrency`` calls are made at once, others wait up to
+    ``queue_timeout`` seconds for their turn.
+
+    ``request`` returns the decoded JSON response, or None if the call failed.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        client_id: str,
+        client_secret: str,
+        redirect_uri: str,
+        scheme: str = "https",
+        pool_size: int = 8,
+        max_concurrency: int = 16,
+        connect_timeout: float = 5,
+        read_timeout: float = 10,
+        queue_timeout: float = 10,
+    ) -> None:
+        self.host = host
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.redirect_uri = redirect_uri
+        self.scheme = scheme
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.queue_timeout = queue_timeout
+        self._idle = []  # type: List[http.client.HTTPConnection]
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max(1, max_concurrency))
+
+        self.requests = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.rejected = 0
+        self.connections = 0
+        self.reused = 0
+        # Latencies in seconds of the latest calls
+        self._latencies = deque(maxlen=1000)  # type: Deque[float]
+
+    def _connect(self) -> http.client.HTTPConnection:
+        cls = http.client.HTTPSConnection if self.scheme == "https" else http.client.HTTPConnection
+        conn = cls(self.host, timeout=self.connect_timeout)
+        conn.connect()
+        conn.sock.settimeout(self.read_timeout)
+        with self._lock:
+            self.connections += 1
+        return conn
+
+    def _checkout(self) -> Optional[http.client.HTTPConnection]:
+        with self._lock:
+            if self._idle:
+                self.reused += 1
+                return self._idle.pop()
+        return None
+
+    def _checkin(self, conn: http.client.HTTPConnection) -> None:
+        with self._lock:
+            if len(self._idle) < self.pool_size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def _send(
+        self, conn: http.client.HTTPConnection, method: str, path: str, body: str
+    ) -> http.client.HTTPResponse:
+        conn.request(
+            method,
+            path,
+            body=body,
+            headers={"Content-type": "application/x-www-form-urlencoded"},
+        )
+        return conn.getresponse()
+
+    def request(self, method: str, path: str, params: Dict[str, Any]) -> Optional[Any]:
+        body = urllib.parse.urlencode(
+            {
+                "client_id": self.client_id,
+                "client_secret": self.client_secret,
+                "redirect_uri": self.redirect_uri,
+                **params,
+            }
+        )
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            self.rejected += 1
+            logger.error(f"OAuth2 {path}: too many calls in progress")
+            return None
+        started = time.monotonic()
+        conn = None
+        try:
+            self.requests += 1
+            conn = self._checkout()
+            reused = conn is not None
+            if conn is None:
+                conn = self._connect()
+            try:
+                response = self._send(conn, method, path, body)
+            except _STALE_CONNECTION_ERRORS:
+                # Calls aren't idempotent, so they're only sent again when
+                # a kept-alive connection turned out to be closed
+                if not reused:
+                    raise
+                conn.close()
+                conn = self._connect()
+                response = self._send(conn, method, path, body)
+            data = response.read()
+            if response.will_close:
+                conn.close()
+            else:
+                self._checkin(conn)
+            conn = None
+            if response.status != 200:
+                self.failures += 1
+                logger.error(f"OAuth2 {path} failed with {response.status}: {data[:200]!r}")
+                return None
+            return json.loads(data)
+        except socket.timeout:
+            self.failures += 1
+            self.timeouts += 1
+            logger.error(f"OAuth2 {path} timed out")
+            return None
+        except (OSError, http.client.HTTPException, ValueError) as e:
+            self.failures += 1
+            logger.error(f"OAuth2 {path} failed: {e!r}")
+            return None
+        finally:
+            if conn is not None:
+                conn.close()
+            self._latencies.append(time.monotonic() - started)
+            self._slots.release()
+
+    def close(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+    def stats(self) -> Dict[str, Any]:
+        latencies = sorted(self._latencies)
+
+        def percentile(p: float) -> Optional[float]:
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000, 1)
+
+        return {
+            "requests": self.requests,
+            "failures": self.failures,
+            "timeouts": self.timeouts,
+            "rejected": self.rejected,
+            "connections": self.connections,
+            "reused": self.reused,
+            "idle": len(self._idle),
+            "latency_ms": {
+                "p50": percentile(0.5),
+                "p95": percentile(0.95),
+                "max": percentile(1.0),
+            },
+        }
@@ -0,0 +1,186 @@
+import copy
+import itertools
+import json
+import threading
+import time
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+CacheKey = Tuple[str, str, datetime, datetime]
+
+_min_dt = datetime.min.replace(tzinfo=timezone.utc)
+_max_dt = datetime.max.replace(tzinfo=timezone.utc)
+
+
+def normalize_query(query: str) -> str:
+    """Collapses whitespace outside of string literals so that formatting doesn't affect cache keys"""
+    out = []  # type: List[str]
+    quote = None
+    prev_char = None
+    pending_space = False
+    for char in query:
+        if quote:
+            out.append(char)
+            if char == quote and prev_char != "\\":
+                quote = None
+        elif char.isspace():
+            pending_space = True
+        else:
+            if pending_space and out:
+                out.append(" ")
+            pending_space = False
+            if char in "'\"":
+                quote = char
+            out.append(char)
+        prev_char = char
+    return "".join(out)
+
+
+def _estimate_size(result: Any) -> int:
+    return len(json.dumps(result, default=str))
+
+
+class QueryCache:
+    """
+    LRU cache of query2 results, one entry per query and single timeperiod.
+
+    Only periods that have already ended are cached, results for those can only
+    change when events are written into the period, in which case invalidate()
+    drops every entry overlapping the written range.
+
+    Entries are evicted least recently used first when there are more than
+    ``max_entries`` of them or their estimated (JSON) size exceeds ``max_bytes``.
+
+    invalidate() only sees the writes of this process. When several processes
+    share the database, writes made by the others (a late replay into a past
+    period, say) are only picked up once entries expire, ``ttl`` seconds after
+    being cached (never if 0).
+    """
+
+    def __init__(
+        self, max_entries: int = 1000, max_bytes: int = 64 * 1024 * 1024, ttl: float = 300
+    ) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        # Recent writes as (sequence number, start, end), used to detect a write
+        # into a period while its query was running
+        self._write_seq = itertools.count(1)
+        self._writes = deque(maxlen=10000)  # type: deque
+        # key -> (result, size, expires at or None)
+        self._entries = OrderedDict()  # type: OrderedDict[CacheKey, Tuple[Any, int, Optional[float]]]
+        self._lock = threading.Lock()
+        self._bytes = 0
+        # Latest end of any cached period, writes after it can't invalidate anything
+        self._max_end = None  # type: Optional[datetime]
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def key(
+        name: str,
+        query: str,
+        starttime: datetime,
+        endtime: datetime,
+        params: Optional[Dict[str, Any]] = None,
+    ) -> CacheKey:
+        query = normalize_query(query)
+        if params:
+            query += " " + json.dumps(params, sort_keys=True, default=str)
+        # The name is only part of the result if the query reads it
+        return (query, name if "NAME" in query else "", starttime, endtime)
+
+    def get(self, key: CacheKey) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] is not None and entry[2] <= time.monotonic():
+                self._bytes -= self._entries.pop(key)[1]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+        # Results contain mutable events, don't let callers modify the cached copy
+        return copy.deepcopy(entry[0])
+
+    def token(self) -> int:
+        """Take before running a query and pass to put(), see put()"""
+        return self._writes[-1][0] if self._writes else 0
+
+    def _written_since(self, token: int, starttime: datetime, endtime: datetime) -> bool:
+        writes = list(self._writes)
+        if writes and writes[0][0] > token + 1:
+            # Too many writes to tell, assume the worst
+            return True
+        return any(
+            seq > token and start <= endtime and starttime <= end
+            for seq, start, end in writes
+        )
+
+    def put(self, key: CacheKey, result: Any, token: int) -> None:
+        """
+        Caches a result computed after ``token`` was taken.
+        The result isn't cached if events were written into its period in the meantime,
+        since the query might not have seen them.
+        """
+        if self._written_since(token, key[2], key[3]):
+            return
+        size = _estimate_size(result)
+        if size > self.max_bytes:
+            return
+        result = copy.deepcopy(result)
+        expires = time.monotonic() + self.ttl if self.ttl > 0 else None
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = (result, size, expires)
+            self._bytes += size
+            endtime = key[3]
+            if self._max_end is None or endtime > self._max_end:
+                self._max_end = endtime
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def invalidate(self, starttime: Optional[datetime] = None, endtime: Optional[datetime] = None) -> None:
+        """Drops every entry whose period overlaps [starttime, endtime] (everything if no range is given)"""
+        self._writes.append(
+            (next(self._write_seq), starttime or _min_dt, endtime or _max_dt)
+        )
+        if self._max_end is None:
+            return
+        if starttime is not None and starttime > self._max_end:
+            # The common case: a heartbeat for the current period
+            return
+        with self._lock:
+            for key in list(self._entries):
+                _, _, start, end = key
+                if (starttime is None or starttime <= end) and (endtime is None or start <= endtime):
+                    self._bytes -= self._entries.pop(key)[1]
+                    self.invalidations += 1
+            if not self._entries:
+                self._max_end = None
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self._max_end = None
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
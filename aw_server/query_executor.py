@@ -0,0 +1,121 @@
+import logging
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Executor,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from aw_datastore.datastore import Datastore
+from aw_datastore.storages.memory import MemoryStorage
+
+from .query_plan import run_query
+
+logger = logging.getLogger(__name__)
+
+# (name, query, starttime, endtime, params)
+QueryTask = Tuple[str, str, datetime, datetime, Optional[Dict[str, Any]]]
+
+# Datastore of a query worker process, see _init_worker
+_worker_db = None  # type: Optional[Datastore]
+
+
+def _init_worker(storage_method, testing: bool) -> None:
+    global _worker_db
+    _worker_db = Datastore(storage_method, testing=testing)
+
+
+def _query_in_worker(
+    name: str,
+    query: str,
+    starttime: datetime,
+    endtime: datetime,
+    params: Optional[Dict[str, Any]],
+) -> Any:
+    return run_query(name, query, starttime, endtime, _worker_db, params)
+
+
+class QueryExecutor:
+    """
+    Evaluates a query over several timeperiods, returning the results in order.
+
+    Modes:
+     - "serial": one period after the other in the calling thread
+     - "thread": on a thread pool shared by all requests
+     - "process": on a process pool, each worker with its own connection to the datastore.
+       Sidesteps the GIL for CPU heavy queries but isn't available with the memory storage.
+
+    No single call runs more than ``max_parallel`` periods at a time, so a month view
+    can't occupy the whole pool while other requests wait.
+    """
+
+    def __init__(
+        self,
+        db,
+        testing: bool,
+        mode: str = "serial",
+        workers: int = 4,
+        max_parallel: int = 4,
+    ) -> None:
+        if mode not in ("serial", "thread", "process"):
+            raise ValueError(f"Unknown query executor mode: {mode}")
+        storage_method = type(db.storage_strategy)
+        if mode == "process" and storage_method is MemoryStorage:
+            logger.warning(
+                "The process query executor can't share the memory storage, using threads"
+            )
+            mode = "thread"
+
+        self.db = db
+        self.mode = mode
+        self.max_parallel = max(1, max_parallel)
+        self._pool = None  # type: Optional[Executor]
+        if mode == "thread":
+            self._pool = ThreadPoolExecutor(workers, thread_name_prefix="query")
+        elif mode == "process":
+            self._pool = ProcessPoolExecutor(
+                workers,
+                initializer=_init_worker,
+                initargs=(storage_method, testing),
+            )
+
+    def _submit(self, pool: Executor, task: QueryTask) -> Future:
+        if self.mode == "process":
+            return pool.submit(_query_in_worker, *task)
+        name, query, starttime, endtime, params = task
+        return pool.submit(run_query, name, query, starttime, endtime, self.db, params)
+
+    def run(self, tasks: List[QueryTask]) -> List[Any]:
+        if self._pool is None or len(tasks) <= 1:
+            return [
+                run_query(name, query, starttime, endtime, self.db, params)
+                for name, query, starttime, endtime, params in tasks
+            ]
+
+        results = [None] * len(tasks)  # type: List[Any]
+        pending = {}
+        queued = iter(enumerate(tasks))
+        try:
+            for i, task in queued:
+                pending[self._submit(self._pool, task)] = i
+                if len(pending) >= self.max_parallel:
+                    break
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    results[pending.pop(future)] = future.result()
+                    for i, task in queued:
+                        pending[self._submit(self._pool, task)] = i
+                        break
+        finally:
+            for future in pending:
+                future.cancel()
+        return results
+
+    def shutdown(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
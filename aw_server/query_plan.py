@@ -0,0 +1,171 @@
+"""
+Parse-once execution of query2 queries.
+
+aw_query.query2.query tokenises and parses the query text on every call, and
+binds variable references to their values while parsing, so a parsed query
+can't be reused. Here a query is parsed once into a plan whose variables are
+looked up when the plan is executed. Plans are cached by query text, so report
+templates and web UI queries are only parsed the first time they're seen.
+
+Plans can also be executed with parameters, which are bound as variables
+before the first statement runs. This lets templates refer to a bucket as
+``query_bucket(afk_bucket)`` instead of formatting the bucket id into the text,
+so all users share one plan.
+
+Some templates call functions of the server that aren't registered with
+aw_query (see _query_functions), so they're only bound in the plans of those
+templates and user queries can't call them.
+"""
+import functools
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from aw_query import query2
+from aw_query.exceptions import QueryInterpretException
+
+from . import intervals
+
+Plan = Tuple[Tuple[Any, Any], ...]
+
+# Query functions only the plan of a query can call, by query text
+_query_functions = {}  # type: Dict[str, Dict[str, Callable]]
+if intervals.HAS_NUMPY:
+    _query_functions[intervals.VECTORISED_REPORT_QUERY] = intervals.QUERY_FUNCTIONS
+
+# Names that are set by the query engine and can't be overridden by parameters
+_reserved_names = frozenset(["NAME", "STARTTIME", "ENDTIME", "RETURN"])
+
+
+class _QLateVariable(query2.QVariable):
+    """A variable reference resolved from the namespace at execution time"""
+
+    def interpret(self, datastore, namespace: dict):
+        if self.name not in namespace:
+            raise QueryInterpretException(
+                f"Tried to reference variable '{self.name}' which is not defined"
+            )
+        return namespace[self.name]
+
+
+class _QPlanFunction(query2.QFunction):
+    """A call of a function from _query_functions, bound when the plan is compiled"""
+
+    def __init__(self, name: str, args: list, function: Callable) -> None:
+        super().__init__(name, args)
+        self.function = function
+
+    def interpret(self, datastore, namespace: dict):
+        args = [arg.interpret(datastore, namespace) for arg in self.args]
+        try:
+            return self.function(*args)
+        except TypeError:
+            raise QueryInterpretException(
+                f"Tried to call function {self.name} with invalid amount of arguments"
+            ) from None
+
+
+def _late_bind(token, functions: Dict[str, Callable]):
+    if isinstance(token, query2.QVariable):
+        return _QLateVariable(token.name, None)
+    if isinstance(token, query2.QFunction):
+        args = [_late_bind(arg, functions) for arg in token.args]
+        if token.name in functions:
+            return _QPlanFunction(token.name, args, functions[token.name])
+        return query2.QFunction(token.name, args)
+    if isinstance(token, query2.QDict):
+        return query2.QDict({k: _late_bind(v, functions) for k, v in token.value.items()})
+    if isinstance(token, query2.QList):
+        return query2.QList([_late_bind(v, functions) for v in token.value])
+    return token
+
+
+def _split_statements(query: str) -> List[str]:
+    """Split query into statements on semicolons, ignoring semicolons inside string literals."""
+    statements = []
+    current = []  # type: List[str]
+    quote = None
+    prev_char = None
+    for char in query:
+        if quote:
+            if char == quote and prev_char != "\\":
+                quote = None
+        elif char in "'\"":
+            quote = char
+        elif char == ";":
+            statements.append("".join(current))
+            current = []
+            prev_char = char
+            continue
+        current.append(char)
+        prev_char = char
+    statements.append("".join(current))
+    return [s.strip() for s in statements if s.strip()]
+
+
+@functools.lru_cache(maxsize=256)
+def string_literals(query: str) -> Tuple[str, ...]:
+    """The string literals of a query, which include the names (or parts of names) of the buckets it reads"""
+    literals = []
+    current = []  # type: List[str]
+    quote = None
+    prev_char = None
+    for char in query:
+        if quote:
+            if char == quote and prev_char != "\\":
+                literals.append("".join(current))
+                quote = None
+            else:
+                current.append(char)
+        elif char in "'\"":
+            quote = char
+            current = []
+        prev_char = char
+    return tuple(literals)
+
+
+@functools.lru_cache(maxsize=256)
+def compile_query(query: str) -> Plan:
+    """Parses a query into a reusable plan. Raises QueryParseException on syntax errors."""
+    namespace = query2.create_namespace()
+    functions = _query_functions.get(query, {})
+    plan = []
+    for statement in _split_statements(query):
+        var, val = query2.parse(statement, namespace)
+        plan.append((var, _late_bind(val, functions)))
+    return tuple(plan)
+
+
+def execute(
+    plan: Plan,
+    name: str,
+    starttime: datetime,
+    endtime: datetime,
+    datastore,
+    params: Optional[Dict[str, Any]] = None,
+) -> Any:
+    namespace = query2.create_namespace()
+    if params:
+        reserved = _reserved_names.intersection(params)
+        if reserved:
+            raise QueryInterpretException(
+                f"Query parameters can't override {', '.join(sorted(reserved))}"
+            )
+        namespace.update(params)
+    namespace["NAME"] = name
+    namespace["STARTTIME"] = starttime.isoformat()
+    namespace["ENDTIME"] = endtime.isoformat()
+    for var, val in plan:
+        query2.interpret(var, val, namespace, datastore)
+    return query2.get_return(namespace)
+
+
+def run_query(
+    name: str,
+    query: str,
+    starttime: datetime,
+    endtime: datetime,
+    datastore,
+    params: Optional[Dict[str, Any]] = None,
+) -> Any:
+    """Drop-in replacement for aw_query.query2.query using a cached plan"""
+    return execute(compile_query(query), name, starttime, endtime, datastore, params)
@@ -0,0 +1,104 @@
+import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Iterator, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# (email, wfh)
+ReportUser = Tuple[str, bool]
+
+
+class ReportEngine:
+    """
+    Computes the reports of many users on a thread pool.
+
+    ``run`` yields ``(index, report)`` pairs as soon as each user is done, so
+    callers can stream partial results, and the index can be used to restore
+    the order of ``users``.
+
+    A user whose report takes longer than ``user_timeout`` seconds is given up
+    on and yielded as the result of ``on_timeout``. Its thread can't be
+    interrupted and keeps running in the background, so if every worker is
+    stuck and no report has started for ``user_timeout`` seconds, the users
+    still waiting are given up on as well rather than stalling the report.
+    """
+
+    def __init__(
+        self,
+        report_user: Callable[[str, bool], dict],
+        on_timeout: Callable[[str, bool], dict],
+        workers: int = 8,
+        user_timeout: float = 60,
+    ) -> None:
+        self.report_user = report_user
+        self.on_timeout = on_timeout
+        self.workers = max(1, workers)
+        self.user_timeout = user_timeout
+
+    def run(self, users: List[ReportUser]) -> Iterator[Tuple[int, dict]]:
+        if not users:
+            return
+
+        started = {}  # type: Dict[int, float]
+        lock = threading.Lock()
+        last_progress = [time.monotonic()]
+
+        def job(i: int, email: str, wfh: bool) -> dict:
+            now = time.monotonic()
+            with lock:
+                started[i] = now
+                last_progress[0] = now
+            return self.report_user(email, wfh)
+
+        # Not used as a context manager, that would wait for timed out reports
+        pool = ThreadPoolExecutor(
+            min(self.workers, len(users)), thread_name_prefix="report"
+        )
+        pending = {
+            pool.submit(job, i, email, wfh): i for i, (email, wfh) in enumerate(users)
+        }
+        try:
+            while pending:
+                with lock:
+                    # Seconds until the earliest report could time out
+                    deadline = last_progress[0] + self.user_timeout
+                    running = [started[i] for i in pending.values() if i in started]
+                    if running:
+                        deadline = min(deadline, min(running) + self.user_timeout)
+                done, _ = wait(
+                    pending,
+                    timeout=max(0.01, deadline - time.monotonic()),
+                    return_when=FIRST_COMPLETED,
+                )
+                for future in done:
+                    i = pending.pop(future)
+                    with lock:
+                        started.pop(i, None)
+                        last_progress[0] = time.monotonic()
+                    yield i, future.result()
+
+                now = time.monotonic()
+                with lock:
+                    stalled = now - last_progress[0] >= self.user_timeout
+                    expired = [
+                        future
+                        for future, i in pending.items()
+                        if (i in started and now - started[i] >= self.user_timeout)
+                        or (i not in started and stalled)
+                    ]
+                    for future in expired:
+                        started.pop(pending[future], None)
+                for future in expired:
+                    i = pending.pop(future)
+                    future.cancel()
+                    email, wfh = users[i]
+                    logger.warning(
+                        f"Report of {email} timed out after {self.user_timeout}s"
+                    )
+                    yield i, self.on_timeout(email, wfh)
+        finally:
+            for future in pending:
+                future.cancel()
+            pool.shutdown(wait=False)
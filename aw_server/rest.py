@@ -1,39 +1,38 @@
 from functools import wraps
 from types import MethodType
 from typing import Dict
+from datetime import datetime
 import traceback
 import json
+import math
 import re
 
-from flask import redirect, request, Blueprint, jsonify, current_app, make_response, session
+from flask import redirect, request, Blueprint, jsonify, current_app, session, g, Response, stream_with_context
 from flask_restx import Api, Resource, fields
 import iso8601
 
 from aw_core import schema
-from aw_core.models import Event
 from aw_query.exceptions import QueryException
 
 from . import logger
 from .api import ServerAPI
+from .auth_policy import ALLOW, REJECT
+from .export import FORMATS as EXPORT_FORMATS
 from .exceptions import BadRequest, Unauthorized
+from .serialization import output_json
+from .validation import parse_event, parse_events
 
 from .config import config
 
 import time
 import base64
 
-import http.client
-import urllib.parse
 import os
 
 from dotenv import load_dotenv
 load_dotenv()
 X_SECRET_KEY = os.getenv('X_SECRET_KEY')
 
-oauth2_auth_url = config["oauth2"]["auth_url"]
-oauth2_client_id = config["oauth2"]["client_id"]
-oauth2_client_secret = config["oauth2"]["client_secret"]
-oauth2_redirect_uri = config["oauth2"]["redirect_uri"]
 application_domain = config["server"]["application_domain"]
 
 def current_milli_time():
@@ -89,32 +88,28 @@ def authentication_check(f):
 
     @wraps(f)
     def decorator(*args, **kwargs):
-        origin = request.environ.get('HTTP_ORIGIN', '')
-        device_id = request.headers.get("device_id", None)
-        secret = request.headers.get("secret", None)
-        xSecret = request.headers.get('X-Secret-Key', 'None')
-        if re.search("DESKTOP", request.path):
+        decision = current_app.auth_policy.decide(request.method, request.path, request.environ)
+        if decision == REJECT:
             logger.info(f"ip address: {request.remote_addr}")
-            logger.info(f"Device Id: {device_id}")
-            return {"message": "bad request"}, 400  
-        if origin == f"http://{application_domain}" or \
-            origin == f"https://{application_domain}" or \
-            origin == "http://localhost:27180" or \
-            (re.search("auth/callback", request.path) is not None) or \
-            (re.search("auth", request.path) is not None and request.method == "POST") or \
-            xSecret == X_SECRET_KEY or \
-            secret is not None:
+            logger.info(f"Device Id: {request.headers.get('device_id', None)}")
+            return {"message": "bad request"}, 400
+        if decision == ALLOW:
             return f(*args, **kwargs)
 
         if "Authorization" in request.headers:
             auth_header = request.headers["Authorization"]   
+            device_id = request.headers.get("device_id", None)
             user = current_app.api.get_user_by_token(device_id,auth_header.replace("Bearer ", ""))
             if user is None:
                 return {"message": "not authenticated"}, 401
             # logger.info(f"Current User: {user.get('email'), user.get('device_id')}")
             if '_id' in user:
                 del user['_id']
-            session['user'] = user
+            g.user = user
+            # Stateless mode keeps the user on the request only, so bearer
+            # requests don't rewrite the session cookie
+            if not current_app.config["STATELESS_AUTH"]:
+                session['user'] = user
             return f(*args, **kwargs)
         else:
             return {"message": "authorization header needed"}, 400 
@@ -122,29 +117,12 @@ def authentication_check(f):
     return decorator
 
 def make_mezon_oauth2_request(method:str, path:str, params: dict):
-    headers = {"Content-type": "application/x-www-form-urlencoded"}
-    prepared_params = urllib.parse.urlencode({
-        'client_id': oauth2_client_id,
-        'client_secret': oauth2_client_secret,
-        'redirect_uri': oauth2_redirect_uri,
-        **params
-    })
-    conn = http.client.HTTPSConnection(oauth2_auth_url)
-    conn.request(
-        method,
-        path,
-        body=prepared_params,
-        headers=headers
-    )
-    response = conn.getresponse()
-    if response.status != 200:
-        print(f"Error: {response.status}")
-        print(response.read())
-        return None
-    return json.loads(response.read())   
+    # current_app is the AWFlask of server.create_app
+    return current_app.oauth2.request(method, path, params)  # type: ignore
 
 blueprint = Blueprint("api", __name__, url_prefix="/api")
 api = Api(blueprint, doc="/", decorators=[authentication_check])
+api.representation("application/json")(output_json)
 # api = Api(blueprint, doc="/")
 
 class AnyJson(fields.Raw):
@@ -170,6 +148,7 @@ info = api.model(
         "version": fields.String(),
         "testing": fields.Boolean(),
         "device_id": fields.String(),
+        "heartbeat_warmup": fields.Raw(),
     },
 )
 
@@ -182,6 +161,18 @@ create_bucket = api.model(
     },
 )
 
+heartbeat_batch_item = api.model(
+    "HeartbeatBatchItem",
+    {
+        "bucket_id": fields.String(required=True),
+        "pulsetime": fields.Float(
+            required=True,
+            description="Largest timewindow allowed between heartbeats for them to merge",
+        ),
+        "event": fields.Raw(required=True, description="The heartbeat event"),
+    },
+)
+
 query = api.model(
     "Query",
     {
@@ -300,13 +291,7 @@ class EventsResource(Resource):
             )
         )
 
-        if isinstance(data, dict):
-            events = [Event(**data)]
-        elif isinstance(data, list):
-            events = [Event(**e) for e in data]
-        else:
-            raise BadRequest("Invalid POST data", "")
-
+        events = parse_events(data)
         event = current_app.api.create_events(bucket_id, events)
         return event.to_json_dict() if event else None, 200
 
@@ -353,18 +338,24 @@ class EventResource(Resource):
 
 @api.route("/0/buckets/<string:bucket_id>/heartbeat")
 class HeartbeatResource(Resource):
-    @api.expect(event, validate=True)
+    # Validated by parse_event, which is a lot cheaper than validate=True
+    @api.expect(event)
     @api.param(
         "pulsetime", "Largest timewindow allowed between heartbeats for them to merge"
     )
     @copy_doc(ServerAPI.heartbeat)
     def post(self, bucket_id):
-        heartbeat = Event(**request.get_json())
+        heartbeat = parse_event(request.get_json())
         logger.debug(
             f"Received heartbeat in bucket '{bucket_id}'"
         )
         if "pulsetime" in request.args:
-            pulsetime = float(request.args["pulsetime"])
+            try:
+                pulsetime = float(request.args["pulsetime"])
+            except ValueError:
+                pulsetime = math.nan
+            if not math.isfinite(pulsetime):
+                raise BadRequest("InvalidParameter", "Invalid pulsetime, expected a number")
         else:
             raise BadRequest("MissingParameter", "Missing required parameter pulsetime")
 
@@ -373,6 +364,52 @@ class HeartbeatResource(Resource):
         return event.to_json_dict(), 200
 
 
+@api.route("/0/heartbeats")
+class HeartbeatsResource(Resource):
+    @api.expect([heartbeat_batch_item])
+    @copy_doc(ServerAPI.heartbeats)
+    def post(self):
+        data = request.get_json()
+        if not isinstance(data, list):
+            raise BadRequest("InvalidBatch", "Expected a list of heartbeats")
+
+        heartbeats = []
+        errors = {}
+        for i, item in enumerate(data):
+            event = item.get("event") if isinstance(item, dict) else None
+            duration = event.get("duration") if isinstance(event, dict) else None
+            # Infinity and NaN (1e400 and NaN in the JSON) can't be merged, the
+            # whole batch is rejected before anything is written. Checked before
+            # parse_event, which would only fail this heartbeat.
+            if isinstance(duration, float) and not math.isfinite(duration):
+                raise BadRequest("InvalidHeartbeat", f"Heartbeat {i} has a non-finite duration")
+            try:
+                heartbeat = (
+                    str(item["bucket_id"]),
+                    parse_event(item["event"]),
+                    float(item["pulsetime"]),
+                )
+            except (KeyError, TypeError, ValueError, OverflowError, BadRequest) as e:
+                errors[i] = {
+                    "bucket_id": item.get("bucket_id") if isinstance(item, dict) else None,
+                    "status": "error",
+                    "type": "InvalidHeartbeat",
+                    "message": e.description if isinstance(e, BadRequest) else str(e),
+                }
+                continue
+            if not math.isfinite(heartbeat[2]):
+                raise BadRequest("InvalidHeartbeat", f"Heartbeat {i} has a non-finite pulsetime")
+            heartbeats.append(heartbeat)
+        logger.debug(f"Received batch of {len(data)} heartbeats")
+
+        merged = iter(current_app.api.heartbeats(heartbeats))
+        results = [errors[i] if i in errors else next(merged) for i in range(len(data))]
+        for result in results:
+            if "event" in result and result["event"].get("id") is not None:
+                result["event"]["id"] = str(result["event"]["id"])
+        return results, 200
+
+
 # QUERY
 
 
@@ -380,15 +417,17 @@ class HeartbeatResource(Resource):
 class QueryResource(Resource):
     # TODO Docs
     @api.expect(query, validate=True)
-    @api.param("name", "Name of the query (required if using cache)")
+    @api.param("name", "Name of the query")
+    @api.param("cache", "Set to 0 to bypass the result cache for periods that have ended")
     def post(self):
         name = ""
         if "name" in request.args:
             name = request.args["name"]
+        cache = request.args.get("cache", "1") != "0"
         query = request.get_json()
         try:
             result = current_app.api.query2(
-                name, query["query"], query["timeperiods"], False
+                name, query["query"], query["timeperiods"], cache
             )
             return jsonify(result)
         except QueryException as qe:
@@ -396,22 +435,51 @@ class QueryResource(Resource):
             return {"type": type(qe).__name__, "message": str(qe)}, 400
 
 
+@api.route("/0/query/cache")
+class QueryCacheResource(Resource):
+    @copy_doc(ServerAPI.get_query_cache_stats)
+    def get(self):
+        return current_app.api.get_query_cache_stats(), 200
+
+
 # EXPORT AND IMPORT
 
 
+def _export_response(bucket_ids, filename):
+    """
+    Streams the export of buckets in the format of the format parameter (json or ndjson),
+    incremental with the since or cursor parameter (see export.Incremental)
+    """
+    export_format = request.args.get("format", "json")
+    if export_format not in EXPORT_FORMATS:
+        raise BadRequest(
+            "InvalidParameter", f"Unknown export format {export_format}, expected json or ndjson"
+        )
+    since = None
+    if request.args.get("since"):
+        try:
+            since = iso8601.parse_date(request.args["since"])
+        except iso8601.ParseError:
+            raise BadRequest("InvalidParameter", "Invalid since, expected an ISO 8601 timestamp")
+    try:
+        chunks = current_app.api.iter_export(
+            bucket_ids, export_format, since=since, cursor=request.args.get("cursor") or None
+        )
+    except ValueError as e:
+        raise BadRequest("InvalidCursor", str(e))
+    response = Response(stream_with_context(chunks), mimetype=EXPORT_FORMATS[export_format])
+    response.headers["Content-Disposition"] = "attachment; filename={}.{}".format(
+        filename, export_format
+    )
+    return response
+
+
 @api.route("/0/export")
 class ExportAllResource(Resource):
     @api.doc(model=buckets_export)
     @copy_doc(ServerAPI.export_all)
     def get(self):
-        buckets_export = current_app.api.export_all()
-        payload = {"buckets": buckets_export}
-        response = make_response(json.dumps(payload))
-        filename = "aw-buckets-export.json"
-        response.headers["Content-Disposition"] = "attachment; filename={}".format(
-            filename
-        )
-        return response
+        return _export_response(None, "aw-buckets-export")
 
 
 # TODO: Perhaps we don't need this, could be done with a query argument to /0/export instead
@@ -420,33 +488,54 @@ class BucketExportResource(Resource):
     @api.doc(model=buckets_export)
     @copy_doc(ServerAPI.export_bucket)
     def get(self, bucket_id):
-        bucket_export = current_app.api.export_bucket(bucket_id)
-        payload = {"buckets": {bucket_export["id"]: bucket_export}}
-        response = make_response(json.dumps(payload))
-        filename = "aw-bucket-export_{}.json".format(bucket_export["id"])
-        response.headers["Content-Disposition"] = "attachment; filename={}".format(
-            filename
-        )
-        return response
+        return _export_response([bucket_id], "aw-bucket-export_{}".format(bucket_id))
+
+
+def _import_format(filename=None):
+    """json or ndjson from the format parameter, the file name or the content type, None to detect it"""
+    import_format = request.args.get("format")
+    if import_format is not None:
+        if import_format not in EXPORT_FORMATS:
+            raise BadRequest(
+                "InvalidParameter", f"Unknown import format {import_format}, expected json or ndjson"
+            )
+        return import_format
+    if filename and re.search(r"\.ndjson(\.gz)?$", filename):
+        return "ndjson"
+    if filename is None and request.mimetype == EXPORT_FORMATS["ndjson"]:
+        return "ndjson"
+    return None
 
 
 @api.route("/0/import")
 class ImportAllResource(Resource):
     @api.expect(buckets_export)
-    @copy_doc(ServerAPI.import_all)
+    @copy_doc(ServerAPI.import_stream)
     def post(self):
+        import_id = request.args.get("import_id")
         # If import comes from a form in th web-ui
         if len(request.files) > 0:
             # web-ui form only allows one file, but technically it's possible to
             # upload multiple files at the same time
+            results = []
             for filename, f in request.files.items():
-                buckets = json.loads(f.stream.read())["buckets"]
-                current_app.api.import_all(buckets)
+                results.append(
+                    current_app.api.import_stream(
+                        f.stream, _import_format(f.filename), import_id
+                    )
+                )
+                import_id = None
+            return results[0] if len(results) == 1 else results, 200
         # Normal import from body
         else:
-            buckets = request.get_json()["buckets"]
-            current_app.api.import_all(buckets)
-        return None, 200
+            return current_app.api.import_stream(request.stream, _import_format(), import_id), 200
+
+
+@api.route("/0/import/<string:import_id>")
+class ImportStatusResource(Resource):
+    @copy_doc(ServerAPI.get_import_status)
+    def get(self, import_id):
+        return current_app.api.get_import_status(import_id), 200
 
 
 # LOGGING
@@ -477,7 +566,16 @@ class AuthResource(Resource):
 @api.route("/0/auth/me")
 class AuthResource(Resource):
     def get(self):
-        return session['user']
+        user = g.get("user") or session.get("user")
+        if user is None:
+            raise Unauthorized("NotAuthenticated", "Not authenticated")
+        return user
+
+@api.route("/0/auth/oauth2")
+class OAuth2StatsResource(Resource):
+    def get(self):
+        """Get the call, connection and latency stats of the OAuth2 client"""
+        return current_app.oauth2.stats(), 200
 
 @api.route("/0/auth/callback")
 class AuthCallbackResource(Resource):
@@ -494,7 +592,7 @@ class AuthCallbackResource(Resource):
             }
         )
         if data is None:
-            return
+            return {"message": "could not get a token from the OAuth2 server"}, 502
         token = data["access_token"]
         user = make_mezon_oauth2_request(
             method = "POST", 
@@ -503,17 +601,22 @@ class AuthCallbackResource(Resource):
                 'access_token': token,
             }
         )
+        if user is None:
+            return {"message": "could not get the user from the OAuth2 server"}, 502
         user_email = user["email"]
         logger.info(f"Auth success for: {user_email}")
         
-        current_app.api.save_user({
+        new_user = {
             "device_id": device_id,
             "name": user_email,
             "email": user_email,
             "access_token": data["access_token"], 
             "refresh_token": data["access_token"],
             "mezon_user_id": user["user_id"],
-        })
+        }
+        current_app.api.save_user(new_user)
+        # Browser login, the one place a session cookie is issued in stateless mode
+        session['user'] = new_user
         
         user_name = re.split("@", user_email, 1)[0]
         
@@ -521,12 +624,72 @@ class AuthCallbackResource(Resource):
 
 # REPORT
 
+# Longest range of days a single report request can cover
+MAX_REPORT_RANGE_DAYS = 366
+
+
+def _parse_report_day(name):
+    value = request.args.get(name)
+    if not value:
+        raise BadRequest("MissingParameter", f"Missing required parameter {name}")
+    try:
+        return datetime.strptime(value.replace("-", "/"), "%Y/%m/%d").date()
+    except ValueError:
+        raise BadRequest("InvalidParameter", f"Invalid {name}, expected YYYY/MM/dd: {value}")
+
+
+def _report_range(emails=None):
+    """
+    Handles the start, end and group (day, week or month) parameters of the report endpoints.
+    Returns None if the request is for a single day.
+    """
+    if "start" not in request.args:
+        return None
+    start = _parse_report_day("start")
+    end = _parse_report_day("end")
+    group = request.args.get("group", "day")
+    if group not in ("day", "week", "month"):
+        raise BadRequest("InvalidParameter", "group must be one of day, week or month")
+    if end < start:
+        raise BadRequest("InvalidParameter", "end is before start")
+    if (end - start).days >= MAX_REPORT_RANGE_DAYS:
+        raise BadRequest(
+            "InvalidParameter", f"Can't report on more than {MAX_REPORT_RANGE_DAYS} days at once"
+        )
+    return current_app.api.get_report_range(start, end, emails, group)
+
+
 @api.route("/0/report/<string:email>")
 class Report(Resource):
     def get(self, email):
+        reports = _report_range([email])
+        if reports is not None:
+            return reports
         day = request.args.get("day")
         report = current_app.api.get_user_report(email, day)
         return report
+
+
+def _stream_reports(reports):
+    """Streams (index, report) pairs as newline delimited JSON, in the order they are done"""
+    def generate():
+        for _, report in reports:
+            yield json.dumps(report, default=str) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+
+def _compact_report(raw_report):
+    raw_report.pop("spent_time", None)
+    raw_report.pop("call_time", None)
+    raw_report.pop("str_active_time", None)
+    raw_report.pop("str_spent_time", None)
+    raw_report.pop("str_call_time", None)
+    raw_report.pop("date", None)
+    raw_report.pop("wfh", None)
+    return raw_report
+
+
 @api.route("/0/report")
 class ReportEmployeesOnDate(Resource):
     def post(self):
@@ -536,22 +699,23 @@ class ReportEmployeesOnDate(Resource):
             emails = req["emails"]
         else:
             raise BadRequest("MissingParameter", "Missing required parameter emails") 
+        reports = _report_range(emails)
+        if reports is not None:
+            return reports, 200
         logger.info(f"Reporting emails on date {day}")
-        res = []
-        for email in emails:
-            raw_report = current_app.api.get_user_report(email,day)
-            raw_report.pop("spent_time", None)
-            raw_report.pop("call_time", None)
-            raw_report.pop("str_active_time", None)
-            raw_report.pop("str_spent_time", None)
-            raw_report.pop("str_call_time", None)
-            raw_report.pop("date", None)
-            raw_report.pop("wfh", None)
-            res.append(raw_report)
+        if request.args.get("stream") in ("1", "true"):
+            reports = current_app.api.iter_users_report(emails, day)
+            return _stream_reports((i, _compact_report(r)) for i, r in reports)
+        res = [_compact_report(r) for r in current_app.api.get_users_report(emails, day)]
         return res, 200
 @api.route("/0/report")
 class ReportAll(Resource):
     def get(self):
+        reports = _report_range()
+        if reports is not None:
+            return reports
         day = request.args.get("day")
+        if request.args.get("stream") in ("1", "true"):
+            return _stream_reports(current_app.api.iter_report_all(day))
         response = current_app.api.report_all(day)
         return response
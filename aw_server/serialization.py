@@ -0,0 +1,135 @@
+"""
+JSON serialisation of responses and exports.
+
+Event lists, query results and exports are mostly timestamps, and the stdlib
+encoder hands every datetime to a Python ``default`` hook. When orjson is
+installed it's used instead: it formats datetimes natively (the same way as
+``datetime.isoformat``) and only calls ``default`` for timedeltas and
+ObjectIds. Without it, or with ``json_backend = "json"`` in the config, the
+stdlib encoder is used.
+
+Both backends produce the same JSON up to whitespace. Whatever orjson can't
+encode (integers over 64 bits, for one) is encoded with the stdlib encoder.
+orjson has no ``ensure_ascii``: when it's asked for, the non-ASCII characters
+of orjson's output (which only occur in strings) are escaped afterwards.
+
+``dumps`` is used by the export generators, ``JSONEncoder`` is set as the
+Flask app's encoder for ``jsonify`` and ``output_json`` is the flask-restx
+representation of resources returning plain data.
+"""
+import json
+import re
+from datetime import datetime, timedelta
+from typing import Any, Optional
+
+from bson import ObjectId
+from flask import Response, current_app, make_response
+from flask.json import JSONEncoder as FlaskJSONEncoder
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None  # type: ignore
+
+HAS_ORJSON = orjson is not None
+
+BACKENDS = (["orjson"] if HAS_ORJSON else []) + ["json"]
+
+_backend = BACKENDS[0]
+
+
+def default(obj: Any) -> Any:
+    """Encodes the types that aren't JSON types, for both backends"""
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    if isinstance(obj, timedelta):
+        return obj.total_seconds()
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def set_backend(name: str) -> None:
+    """Selects the backend by name, "auto" for the fastest one installed"""
+    global _backend
+    if name == "auto":
+        name = BACKENDS[0]
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown or unavailable JSON backend {name}, expected one of {BACKENDS}")
+    _backend = name
+
+
+def get_backend() -> str:
+    return _backend
+
+
+_non_ascii = re.compile(r"[^\x00-\x7f]")
+
+
+def _escape_non_ascii(match: "re.Match") -> str:
+    # Escaped like the stdlib encoder does, as UTF-16 surrogate pairs beyond the BMP
+    c = ord(match.group())
+    if c > 0xFFFF:
+        c -= 0x10000
+        return "\\u{:04x}\\u{:04x}".format(0xD800 | (c >> 10), 0xDC00 | (c & 0x3FF))
+    return "\\u{:04x}".format(c)
+
+
+def _stdlib_dumps(obj: Any, indent: bool, sort_keys: bool, ensure_ascii: bool) -> str:
+    if indent:
+        return json.dumps(
+            obj, default=default, indent=2, sort_keys=sort_keys, ensure_ascii=ensure_ascii
+        )
+    return json.dumps(
+        obj,
+        default=default,
+        separators=(",", ":"),
+        sort_keys=sort_keys,
+        ensure_ascii=ensure_ascii,
+    )
+
+
+def dumps(
+    obj: Any, indent: bool = False, sort_keys: bool = False, ensure_ascii: bool = False
+) -> str:
+    if _backend == "orjson":
+        option = orjson.OPT_NON_STR_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        try:
+            data = orjson.dumps(obj, default=default, option=option).decode()
+        except orjson.JSONEncodeError:
+            pass
+        else:
+            return _non_ascii.sub(_escape_non_ascii, data) if ensure_ascii else data
+    return _stdlib_dumps(obj, indent, sort_keys, ensure_ascii)
+
+
+class JSONEncoder(FlaskJSONEncoder):
+    """
+    Flask's json_encoder, encoding with the selected backend. Follows the
+    JSON_SORT_KEYS and JSON_AS_ASCII settings, and pretty-prints with an
+    indent of 2 (what jsonify uses), other indents go to the stdlib encoder.
+    """
+
+    def default(self, obj: Any) -> Any:
+        return default(obj)
+
+    def encode(self, obj: Any) -> str:
+        if self.indent not in (None, 2):
+            return super().encode(obj)
+        return dumps(
+            obj,
+            indent=self.indent is not None,
+            sort_keys=self.sort_keys,
+            ensure_ascii=self.ensure_ascii,
+        )
+
+
+def output_json(data: Any, code: int, headers: Optional[dict] = None) -> Response:
+    """The flask-restx representation of application/json, encoding with the selected backend"""
+    resp = make_response(dumps(data, indent=current_app.debug) + "\n", code)
+    resp.headers.extend(headers or {})
+    return resp
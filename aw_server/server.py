@@ -1,7 +1,6 @@
 import os
 import logging
 from typing import List, Dict
-import json
 
 from flask import Flask, Blueprint, current_app, send_from_directory
 from flask_cors import CORS
@@ -12,11 +11,13 @@ from .custom_static import get_custom_static_blueprint
 
 from .log import FlaskLogHandler
 from .api import ServerAPI
+from .auth_policy import AuthPolicy, trusted_origins
+from .compression import Compression
+from .oauth2 import OAuth2Client
+from .config import config
+from .serialization import JSONEncoder, set_backend as set_json_backend
 from . import rest
 
-from datetime import datetime, timedelta
-from bson import ObjectId
-
 logger = logging.getLogger(__name__)
 
 app_folder = os.path.dirname(os.path.abspath(__file__))
@@ -30,25 +31,8 @@ class AWFlask(Flask):
 
         # Is set on later initialization
         self.api = None  # type: ServerAPI
-
-# TODO: Clean up JSONEncoder code?
-# Move to server.py
-class CustomJSONEncoder(json.JSONEncoder):
-    def __init__(self, *args, **kwargs):
-        super().__init__()
-
-    def default(self, obj, *args, **kwargs):
-        try:
-            if isinstance(obj, datetime):
-                return obj.isoformat()
-            if isinstance(obj, timedelta):
-                return obj.total_seconds()
-            if isinstance(obj, ObjectId):
-                return str(obj)
-        except TypeError:
-            pass
-        return json.JSONEncoder.default(self, obj)
-
+        self.auth_policy = None  # type: AuthPolicy
+        self.oauth2 = None  # type: OAuth2Client
 
 def create_app(
     host: str, testing=True, storage_method=None, cors_origins=[], custom_static=dict()
@@ -63,18 +47,72 @@ def create_app(
     with app.app_context():
         _config_cors(cors_origins, testing)
 
-    app.json_encoder = CustomJSONEncoder
+    app.json_encoder = JSONEncoder
 
     app.register_blueprint(root)
     app.register_blueprint(rest.blueprint)
     app.register_blueprint(get_custom_static_blueprint(custom_static))
 
+    server_config = config["server-testing" if testing else "server"]
+
+    set_json_backend(server_config.get("json_backend", "auto"))
+
+    compression_min_size = int(server_config.get("compression_min_size", 1024))
+    if compression_min_size > 0:
+        Compression(
+            min_size=compression_min_size,
+            level=int(server_config.get("compression_level", 6)),
+        ).init_app(app)
+
     db = Datastore(storage_method, testing=testing)
-    app.api = ServerAPI(db=db, testing=testing)
+    app.api = ServerAPI(
+        db=db,
+        testing=testing,
+        heartbeat_flush_interval=float(
+            server_config.get("heartbeat_flush_interval", 0)
+        ),
+        last_event_cache_size=int(server_config.get("last_event_cache_size", 10000)),
+        last_event_cache_ttl=float(server_config.get("last_event_cache_ttl", 3600)),
+        heartbeat_warmup_hours=float(server_config.get("heartbeat_warmup_hours", 0)),
+        query_cache_entries=int(server_config.get("query_cache_entries", 1000)),
+        query_cache_max_mb=float(server_config.get("query_cache_max_mb", 64)),
+        query_cache_ttl=float(server_config.get("query_cache_ttl", 300)),
+        query_executor=str(server_config.get("query_executor", "thread")),
+        query_workers=int(server_config.get("query_workers", 8)),
+        query_max_parallel=int(server_config.get("query_max_parallel", 4)),
+        report_workers=int(server_config.get("report_workers", 8)),
+        report_user_timeout=float(server_config.get("report_user_timeout", 60)),
+        live_report_reconcile_interval=float(
+            server_config.get("live_report_reconcile_interval", 0)
+        ),
+        last_used_flush_interval=float(
+            server_config.get("last_used_flush_interval", 0)
+        ),
+        user_cache_size=int(server_config.get("user_cache_size", 10000)),
+        user_cache_ttl=float(server_config.get("user_cache_ttl", 300)),
+        user_invalidation_file=str(server_config.get("user_invalidation_file", "")),
+        import_batch_size=int(server_config.get("import_batch_size", 1000)),
+    )
+    app.auth_policy = AuthPolicy(
+        trusted_origins(config["server"]["application_domain"]), rest.X_SECRET_KEY
+    )
+    oauth2_config = config["oauth2"]
+    app.oauth2 = OAuth2Client(
+        oauth2_config["auth_url"],
+        oauth2_config["client_id"],
+        oauth2_config["client_secret"],
+        oauth2_config["redirect_uri"],
+        pool_size=int(oauth2_config.get("pool_size", 8)),
+        max_concurrency=int(oauth2_config.get("max_concurrency", 16)),
+        connect_timeout=float(oauth2_config.get("connect_timeout", 5)),
+        read_timeout=float(oauth2_config.get("read_timeout", 10)),
+    )
     # TODO get from config
     app.secret_key = "komutracker-secretkey"
     # needed for host-header check
     app.config["HOST"] = host
+    # Keep the user of bearer requests on the request only, not in the session cookie
+    app.config["STATELESS_AUTH"] = bool(server_config.get("stateless_auth", True))
     
     app.logger.setLevel(logging.ERROR)
     
@@ -1,20 +1,59 @@
-from datetime import date, datetime, timedelta, time
+from datetime import date, datetime, timedelta, time, timezone
+from typing import Dict, Iterator, List, Optional, Tuple
 from aw_core.log import setup_logging
-from aw_datastore import get_storage_methods
-from aw_datastore.datastore import Datastore
-from aw_query import query2
 import requests
 import logging
 import pytz
 import iso8601
+
+from . import bulk, intervals
+from .config import config
+from .query_plan import run_query
+from .report_engine import ReportEngine
+
 logger = logging.getLogger('REPORT')
 
+# Computes spent and call time of a user in one pass, reading the afk bucket once.
+# Spent time is the flooded not-afk time (window events are ignored), call time is
+# the time the KomuTracker call window was active while the user was afk.
+# The buckets of the user are bound as parameters so the template is only
+# parsed once (see query_plan).
+REPORT_QUERY = """
+afk_events = query_bucket(afk_bucket);
+not_afk = filter_keyvals(afk_events, "status", ["not-afk"]);
+not_afk = merge_events(not_afk);
+not_afk = flood(not_afk);
+afk = filter_keyvals(afk_events, "status", ["afk"]);
+afk = merge_events(afk);
+afk = flood(afk);
+calls = flood(query_bucket(find_bucket(window_bucket)));
+calls = filter_keyvals(calls, "title", ["KomuTracker - Google Chrome"]);
+calls = filter_period_intersect(calls, afk);
+RETURN = {"spent_time": sum_durations(not_afk), "call_time": sum_durations(calls)};
+"""
+
+
+# Same as REPORT_QUERY, evaluated with the NumPy interval engine (see intervals)
+VECTORISED_REPORT_QUERY = intervals.VECTORISED_REPORT_QUERY
+
+
+def report_query() -> str:
+    return VECTORISED_REPORT_QUERY if intervals.HAS_NUMPY else REPORT_QUERY
+
+
+def user_buckets(email: str) -> dict:
+    """Query parameters with the watcher buckets of a user"""
+    return {
+        "afk_bucket": f"aw-watcher-afk_{email}",
+        "window_bucket": f"aw-watcher-window_{email}",
+    }
+
 
 def _dt_is_tzaware(dt: datetime) -> bool:
     return dt.tzinfo is not None and dt.tzinfo.utcoffset(dt) is not None
 
 
-def str_to_date(day: str = "") -> date:
+def str_to_date(day: Optional[str] = "") -> date:
     '''Convert string `day` (format: dd/MM/YYYY or YYYY/MM/dd) to type date
     Return today if day is not in the right format 
     '''
@@ -43,7 +82,7 @@ def format_timedelta(time: timedelta) -> str:
     return f"{int(hours)}h{int(minutes)}m{int(seconds)}s"
 
 
-def cal_timeperiods(day: str = ""):
+def cal_timeperiods(day: Optional[str] = ""):
     date = str_to_date(day)
     daystart = datetime.combine(date, time())
     dayend = daystart + timedelta(days=1)
@@ -65,13 +104,89 @@ def cal_timeperiods(day: str = ""):
     return _timeperiods
 
 
+def empty_report(email: str, day: Optional[str] = None, wfh=True) -> dict:
+    return {
+        "email": email,
+        "spent_time": 0,
+        "call_time": 0,
+        "active_time": 0,
+        "str_active_time": '0h0m0s',
+        "str_spent_time": '0h0m0s',
+        "str_call_time": '0h0m0s',
+        "date": day,
+        "wfh": wfh
+    }
+
+
+def _as_date(value) -> date:
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return date.fromisoformat(str(value)[:10].replace("/", "-"))
+
+
+def _week(day: date) -> Tuple[date, date]:
+    monday = day - timedelta(days=day.weekday())
+    return monday, monday + timedelta(days=6)
+
+
+def _month(day: date) -> Tuple[date, date]:
+    first = day.replace(day=1)
+    next_month = (first + timedelta(days=32)).replace(day=1)
+    return first, next_month - timedelta(days=1)
+
+
+# Ways of grouping days in report_range, each returns the first and last day of the group of a day
+GROUPS = {
+    "day": lambda day: (day, day),
+    "week": _week,
+    "month": _month,
+}
+
+
+def make_report(email: str, day: Optional[str], wfh, spent_time: timedelta, call_time: timedelta) -> dict:
+    return {
+        "email": email,
+        "spent_time": spent_time.total_seconds(),
+        "call_time": call_time.total_seconds(),
+        "active_time": sum([spent_time, call_time], timedelta()).total_seconds(),
+        "str_active_time": format_timedelta(sum([spent_time, call_time], timedelta())),
+        "str_spent_time": format_timedelta(spent_time),
+        "str_call_time": format_timedelta(call_time),
+        "date": day,
+        "wfh": wfh
+    }
+
+
+def stored_report(_report: dict, day: Optional[str]) -> dict:
+    """Formats a report loaded from the database like a computed one"""
+    # TODO: FIX ME Converting float to timedelta because storing in database as timedelta
+    _report["str_active_time"] = format_timedelta(timedelta(seconds=_report['active_time']))
+    _report["str_spent_time"] = format_timedelta(timedelta(seconds=_report['spent_time']))
+    _report["str_call_time"] = format_timedelta(timedelta(seconds=_report['call_time']))
+    _report["date"] = day
+    _report.pop('id', None)
+    return _report
+
+
 class TrackerReport:
-    def __init__(self, db, query2, app=None) -> None:
+    # Users whose buckets are fetched together by report_emails
+    bulk_size = 100
+    # Past days whose users are kept by get_users
+    past_users_days = 400
+
+    def __init__(self, db, query2, app=None, workers: int = 8, user_timeout: float = 60, live_report=None) -> None:
         self.db = db
         self.app = app
         self.query2 = query2
+        self.workers = workers
+        self.user_timeout = user_timeout
+        # Optional LiveReport following today's reports
+        self.live_report = live_report
+        self._past_users = {}  # type: Dict[date, List[str]]
 
-    def report_user(self, email: str, day: str = None, wfh=True):
+    def report_user(self, email: str, day: Optional[str] = None, wfh=True):
         # TODO: FIX ME
         # if day:
         #   day = list(map(int, day.split("/")))
@@ -89,22 +204,13 @@ class TrackerReport:
                 date = str_to_date(day)
                 _report = self.db.storage_strategy.get_report(email=email,day=date)
                 if _report:
-                    # TODO: FIX ME Converting float to timedelta because storing in database as timedelta
-                    _report["str_active_time"] = format_timedelta(timedelta(seconds=_report['active_time'])) 
-                    _report["str_spent_time"] = format_timedelta(timedelta(seconds=_report['spent_time']))
-                    _report["str_call_time"] = format_timedelta(timedelta(seconds=_report['call_time']))
-                    _report["date"] = day
-                    _report.pop('id')
-                    return _report
+                    return stored_report(_report, day)
             except Exception as e:
                 logger.info(f"Error when getting Report Model: {e}") 
             # No report found, process as usual
             timeperiods = cal_timeperiods(day)
             try:
-                spent_time = self.get_spent_time(email, timeperiods)
-                # TODO: Fix call time later
-                call_time = self.get_call_time(email, timeperiods)
-                # call_time = timedelta()
+                spent_time, call_time = self.get_times_today(email, day, timeperiods)
             except Exception as e:
                 logger.info(f"Error {e}")
                 # spent_time = self.get_spent_time(
@@ -114,88 +220,251 @@ class TrackerReport:
                 spent_time = timedelta()
                 call_time = timedelta()
 
-            rec = {
-                "email": email,
-                "spent_time": spent_time.total_seconds(),
-                "call_time": call_time.total_seconds(),
-                "active_time": sum([spent_time, call_time], timedelta()).total_seconds(),
-                "str_active_time": format_timedelta(sum([spent_time, call_time], timedelta())),
-                "str_spent_time": format_timedelta(spent_time),
-                "str_call_time": format_timedelta(call_time),
-                "date": day,
-                "wfh": wfh
-            }
+            rec = make_report(email, day, wfh, spent_time, call_time)
             # ! If getting report of on going day, the report is lock on the first time called getting report. Switching to using cronjob
             # logger.info(f"rec: {rec}")
             # self.db.storage_strategy.save_report(rec)
             return rec
         except Exception as e:
-            rec = {
-                "email": email,
-                "spent_time": 0,
-                "call_time": 0,
-                "active_time": 0,
-                "str_active_time": '0h0m0s',
-                "str_spent_time": '0h0m0s',
-                "str_call_time": '0h0m0s',
-                "date": day,
-                "wfh": wfh
-            }
             logger.error(f"Error: {e}")
+            return empty_report(email, day, wfh)
+
+    def report_users(self, users: List[Tuple[str, bool]], day: Optional[str] = None) -> Iterator[Tuple[int, dict]]:
+        """
+        Reports on users, given as (email, wfh), in parallel.
+        Yields (index in users, report) as each user is done.
+        A user that times out is reported as empty_report with an "error" key.
+        """
+        def on_timeout(email, wfh):
+            rec = empty_report(email, day, wfh)
+            rec["error"] = "timeout"
             return rec
-    def get_call_time(self, email, timeperiods) -> timedelta:
-        query = []
-        query.append(
-            f"events = flood(query_bucket(find_bucket(\"aw-watcher-window_{email}\")));")
-        query.append(
-            "events = filter_keyvals(events, \"title\", [\"KomuTracker - Google Chrome\"]);")
-        query.append(
-            f"afk = query_bucket(find_bucket(\"aw-watcher-afk_{email}\"));")
-        query.append("afk = filter_keyvals(afk, \"status\", [\"afk\"]);")
-        query.append(f"afk = merge_events(afk);")
-        query.append(f"afk = flood(afk);")
-        query.append("events = filter_period_intersect(events, afk);")
-        query.append("duration = sum_durations(events);")
-        query.append("RETURN = {\"duration\": duration, \"events\": events};")
-
-        result = []
-        if self.query2:
-            result = self.query2(
-                "report-call-time", query, timeperiods, False
-            )
+
+        engine = ReportEngine(
+            lambda email, wfh: self.report_user(email=email, day=day, wfh=wfh),
+            on_timeout,
+            workers=self.workers,
+            user_timeout=self.user_timeout,
+        )
+        return engine.run(users)
+
+    def get_stored_reports(self, emails: List[str], date: date) -> Dict[str, dict]:
+        """Stored reports of the users on date, as {email: report}"""
+        try:
+            return {r["email"]: r for r in bulk.get_reports(self.db, date, date, emails)}
+        except Exception as e:
+            logger.info(f"Error when getting Report Models: {e}")
+            return {}
+
+    def get_stored_reports_between(
+        self, users_by_day: Dict[date, List[str]]
+    ) -> Dict[Tuple[date, str], dict]:
+        """
+        Stored reports of the users of each day in users_by_day, as {(date, email): report},
+        read at once for the whole range.
+        """
+        if not users_by_day:
+            return {}
+        emails = list(dict.fromkeys(e for day_emails in users_by_day.values() for e in day_emails))
+        try:
+            reports = bulk.get_reports(self.db, min(users_by_day), max(users_by_day), emails)
+        except Exception as e:
+            logger.info(f"Error when getting Report Models: {e}")
+            return {}
+        wanted = {(day, e) for day, day_emails in users_by_day.items() for e in day_emails}
+        stored = {}
+        for r in reports:
+            key = (_as_date(r["date"]), r["email"])
+            if key in wanted:
+                stored[key] = r
+        return stored
+
+    def get_users(self, day: date) -> List[str]:
+        """Emails (without domain) of the users who used the tracker on day"""
+        emails = self._past_users.get(day)
+        if emails is not None:
+            return emails
+        users = self.db.storage_strategy.get_use_tracker(day)
+        emails = list(dict.fromkeys(user["email"].split("@")[0] for user in users))
+        # Who used the tracker on a day that's over doesn't change anymore
+        if day < str_to_date():
+            if len(self._past_users) >= self.past_users_days:
+                self._past_users.pop(next(iter(self._past_users)), None)
+            self._past_users[day] = emails
+        return emails
+
+    def get_users_between(self, start: date, end: date) -> Dict[date, List[str]]:
+        """
+        get_users of every day from start to end. The storage lists users day by
+        day, so only today and the days not seen before are listed.
+        """
+        users_by_day = {}
+        day = start
+        while day <= end:
+            users_by_day[day] = self.get_users(day)
+            day += timedelta(days=1)
+        return users_by_day
+
+    def report_range(
+        self, start: date, end: date, emails: Optional[List[str]] = None, group: str = "day"
+    ) -> List[dict]:
+        """
+        Reports of the given users (or everyone) from start to end, summed by "day", "week" or "month".
+
+        Built on the stored daily reports. Days that aren't stored are computed, and
+        saved unless they are today or later, since today's report isn't final.
+        """
+        if group not in GROUPS:
+            raise ValueError(f"Unknown report group: {group}")
+        today = str_to_date()
+        last = min(end, today)
+        if emails is None:
+            users_by_day = self.get_users_between(start, last)
         else:
-            result = self.app.api.query2(
-                "report-call-time", query, timeperiods, False
+            users_by_day = {
+                start + timedelta(days=i): emails for i in range((last - start).days + 1)
+            }
+        daily = self.get_stored_reports_between(users_by_day)
+
+        for day, day_emails in users_by_day.items():
+            missing = [email for email in day_emails if (day, email) not in daily]
+            day_str = day.strftime("%Y/%m/%d")
+            for i, rec in self.report_emails(missing, day_str, stored={}):
+                if day < today:
+                    try:
+                        self.db.storage_strategy.save_report(rec)
+                    except Exception as e:
+                        logger.info(f"Error when saving Report Model: {e}")
+                daily[(day, missing[i])] = rec
+
+        totals = {}  # type: Dict[Tuple[str, date], dict]
+        for (day, email), rec in daily.items():
+            period_start, period_end = GROUPS[group](day)
+            total = totals.setdefault(
+                (email, period_start),
+                {
+                    "email": email,
+                    "start": max(period_start, start),
+                    "end": min(period_end, end),
+                    "days": 0,
+                    "spent_time": 0.0,
+                    "call_time": 0.0,
+                },
             )
+            total["days"] += 1
+            total["spent_time"] += rec["spent_time"]
+            total["call_time"] += rec["call_time"]
+
+        response = []
+        for key in sorted(totals):
+            total = totals[key]
+            spent_time = timedelta(seconds=total["spent_time"])
+            call_time = timedelta(seconds=total["call_time"])
+            rec = make_report(total["email"], None, None, spent_time, call_time)
+            del rec["date"], rec["wfh"]
+            rec["start"] = total["start"].isoformat()
+            rec["end"] = total["end"].isoformat()
+            rec["days"] = total["days"]
+            response.append(rec)
+        return response
+
+    def report_emails(
+        self,
+        emails: List[str],
+        day: Optional[str] = None,
+        wfh=True,
+        stored: Optional[Dict[str, dict]] = None,
+    ) -> Iterator[Tuple[int, dict]]:
+        """
+        Same reports as report_user for many users, yielded as (index in emails, report).
+
+        Stored reports are looked up together (unless already given as stored), and the
+        buckets of the remaining users are read bulk_size users at a time, with
+        REPORT_QUERY evaluated on the prefetched events.
+        """
+        date = str_to_date(day)
+        if stored is None:
+            stored = self.get_stored_reports(emails, date)
+        live = self.live_report if date == str_to_date() else None
+        missing = []
+        for i, email in enumerate(emails):
+            times = live.get(email, date) if live is not None and email not in stored else None
+            if email in stored:
+                yield i, stored_report(stored[email], day)
+            elif times is not None:
+                yield i, make_report(email, day, wfh, *times)
+            else:
+                missing.append(i)
+        if not missing:
+            return
+
+        timeperiod = cal_timeperiods(day)[0]
+        period = timeperiod.split("/")
+        starttime = iso8601.parse_date(period[0])
+        endtime = iso8601.parse_date(period[1])
+        all_buckets = list(self.db.buckets())
+        existing = set(all_buckets)
+        for chunk in range(0, len(missing), self.bulk_size):
+            users = {}
+            for i in missing[chunk : chunk + self.bulk_size]:
+                buckets = user_buckets(emails[i])
+                # Resolve the window bucket the way find_bucket in REPORT_QUERY would
+                window_bucket = next(
+                    (b for b in all_buckets if buckets["window_bucket"] in b), None
+                )
+                users[i] = [buckets["afk_bucket"], window_bucket]
+            bucket_ids = {b for bs in users.values() for b in bs if b is not None}
+            since = datetime.now(timezone.utc)
+            events = bulk.get_events(self.db, bucket_ids, starttime, endtime)
+            for i, buckets_of_user in users.items():
+                email = emails[i]
+                datastore = bulk.PrefetchedDatastore(
+                    {b: events.get(b, []) for b in buckets_of_user if b in existing}
+                )
+                try:
+                    result = run_query(
+                        "report-time", report_query(), starttime, endtime,
+                        datastore, user_buckets(email),
+                    )
+                    spent_time, call_time = result["spent_time"], result["call_time"]
+                    if live is not None:
+                        live.reconcile(email, date, timeperiod, since, spent_time, call_time)
+                except Exception as e:
+                    logger.info(f"Error {e}")
+                    spent_time = timedelta()
+                    call_time = timedelta()
+                yield i, make_report(email, day, wfh, spent_time, call_time)
 
-        total_call_time = result[0]["duration"]
-        return total_call_time
-
-    def get_spent_time(self, email, timeperiods) -> timedelta:
-        # ! Changing to only consider not_afk, ignore window_events
-        query = []
-        query.append(
-            f"not_afk = query_bucket(\"aw-watcher-afk_{email}\");")
-        query.append(
-            "not_afk = filter_keyvals(not_afk, \"status\", [\"not-afk\"]);")
-        query.append("not_afk_process = merge_events(not_afk);")
-        query.append("not_afk_process = flood(not_afk_process);")
-        query.append("duration = sum_durations(not_afk_process);")
-        query.append("RETURN = {\"duration\": duration};")
-
-        result = []
+    def _query(self, name, query, timeperiods, params):
         if self.query2:
-            result = self.query2(
-                "report-call-time", query, timeperiods, False
-            )
-        else:
-            result = self.app.api.query2(
-                "report-call-time", query, timeperiods, False
-            )
-        total_duration = result[0]["duration"]
-        return total_duration
+            return self.query2(name, query, timeperiods, False, params=params)
+        return self.app.api.query2(name, query, timeperiods, False, params=params)
+
+    def get_times(self, email, timeperiods) -> Tuple[timedelta, timedelta]:
+        """Returns (spent_time, call_time) of the user in the first timeperiod"""
+        result = self._query(
+            "report-time", report_query(), timeperiods, user_buckets(email)
+        )
+        return result[0]["spent_time"], result[0]["call_time"]
+
+    def get_times_today(self, email, day, timeperiods) -> Tuple[timedelta, timedelta]:
+        """Like get_times, but today's times are looked up in live_report when possible"""
+        date = str_to_date(day)
+        if self.live_report is None or date != str_to_date():
+            return self.get_times(email, timeperiods)
+        times = self.live_report.get(email, date)
+        if times is None:
+            since = datetime.now(timezone.utc)
+            times = self.get_times(email, timeperiods)
+            self.live_report.reconcile(email, date, timeperiods[0], since, *times)
+        return times
+
+    def report(self, day: Optional[str] = None, save_to_db = False):
+        indexed = sorted(self.iter_report(day, save_to_db), key=lambda item: item[0])
+        return [rec for _, rec in indexed]
 
-    def report(self, day: str = None, save_to_db = False):
+    def iter_report(self, day: Optional[str] = None, save_to_db = False) -> Iterator[Tuple[int, dict]]:
+        """Like report, but yields (index, report) as each user is done"""
         date = str_to_date(day)
         # print timezone info of date
         logger.info(f"Running tracker_report on day {date}")
@@ -221,54 +490,49 @@ class TrackerReport:
         #         user['wfh'] = True
         #         report_users[email] = user
 
-        response = []
-        for email in report_users:
-            rec = self.report_user(
-                email=email, wfh=report_users[email]['wfh'], day=day)
-            if save_to_db:
+        users = [(email, report_users[email]['wfh']) for email in report_users]
+        for i, rec in self.report_users(users, day):
+            # Don't store an empty report for a user that timed out, the next run retries it
+            if save_to_db and "error" not in rec:
                 self.db.storage_strategy.save_report(rec)
             rec['spent_time'] = str(timedelta(seconds=rec["spent_time"]))
             rec["call_time"] = str(timedelta(seconds=rec["call_time"]))
             rec["active_time"] = str(timedelta(seconds=rec["active_time"]))
-            response.append(rec)
-        return response
+            yield i, rec
 
-def report_on_dates(day: datetime = datetime.today(), duration: int = 1):
-    print(f"Running report from {day - timedelta(days = duration)} to {day}")
-    setup_logging("Cronjob",
-        testing=False,
-        verbose=False,
-        log_stderr=False,
-        log_file=False,
-        log_file_json=False,)
-    storage_methods = get_storage_methods()
-    storage_method = storage_methods['peewee']
-    end_date = datetime.strftime(day, '%Y/%m/%d')
-    db = Datastore(storage_method, testing=False)
-    def self_query2(name, query, timeperiods, cache):
+def datastore_query2(db):
+    """A query2 function for TrackerReport evaluating queries directly on db, outside of the server"""
+    def self_query2(name, query, timeperiods, cache, params=None):
             result = []
+            query = str().join(query)
             for timeperiod in timeperiods:
                 period = timeperiod.split("/")[
                     :2
                 ]  # iso8601 timeperiods are separated by a slash
                 starttime = iso8601.parse_date(period[0])
                 endtime = iso8601.parse_date(period[1])
-                query = str().join(query)
-                result.append(query2.query(name, query, starttime, endtime, db))
+                result.append(run_query(name, query, starttime, endtime, db, params))
             return result
-    tracker_report = TrackerReport(db=db, query2=self_query2)
-    dates = [datetime.strftime(day - timedelta(days=idx + 1), '%Y/%m/%d') for idx in range(duration)]
-    for date in dates:
-        try:
-            print(f"Start running tracker_report on {date}")
-            reports = tracker_report.report(date, save_to_db=True)
-            logger.info(f"Running tracker_report on day {date}")
-            print(f"Finish running tracker_report on day {date}: generated {len(reports)} total reports ") 
-        except Exception as e:
-            print(f"Day: {date} generate error: \n{e}")
-            break
+    return self_query2
+
+def report_on_dates(day: datetime = datetime.today(), duration: int = 1):
+    # Imported here since backfill builds on this module
+    from .backfill import backfill, open_tracker_report
+
+    print(f"Running report from {day - timedelta(days = duration)} to {day}")
+    setup_logging("Cronjob",
+        testing=False,
+        verbose=False,
+        log_stderr=False,
+        log_file=False,)
+    tracker_report = open_tracker_report()
+    dates = [datetime.strftime(day - timedelta(days=idx + 1), '%Y/%m/%d') for idx in reversed(range(duration))]
+    backfill(
+        tracker_report,
+        dates,
+        workers=int(config["server"].get("report_workers", 8)),
+    )
     print(f"Finish reporting") 
-    # print(f"Report {reports}")  
 
 if __name__ == '__main__':
     # stop_date = datetime(2022,6,10)
@@ -0,0 +1,168 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+INVALIDATE = "invalidate"
+
+
+class FileInvalidation:
+    """
+    Invalidation signal shared by the server processes on a host, through an
+    append-only file of ``<action>\\t<device_id>`` lines.
+
+    Each process remembers how far it has read and, at most every
+    ``poll_interval`` seconds, reads the lines other processes appended since.
+    The file is truncated by whoever finds it over ``max_bytes``, after which
+    everyone starts reading from the top again.
+    """
+
+    def __init__(self, path: str, poll_interval: float = 1, max_bytes: int = 1 << 20) -> None:
+        self.path = path
+        self.poll_interval = poll_interval
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._next_poll = 0.0
+        try:
+            self._offset = os.path.getsize(path)
+        except OSError:
+            self._offset = 0
+
+    def publish(self, action: str, device_id: str) -> None:
+        line = f"{action}\t{device_id}\n".encode()
+        with self._lock:
+            try:
+                if os.path.getsize(self.path) > self.max_bytes:
+                    open(self.path, "wb").close()
+                    self._offset = 0
+            except OSError:
+                pass
+            with open(self.path, "ab") as f:
+                f.write(line)
+            # Our own signals don't need to be read back
+            if self._offset == os.path.getsize(self.path) - len(line):
+                self._offset += len(line)
+
+    def poll(self) -> List[Tuple[str, str]]:
+        """Returns the (action, device_id) signals published since the last poll"""
+        now = time.monotonic()
+        if now < self._next_poll:
+            return []
+        with self._lock:
+            self._next_poll = now + self.poll_interval
+            try:
+                size = os.path.getsize(self.path)
+            except OSError:
+                return []
+            if size == self._offset:
+                return []
+            if size < self._offset:
+                # Truncated, signals may have been lost so drop everything
+                self._offset = size
+                return [(INVALIDATE, "")]
+            with open(self.path, "rb") as f:
+                f.seek(self._offset)
+                data = f.read(size - self._offset)
+            # Only consume complete lines
+            data = data[: data.rfind(b"\n") + 1]
+            self._offset += len(data)
+        signals = []
+        for line in data.decode(errors="replace").splitlines():
+            action, _, device_id = line.partition("\t")
+            signals.append((action, device_id))
+        return signals
+
+
+class UserCache:
+    """
+    Users by device_id, loaded on demand.
+
+    Entries expire ``ttl`` seconds after being loaded so tokens saved by other
+    processes are picked up, and the least recently used are evicted beyond
+    ``max_size``. Unknown device ids are cached too, for ``negative_ttl``
+    seconds.
+
+    With an ``invalidation`` signal (see FileInvalidation), saves are published
+    to the other processes, which drop their copy.
+    """
+
+    def __init__(
+        self,
+        load: Callable[[str], Optional[dict]],
+        max_size: int = 10000,
+        ttl: float = 300,
+        negative_ttl: float = 30,
+        invalidation: Optional[FileInvalidation] = None,
+    ) -> None:
+        self.load = load
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.invalidation = invalidation
+        # device_id -> (user or None, expires at)
+        self._entries = OrderedDict()  # type: OrderedDict[str, Tuple[Optional[dict], float]]
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _poll(self) -> None:
+        if self.invalidation is None:
+            return
+        for _, device_id in self.invalidation.poll():
+            with self._lock:
+                if not device_id:
+                    self._entries.clear()
+                else:
+                    self._entries.pop(device_id, None)
+
+    def _set(self, device_id: str, user: Optional[dict], expires: float) -> None:
+        self._entries[device_id] = (user, expires)
+        self._entries.move_to_end(device_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def get(self, device_id: Optional[str]) -> Optional[dict]:
+        if device_id is None:
+            return None
+        self._poll()
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(device_id)
+            if entry is not None and entry[1] > now:
+                self._entries.move_to_end(device_id)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        try:
+            user = self.load(device_id)
+        except Exception as e:
+            logger.exception(f"Failed to load user of device {device_id}: {e}")
+            return None
+        with self._lock:
+            ttl = self.ttl if user is not None else self.negative_ttl
+            self._set(device_id, user, time.monotonic() + ttl)
+        return user
+
+    def put(self, device_id: str, user: dict) -> None:
+        with self._lock:
+            self._set(device_id, user, time.monotonic() + self.ttl)
+        if self.invalidation is not None:
+            self.invalidation.publish(INVALIDATE, device_id)
+
+    def invalidate(self, device_id: str) -> None:
+        """Drops the copy of a device's user, to be loaded again on next use"""
+        with self._lock:
+            self._entries.pop(device_id, None)
+        if self.invalidation is not None:
+            self.invalidation.publish(INVALIDATE, device_id)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
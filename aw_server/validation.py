@@ -0,0 +1,92 @@
+"""
+Fast validation of incoming events.
+
+flask-restx validates a payload against a JSONSchema by building a new
+jsonschema validator on every request, after which ``Event(**data)`` parses
+the timestamp once more. Heartbeats go through this path several times per
+second per watcher, so instead the event schema from aw_core is checked by
+hand here and the Event is built from the already parsed values.
+
+``event_validator`` is the same schema compiled once, used to produce
+detailed error messages when the fast checks fail.
+"""
+from datetime import datetime, timedelta, timezone
+from typing import Any, List
+
+import iso8601
+from jsonschema import Draft4Validator
+
+from aw_core import schema
+from aw_core.models import Event
+
+from .exceptions import BadRequest
+
+event_validator = Draft4Validator(schema.get_json_schema("event"))
+
+_event_keys = frozenset(["id", "timestamp", "duration", "data"])
+
+
+def _invalid(data: Any) -> BadRequest:
+    errors = [e.message for e in event_validator.iter_errors(data)]
+    return BadRequest("InvalidEvent", "; ".join(errors) or "Invalid event")
+
+
+def parse_timestamp(ts: str) -> datetime:
+    """Parses an iso8601 timestamp, naive timestamps are assumed to be UTC (like iso8601.parse_date)"""
+    try:
+        # fromisoformat is a lot faster than iso8601, but before Python 3.11
+        # it only handles the format produced by datetime.isoformat()
+        dt = datetime.fromisoformat(ts[:-1] + "+00:00" if ts[-1:] == "Z" else ts)
+    except ValueError:
+        dt = iso8601.parse_date(ts)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt
+
+
+def parse_event(data: Any) -> Event:
+    """
+    Validates a JSON-decoded event against the aw_core event schema and returns it as an Event.
+    Raises BadRequest if the event is invalid.
+    """
+    if not isinstance(data, dict) or not _event_keys.issuperset(data):
+        raise BadRequest(
+            "InvalidEvent",
+            "Expected an event object with only the keys id, timestamp, duration and data",
+        )
+
+    ts = data.get("timestamp")
+    if not isinstance(ts, str):
+        raise _invalid(data)
+    duration = data.get("duration", 0)
+    # bool is a subclass of int but not a JSONSchema number
+    if not isinstance(duration, (int, float)) or isinstance(duration, bool):
+        raise _invalid(data)
+    event_data = data.get("data")
+    if event_data is not None and not isinstance(event_data, dict):
+        raise _invalid(data)
+
+    try:
+        timestamp = parse_timestamp(ts)
+    except (ValueError, iso8601.ParseError):
+        raise BadRequest("InvalidEvent", f"Invalid timestamp: {ts}")
+    try:
+        # NaN and infinity fail here too, as do events that would end after datetime.max
+        delta = timedelta(seconds=duration)
+        timestamp + delta
+    except (ValueError, OverflowError):
+        raise BadRequest("InvalidEvent", f"Invalid duration: {duration}")
+
+    return Event(
+        id=data.get("id"),
+        timestamp=timestamp,
+        duration=delta,
+        data=event_data,
+    )
+
+
+def parse_events(data: Any) -> List[Event]:
+    """Like parse_event, but accepts both a single event and a list of events"""
+    if isinstance(data, list):
+        return [parse_event(e) for e in data]
+    return [parse_event(data)]
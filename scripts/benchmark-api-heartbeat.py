@@ -1,8 +1,9 @@
 from time import sleep
 import cProfile
 import pstats
+import sys
 from datetime import timezone as tz
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from aw_core.models import Event
 
@@ -33,7 +34,66 @@ def benchmark():
         )
 
 
+def count_writes(storage):
+    """Wraps the write methods of a storage to count how often they are called"""
+    counts = {"insert": 0, "replace_last": 0}
+
+    def counted(name, f):
+        def g(*args, **kwargs):
+            counts[name] += 1
+            return f(*args, **kwargs)
+
+        return g
+
+    storage.insert_one = counted("insert", storage.insert_one)
+    storage.insert_many = counted("insert", storage.insert_many)
+    storage.replace_last = counted("replace_last", storage.replace_last)
+    return counts
+
+
+def benchmark_write_behind(n_buckets=20, n_pulses=600, flush_interval=10.0):
+    """
+    Simulates watchers pulsing once per second (with a data change every 60
+    pulses) and compares the number of database writes issued with and
+    without the write-behind heartbeat buffer.
+    """
+    start = datetime.now(tz=tz.utc) - timedelta(days=1)
+    for interval in [0, flush_interval]:
+        ds = aw_datastore.Datastore(aw_datastore.storages.MemoryStorage, testing=True)
+        counts = count_writes(ds.storage_strategy)
+        api = aw_server.api.ServerAPI(ds, testing=True, heartbeat_flush_interval=interval)
+        bucket_ids = [f"test-benchmark-{i}" for i in range(n_buckets)]
+        for bucket_id in bucket_ids:
+            api.create_bucket(bucket_id, "test", "test", "test")
+
+        for i in range(n_pulses):
+            for bucket_id in bucket_ids:
+                api.heartbeat(
+                    bucket_id,
+                    Event(
+                        timestamp=start + timedelta(seconds=i),
+                        data={"test": str(i // 60)},
+                    ),
+                    pulsetime=2,
+                )
+            # The background flusher runs on wall-clock time, emulate it here
+            if interval and i % int(interval) == 0:
+                api.flush_heartbeats()
+        api.flush_heartbeats()
+
+        total = counts["insert"] + counts["replace_last"]
+        mode = f"write-behind ({interval}s)" if interval else "write-through"
+        print(
+            f"{mode:>22}: {n_buckets * n_pulses} heartbeats, {total} writes "
+            f"({counts['insert']} inserts, {counts['replace_last']} replace_last)"
+        )
+
+
 if __name__ == "__main__":
+    if "--write-behind" in sys.argv:
+        benchmark_write_behind()
+        sys.exit(0)
+
     f_bench = "benchmark.dat"
     cProfile.run("benchmark()", f_bench)
     p = pstats.Stats(f_bench)
@@ -0,0 +1,61 @@
+"""
+Compares the cost of deciding how a heartbeat request is authorised with the
+regex and string comparison chain authentication_check used to run against
+the precompiled aw_server.auth_policy.AuthPolicy.
+"""
+import re
+import timeit
+
+from werkzeug.datastructures import EnvironHeaders
+
+from aw_server.auth_policy import BEARER, AuthPolicy, trusted_origins
+
+application_domain = "tracker.komu.vn"
+secret_key = "s3cret"
+policy = AuthPolicy(trusted_origins(application_domain), secret_key)
+
+method = "POST"
+path = "/api/0/buckets/aw-watcher-window_john.doe/heartbeat"
+environ = {
+    "REQUEST_METHOD": method,
+    "PATH_INFO": path,
+    "HTTP_AUTHORIZATION": "Bearer abcdef",
+    "HTTP_DEVICE_ID": "4f0c6d3e-0d52-4d5b-9f39-6b0f2d3c1a77",
+    "HTTP_HOST": application_domain,
+    "HTTP_USER_AGENT": "aw-client",
+    "CONTENT_TYPE": "application/json",
+    "CONTENT_LENGTH": "120",
+}
+headers = EnvironHeaders(environ)
+
+
+def regex_chain():
+    origin = environ.get("HTTP_ORIGIN", "")
+    device_id = headers.get("device_id", None)
+    secret = headers.get("secret", None)
+    x_secret = headers.get("X-Secret-Key", "None")
+    if re.search("DESKTOP", path):
+        return "reject"
+    if (
+        origin == f"http://{application_domain}"
+        or origin == f"https://{application_domain}"
+        or origin == "http://localhost:27180"
+        or (re.search("auth/callback", path) is not None)
+        or (re.search("auth", path) is not None and method == "POST")
+        or x_secret == secret_key
+        or secret is not None
+    ):
+        return "allow"
+    return "bearer"
+
+
+def compiled_policy():
+    return policy.decide(method, path, environ)
+
+
+if __name__ == "__main__":
+    assert regex_chain() == compiled_policy() == BEARER
+    n = 100000
+    for name, f in [("regex chain", regex_chain), ("AuthPolicy.decide", compiled_policy)]:
+        t = min(timeit.repeat(f, number=n, repeat=5))
+        print(f"{name:>18}: {t / n * 1e6:.2f} us/request")
@@ -0,0 +1,38 @@
+"""
+Compares the cost of validating and parsing a heartbeat payload the way
+flask-restx does it with validate=True (a new JSONSchema validator per request,
+followed by Event(**data)) against aw_server.validation.parse_event.
+"""
+import timeit
+from datetime import datetime, timezone
+
+from jsonschema import Draft4Validator
+
+from aw_core import schema
+from aw_core.models import Event
+
+from aw_server.validation import parse_event
+
+payload = {
+    "timestamp": datetime.now(tz=timezone.utc).isoformat(),
+    "duration": 0,
+    "data": {"app": "chrome.exe", "title": "KomuTracker - Google Chrome"},
+}
+event_schema = schema.get_json_schema("event")
+
+
+def restx_path():
+    Draft4Validator(event_schema).validate(payload)
+    return Event(**payload)
+
+
+def fast_path():
+    return parse_event(payload)
+
+
+if __name__ == "__main__":
+    assert restx_path() == fast_path()
+    n = 20000
+    for name, f in [("flask-restx validate + Event(**data)", restx_path), ("parse_event", fast_path)]:
+        t = min(timeit.repeat(f, number=n, repeat=5))
+        print(f"{name:>38}: {t / n * 1e6:.2f} us/event")
@@ -0,0 +1,77 @@
+"""
+Compares exporting a bucket the way /0/export used to (export_all, then
+json.dumps of the whole document) with the streaming export, for time and
+peak memory, on a temporary peewee database.
+
+    python scripts/benchmark-export.py [number of events]
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+from aw_core.models import Event
+from aw_datastore import get_storage_methods
+from aw_datastore.datastore import Datastore
+
+from aw_server.api import ServerAPI
+
+
+def fill(api, bucket_id, n):
+    api.create_bucket(bucket_id, "currentwindow", "aw-watcher-window", "benchmark")
+    start = datetime.now(timezone.utc) - timedelta(days=365)
+    apps = ["chrome.exe", "code.exe", "slack.exe", "explorer.exe"]
+    batch = []
+    for i in range(n):
+        batch.append(
+            Event(
+                timestamp=start + timedelta(seconds=10 * i),
+                duration=9.5,
+                data={"app": apps[i % len(apps)], "title": f"Document {i % 500} - Editor"},
+            )
+        )
+        if len(batch) == 10000:
+            api.db[bucket_id].insert(batch)
+            batch = []
+    if batch:
+        api.db[bucket_id].insert(batch)
+
+
+def measure(name, f):
+    started = time.perf_counter()
+    size = f()
+    elapsed = time.perf_counter() - started
+    # Measured separately, tracing allocations slows everything down
+    tracemalloc.start()
+    f()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(
+        f"{name:>10}: {elapsed:.2f}s, {size / elapsed / 1e6:.1f} MB/s, peak memory {peak / 1e6:.1f} MB"
+    )
+
+
+def in_memory(api):
+    return len(json.dumps({"buckets": api.export_all()}))
+
+
+def streaming(api):
+    return sum(len(chunk) for chunk in api.iter_export())
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db = Datastore(
+            get_storage_methods()["peewee"],
+            testing=True,
+            filepath=os.path.join(tmpdir, "benchmark.db"),
+        )
+        api = ServerAPI(db=db, testing=True)
+        fill(api, "aw-watcher-window_benchmark", n)
+        print(f"Exporting {n} events")
+        measure("in memory", lambda: in_memory(api))
+        measure("streaming", lambda: streaming(api))
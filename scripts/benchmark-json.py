@@ -0,0 +1,70 @@
+"""
+Compares encoding a day of window events, as returned by queries and exports,
+with the CustomJSONEncoder the app used to set as its json_encoder against the
+backends of aw_server.serialization.
+"""
+import json
+import random
+import timeit
+from datetime import datetime, timedelta, timezone
+
+from aw_core.models import Event
+
+from aw_server.serialization import BACKENDS, dumps, set_backend
+
+
+class CustomJSONEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, datetime):
+            return obj.isoformat()
+        if isinstance(obj, timedelta):
+            return obj.total_seconds()
+        return json.JSONEncoder.default(self, obj)
+
+
+apps = ["chrome.exe", "Code.exe", "slack.exe", "explorer.exe", "WINWORD.EXE"]
+titles = [
+    "KomuTracker - Google Chrome",
+    "rest.py - aw-server - Visual Studio Code",
+    "Slack | general | NCC",
+    "Báo cáo tuần.docx - Word",
+]
+start = datetime(2024, 3, 4, 1, 0, tzinfo=timezone.utc)
+random.seed(0)
+events = [
+    Event(
+        id=i,
+        timestamp=start + timedelta(seconds=5 * i, microseconds=random.randrange(10**6)),
+        duration=timedelta(seconds=random.random() * 5),
+        data={"app": random.choice(apps), "title": random.choice(titles)},
+    )
+    for i in range(20000)
+]
+
+
+def custom_encoder():
+    return json.dumps(events, cls=CustomJSONEncoder)
+
+
+def to_json_dict():
+    # What the export generators did before
+    return json.dumps([e.to_json_dict() for e in events])
+
+
+def backend_dumps(backend):
+    def f():
+        set_backend(backend)
+        return dumps(events)
+
+    return f
+
+
+if __name__ == "__main__":
+    n = 5
+    cases = [("CustomJSONEncoder", custom_encoder), ("to_json_dict + json", to_json_dict)]
+    cases += [(f"serialization ({backend})", backend_dumps(backend)) for backend in BACKENDS]
+    expected = json.loads(custom_encoder())
+    for name, f in cases:
+        assert json.loads(f()) == expected
+        t = min(timeit.repeat(f, number=n, repeat=3))
+        print(f"{name:>24}: {t / n * 1000:.1f} ms per {len(events)} events")
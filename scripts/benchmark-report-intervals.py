@@ -0,0 +1,56 @@
+"""
+Compares computing the spent and call time of synthetic user-days with
+aw_transform (flood, filter_period_intersect and sum_durations on Event
+objects, as REPORT_QUERY does) against the NumPy engine in aw_server.intervals.
+"""
+import random
+import timeit
+from datetime import datetime, timedelta, timezone
+
+from aw_core.models import Event
+from aw_transform import filter_keyvals, filter_period_intersect, flood, sum_durations
+
+from aw_server import intervals
+
+START = datetime(2024, 1, 1, 1, tzinfo=timezone.utc)
+
+
+def user_day(heartbeats: int, windows: int, seed: int = 0):
+    """afk events from 1 second heartbeats, with a break now and then, and window events"""
+    rnd = random.Random(seed)
+    afk_events = []
+    t = START
+    for i in range(heartbeats):
+        status = "afk" if i % 600 > 540 else "not-afk"
+        afk_events.append(Event(timestamp=t, duration=1, data={"status": status}))
+        t += timedelta(seconds=rnd.choice([1, 1, 1, 1.5, 7]))
+    window_events = []
+    t = START
+    for _ in range(windows):
+        title = rnd.choice([intervals.CALL_TITLE, "Inbox", "Editor", "Terminal"])
+        duration = timedelta(seconds=rnd.randint(5, 300))
+        window_events.append(Event(timestamp=t, duration=duration, data={"title": title}))
+        t += duration + timedelta(seconds=rnd.choice([0, 1, 10]))
+    return afk_events, window_events
+
+
+def object_path(afk_events, window_events):
+    not_afk = flood(filter_keyvals(afk_events, "status", ["not-afk"]))
+    afk = flood(filter_keyvals(afk_events, "status", ["afk"]))
+    calls = filter_keyvals(flood(window_events), "title", [intervals.CALL_TITLE])
+    return {
+        "spent_time": sum_durations(not_afk),
+        "call_time": sum_durations(filter_period_intersect(calls, afk)),
+    }
+
+
+if __name__ == "__main__":
+    for heartbeats, windows in [(1000, 50), (10000, 300), (40000, 1000)]:
+        afk_events, window_events = user_day(heartbeats, windows)
+        expected = object_path(afk_events, window_events)
+        result = intervals.report_times(afk_events, window_events)
+        assert all(abs(expected[k] - result[k]) < timedelta(milliseconds=1) for k in expected)
+        print(f"{heartbeats} afk events, {windows} window events:")
+        for name, f in [("aw_transform", object_path), ("intervals", intervals.report_times)]:
+            t = min(timeit.repeat(lambda: f(afk_events, window_events), number=3, repeat=3)) / 3
+            print(f"{name:>16}: {t * 1000:.1f} ms")
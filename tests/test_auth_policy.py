@@ -0,0 +1,34 @@
+from aw_server.auth_policy import ALLOW, BEARER, REJECT, AuthPolicy, trusted_origins
+
+policy = AuthPolicy(trusted_origins("tracker.example.com"), "s3cret")
+
+
+def test_origins():
+    assert policy.decide("GET", "/api/0/buckets/", {"HTTP_ORIGIN": "https://tracker.example.com"}) == ALLOW
+    assert policy.decide("GET", "/api/0/buckets/", {"HTTP_ORIGIN": "http://localhost:27180"}) == ALLOW
+    assert policy.decide("GET", "/api/0/buckets/", {"HTTP_ORIGIN": "https://evil.example.com"}) == BEARER
+    assert policy.decide("GET", "/api/0/buckets/", {}) == BEARER
+
+
+def test_public_routes():
+    assert policy.decide("GET", "/api/0/auth/callback", {}) == ALLOW
+    assert policy.decide("POST", "/api/0/auth", {}) == ALLOW
+    assert policy.decide("POST", "/api/0/auth/", {}) == ALLOW
+    assert policy.decide("DELETE", "/api/0/auth", {}) == BEARER
+    assert policy.decide("GET", "/api/0/auth/me", {}) == BEARER
+    # Buckets named like a public route aren't public
+    assert policy.decide("POST", "/api/0/buckets/aw-watcher-window_author/heartbeat", {}) == BEARER
+    assert policy.decide("POST", "/api/0/authx", {}) == BEARER
+
+
+def test_secrets():
+    assert policy.decide("GET", "/api/0/buckets/", {"HTTP_SECRET": "x"}) == ALLOW
+    assert policy.decide("GET", "/api/0/buckets/", {"HTTP_X_SECRET_KEY": "s3cret"}) == ALLOW
+    assert policy.decide("GET", "/api/0/buckets/", {"HTTP_X_SECRET_KEY": "wrong"}) == BEARER
+    no_key = AuthPolicy(trusted_origins("tracker.example.com"), None)
+    assert no_key.decide("GET", "/api/0/buckets/", {"HTTP_X_SECRET_KEY": "None"}) == BEARER
+
+
+def test_desktop():
+    path = "/api/0/buckets/aw-watcher-afk_DESKTOP-1234/heartbeat"
+    assert policy.decide("POST", path, {"HTTP_ORIGIN": "https://tracker.example.com", "HTTP_SECRET": "x"}) == REJECT
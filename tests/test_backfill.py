@@ -0,0 +1,80 @@
+import sys
+from datetime import date, timedelta
+
+import pytest
+
+from aw_datastore import Datastore, get_storage_methods
+
+from aw_server import backfill as backfill_module
+from aw_server.backfill import Checkpoint, backfill, days_between
+from aw_server.tracker_report import TrackerReport, str_to_date
+
+DAYS = ["2024/01/01", "2024/01/02"]
+
+
+@pytest.fixture
+def tracker_report(monkeypatch):
+    db = Datastore(get_storage_methods()["memory"], testing=True)
+    storage = db.storage_strategy
+    saved = {}
+
+    def get_use_tracker(day):
+        return [{"email": "a@ncc.asia"}, {"email": "b@ncc.asia"}, {"email": "broken@ncc.asia"}]
+
+    def get_report(email, day):
+        return saved.get((email, day))
+
+    def save_report(rec):
+        saved[(rec["email"], str_to_date(rec["date"]))] = dict(rec, id=len(saved))
+
+    def query2(name, query, timeperiods, cache, params=None):
+        if params["afk_bucket"].endswith("broken"):
+            raise ConnectionError("database went away")
+        return [{"spent_time": timedelta(hours=1), "call_time": timedelta()}]
+
+    monkeypatch.setattr(storage, "get_use_tracker", get_use_tracker, raising=False)
+    monkeypatch.setattr(storage, "get_report", get_report, raising=False)
+    monkeypatch.setattr(storage, "save_report", save_report, raising=False)
+    tracker_report = TrackerReport(db, query2)
+    tracker_report.saved = saved
+    return tracker_report
+
+
+def test_days_between():
+    assert days_between(str_to_date("2024/01/30"), str_to_date("2024/02/01")) == [
+        "2024/01/30",
+        "2024/01/31",
+        "2024/02/01",
+    ]
+
+
+def test_backfill(tracker_report, tmp_path):
+    checkpoint_path = str(tmp_path / "checkpoint.txt")
+    checkpoint = Checkpoint(checkpoint_path)
+    stats = backfill(tracker_report, DAYS, workers=2, checkpoint=checkpoint, log=lambda msg: None)
+    checkpoint.close()
+    assert stats == {"saved": 4, "skipped": 0, "failed": 2}
+    assert tracker_report.saved[("a", str_to_date(DAYS[0]))]["spent_time"] == 3600
+
+    # Resuming skips what was saved, failed reports are retried
+    checkpoint = Checkpoint(checkpoint_path)
+    assert (DAYS[1], "b") in checkpoint
+    tracker_report.saved.clear()
+    stats = backfill(tracker_report, DAYS, workers=2, checkpoint=checkpoint, log=lambda msg: None)
+    checkpoint.close()
+    assert stats == {"saved": 0, "skipped": 4, "failed": 2}
+
+    # Without a checkpoint, stored reports are skipped
+    stats = backfill(tracker_report, DAYS[:1], log=lambda msg: None)
+    assert stats == {"saved": 2, "skipped": 0, "failed": 1}
+    stats = backfill(tracker_report, DAYS[:1], log=lambda msg: None)
+    assert stats == {"saved": 0, "skipped": 2, "failed": 1}
+
+
+def test_end_not_over(monkeypatch):
+    today = date.today().strftime("%Y/%m/%d")
+    monkeypatch.setattr(sys, "argv", ["backfill", "--start", "2024/01/01", "--end", today])
+    monkeypatch.setattr(backfill_module, "open_tracker_report", pytest.fail)
+    # Today's report isn't final yet
+    with pytest.raises(SystemExit):
+        backfill_module.main()
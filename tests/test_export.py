@@ -0,0 +1,110 @@
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+
+from aw_core.models import Event
+from aw_datastore.storages.peewee import PeeweeStorage
+
+from aw_server.export import Incremental, decode_cursor, encode_cursor
+
+START = datetime(2024, 1, 1, 12, tzinfo=timezone.utc)
+
+
+@pytest.fixture()
+def db(tmp_path):
+    storage = PeeweeStorage(testing=True, filepath=str(tmp_path / "test.db"))
+    for bucket_id in ("a", "b"):
+        storage.create_bucket(bucket_id, "test", "test", "test", created=START.isoformat())
+    return SimpleNamespace(storage_strategy=storage)
+
+
+def _insert(db, bucket_id, minutes, duration=60):
+    event = Event(timestamp=START + timedelta(minutes=minutes), duration=duration, data={"i": minutes})
+    return db.storage_strategy.insert_one(bucket_id, event)
+
+
+def _export(db, cursor=None, since=None, page_size=1000):
+    incremental = Incremental(db, since, cursor)
+    exported = {
+        bucket_id: [e.data["i"] for page in incremental.pages(bucket_id, page_size) for e in page]
+        for bucket_id in ("a", "b")
+    }
+    return exported, incremental.cursor()
+
+
+def test_cursor(db):
+    for i in range(3):
+        _insert(db, "a", i)
+    exported, cursor = _export(db, since=START + timedelta(seconds=90))
+    assert exported == {"a": [1, 2], "b": []}
+    # The highest id, and the id of the last event of each bucket
+    assert decode_cursor(cursor) == (3, {"a": 3})
+
+    # Nothing changed but the last events, which are always exported again
+    exported, cursor = _export(db, cursor=cursor)
+    assert exported == {"a": [2], "b": []}
+
+    _insert(db, "b", 0)
+    exported, cursor = _export(db, cursor=cursor, page_size=1)
+    assert exported == {"a": [2], "b": [0]}
+
+
+def test_cursor_backdated(db):
+    _insert(db, "a", 10)
+    _, cursor = _export(db)
+    # Inserted after the export, but before the last event
+    _insert(db, "a", 5)
+    exported, cursor = _export(db, cursor=cursor)
+    assert exported["a"] == [10, 5]
+
+    # A heartbeat extends the last event, which has a lower id than the cursor
+    db.storage_strategy.replace_last(
+        "a", Event(timestamp=START + timedelta(minutes=10), duration=120, data={"i": 10})
+    )
+    exported, cursor = _export(db, cursor=cursor)
+    assert exported["a"] == [10]
+
+
+def test_cursor_last_event_closed(db):
+    _insert(db, "a", 0, duration=10)
+    _, cursor = _export(db)
+    # The open last event is extended, then closed by a new one
+    db.storage_strategy.replace_last(
+        "a", Event(timestamp=START, duration=50, data={"i": 0})
+    )
+    _insert(db, "a", 5)
+    exported, _ = _export(db, cursor=cursor)
+    assert exported["a"] == [0, 5]
+
+
+def test_cursor_during_export(db):
+    _insert(db, "a", 0)
+    incremental = Incremental(db)
+    # Written while the export runs
+    _insert(db, "a", 1)
+    list(incremental.pages("a", 1000))
+    exported, _ = _export(db, cursor=incremental.cursor())
+    # With the event that was last when the export started
+    assert exported["a"] == [0, 1]
+
+
+def test_cursor_limits(db):
+    first = _insert(db, "a", 0)
+    last = _insert(db, "a", 1)
+    _, cursor = _export(db)
+    # Deletes and updates by id of events before the last aren't reported
+    db.storage_strategy.replace(
+        "a", first.id, Event(timestamp=START, duration=30, data={"i": 0})
+    )
+    exported, _ = _export(db, cursor=cursor)
+    assert exported["a"] == [1]
+    db.storage_strategy.delete("a", last.id)
+    exported, _ = _export(db, cursor=cursor)
+    assert exported["a"] == [0]
+
+
+def test_invalid_cursor(db):
+    for cursor in ("nonsense", "-1", "e30=", encode_cursor(-1, {}), encode_cursor(0, {"a": "1"})):
+        with pytest.raises(ValueError):
+            Incremental(db, cursor=cursor)
@@ -0,0 +1,139 @@
+import gzip
+import io
+import json
+import os
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from aw_datastore import Datastore, get_storage_methods
+
+from aw_server.api import ServerAPI
+from aw_server.exceptions import BadRequest, NotFound
+from aw_server.export import encode_cursor
+from aw_server.importer import iter_export_document, open_upload
+
+
+@pytest.fixture()
+def api(tmp_path):
+    db = Datastore(get_storage_methods()["memory"], testing=True)
+    api = ServerAPI(db=db, testing=True, import_batch_size=10)
+    api.import_checkpoint_dir = str(tmp_path)
+    return api
+
+
+def _bucket(bucket_id, n):
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    return {
+        "id": bucket_id,
+        "created": start.isoformat(),
+        "type": "afkstatus",
+        "client": "aw-watcher-afk",
+        "hostname": "test",
+        "events": [
+            {
+                "timestamp": (start + timedelta(minutes=i)).isoformat(),
+                "duration": 60,
+                "data": {"status": "not-afk"},
+            }
+            for i in range(n)
+        ],
+    }
+
+
+def _ndjson(*buckets):
+    lines = []
+    for bucket in buckets:
+        bucket = dict(bucket)
+        events = bucket.pop("events")
+        lines.append(json.dumps({"bucket": bucket}))
+        lines.extend(json.dumps({"event": e}) for e in events)
+    return ("\n".join(lines) + "\n").encode()
+
+
+def test_export_document(api):
+    document = {"buckets": {"a": _bucket("a", 25), "b": _bucket("b", 0)}}
+    stats = api.import_stream(io.BytesIO(json.dumps(document, indent=2).encode()))
+    assert stats["buckets"] == 2
+    assert stats["events"] == 25
+    assert len(api.db["a"].get()) == 25
+    assert "b" in api.db.buckets()
+    # The checkpoint is removed once the import is done
+    assert os.listdir(api.import_checkpoint_dir) == []
+    with pytest.raises(NotFound):
+        api.get_import_status(stats["import_id"])
+
+
+def test_metadata_after_events():
+    bucket = _bucket("a", 3)
+    events = bucket.pop("events")
+    document = '{"buckets": {"a": {"events": %s, %s}}}' % (
+        json.dumps(events),
+        json.dumps(bucket)[1:-1],
+    )
+    items = list(iter_export_document(io.StringIO(document)))
+    assert items[0] == ("bucket", bucket)
+    assert [data for kind, data in items[1:]] == events
+
+
+def test_ndjson_gzip(api):
+    upload = gzip.compress(_ndjson(_bucket("a", 5), _bucket("b", 12)))
+    stats = api.import_stream(io.BytesIO(upload))
+    assert (stats["buckets"], stats["events"]) == (2, 17)
+    assert len(api.db["b"].get()) == 12
+
+
+def test_round_trip(api):
+    api.import_stream(io.BytesIO(_ndjson(_bucket("a", 15))))
+    exported = "".join(api.iter_export(["a"], "ndjson")).encode()
+    api.delete_bucket("a")
+    items = list(open_upload(io.BytesIO(exported)))
+    assert items[0][0] == "bucket"
+    assert len(items) == 16
+
+
+def test_resume(api):
+    upload = _ndjson(_bucket("a", 25))
+    # Cut off in the middle of an event
+    with pytest.raises(BadRequest) as e:
+        api.import_stream(io.BytesIO(upload[: len(upload) // 2]), import_id="resume-test")
+    assert "import_id=resume-test" in e.value.description
+    committed = api.get_import_status("resume-test")["committed"]["a"]
+    assert committed > 0 and committed % 10 == 0
+
+    stats = api.import_stream(io.BytesIO(upload), import_id="resume-test")
+    assert stats["skipped"] == committed
+    assert len(api.db["a"].get()) == 25
+
+    with pytest.raises(BadRequest):
+        api.import_stream(io.BytesIO(upload), import_id="resume-test")
+
+
+def test_invalid_event(api):
+    upload = _ndjson(_bucket("a", 1)) + b'{"event": "not an event"}\n'
+    with pytest.raises(BadRequest) as e:
+        api.import_stream(io.BytesIO(upload), import_id="invalid-test")
+    assert e.value.type == "InvalidEvent"
+    assert api.db["a"].get() == []
+
+
+def test_existing_bucket(api):
+    api.import_stream(io.BytesIO(_ndjson(_bucket("a", 1))))
+    with pytest.raises(BadRequest):
+        api.import_stream(io.BytesIO(_ndjson(_bucket("a", 1))))
+
+
+def test_incremental_export_all(api):
+    api.import_stream(io.BytesIO(_ndjson(_bucket("a", 3))))
+    export = api.export_all(cursor=encode_cursor(0, {}))
+    assert len(export["buckets"]["a"]["events"]) == 3
+    api.import_stream(io.BytesIO(_ndjson(_bucket("b", 2))))
+    export = api.export_all(cursor=export["cursor"])
+    # Without global event ids the memory storage exports every event again
+    assert len(export["buckets"]["a"]["events"]) == 3
+    assert len(export["buckets"]["b"]["events"]) == 2
+
+    # Incremental exports can be imported
+    api.delete_bucket("b")
+    document = json.dumps({"buckets": {"b": export["buckets"]["b"]}, "cursor": export["cursor"]})
+    assert api.import_stream(io.BytesIO(document.encode()))["events"] == 2
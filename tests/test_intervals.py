@@ -0,0 +1,72 @@
+import random
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from aw_core.models import Event
+from aw_datastore import Datastore, get_storage_methods
+from aw_query.exceptions import QueryInterpretException
+
+from aw_server import intervals
+from aw_server.query_plan import run_query
+from aw_server.tracker_report import REPORT_QUERY, VECTORISED_REPORT_QUERY, user_buckets
+
+pytestmark = pytest.mark.skipif(not intervals.HAS_NUMPY, reason="requires numpy")
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def _random_events(rnd, n, data):
+    events = []
+    t = START
+    for _ in range(n):
+        # Overlaps, touching events, short and long gaps
+        t += timedelta(seconds=rnd.choice([-2, 0, 0.5, 3, 5, 6, 60]))
+        duration = timedelta(seconds=rnd.choice([0, 0, 1, 2.5, 30, 300]))
+        events.append(Event(timestamp=t, duration=duration, data=rnd.choice(data)))
+        t += duration
+    return events
+
+
+def _datastore(afk_events, window_events):
+    db = Datastore(get_storage_methods()["memory"], testing=True)
+    buckets = user_buckets("test")
+    for bucket_id, events in (
+        (buckets["afk_bucket"], afk_events),
+        (buckets["window_bucket"], window_events),
+    ):
+        db.create_bucket(bucket_id, "test", "test", "test", created=START)
+        db[bucket_id].insert(events)
+    return db
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_report_query_matches(seed):
+    rnd = random.Random(seed)
+    afk_events = _random_events(rnd, 500, [{"status": "afk"}, {"status": "not-afk"}])
+    window_events = _random_events(
+        rnd, 200, [{"title": intervals.CALL_TITLE}, {"title": "Inbox"}, {"title": "Editor"}]
+    )
+    rnd.shuffle(afk_events)
+    db = _datastore(afk_events, window_events)
+
+    def report(query):
+        return run_query("test", query, START, START + timedelta(days=1), db, user_buckets("test"))
+
+    expected = report(REPORT_QUERY)
+    result = report(VECTORISED_REPORT_QUERY)
+    for key in expected:
+        assert result[key].total_seconds() == pytest.approx(expected[key].total_seconds(), abs=1e-3)
+
+
+def test_report_times_not_registered():
+    db = _datastore([], [])
+    with pytest.raises(QueryInterpretException):
+        run_query("test", "RETURN = report_times([], []);", START, START + timedelta(days=1), db)
+
+
+def test_report_times_empty():
+    assert intervals.report_times([], []) == {
+        "spent_time": timedelta(),
+        "call_time": timedelta(),
+    }
@@ -0,0 +1,67 @@
+import time
+from datetime import datetime, timezone
+
+from aw_core.models import Event
+
+from aw_server.last_event_cache import LastEventCache
+
+
+def _event(i):
+    return Event(timestamp=datetime.now(tz=timezone.utc), data={"i": i})
+
+
+def test_lru_eviction():
+    cache = LastEventCache(max_size=4, shards=1)
+    for i in range(6):
+        cache.set(f"bucket-{i}", _event(i))
+    assert len(cache) == 4
+    assert cache.get("bucket-0") is None
+    assert cache.get("bucket-5").data == {"i": 5}
+    assert cache.stats() == {"size": 4, "hits": 1, "misses": 1, "evictions": 2}
+
+
+def test_ttl_eviction():
+    cache = LastEventCache(ttl=0.01)
+    cache.set("bucket", _event(0))
+    time.sleep(0.02)
+    assert "bucket" not in cache
+    assert cache.get("bucket") is None
+    assert cache.stats()["evictions"] == 1
+
+
+def test_lock_is_per_shard():
+    cache = LastEventCache(shards=4)
+    assert cache.lock("bucket") is cache.lock("bucket")
+    with cache.lock("bucket"):
+        # Reentrant, so cache operations work while a heartbeat holds the lock
+        cache.set("bucket", _event(0))
+        assert cache.pop("bucket").data == {"i": 0}
+
+
+def test_warm_up_skips_written_buckets(monkeypatch):
+    from datetime import timedelta
+
+    from aw_datastore import Datastore, get_storage_methods
+
+    from aw_server import bulk
+    from aw_server.api import ServerAPI
+
+    db = Datastore(get_storage_methods()["memory"], testing=True)
+    api = ServerAPI(db=db, testing=True)
+    for bucket_id in ("written", "idle"):
+        api.create_bucket(bucket_id, "test", "test", "test")
+        api.create_events(bucket_id, [_event(0)])
+    snapshot = bulk.get_last_events(db, datetime.now(timezone.utc) - timedelta(hours=1))
+
+    def get_last_events(db, since):
+        # An event is inserted while the warm-up reads
+        api.create_events("written", [_event(1)])
+        return snapshot
+
+    monkeypatch.setattr(bulk, "get_last_events", get_last_events)
+    api._written_during_warmup = set()
+    api._warm_up(timedelta(hours=1), api._written_during_warmup)
+    assert api.warmup_status["state"] == "done"
+    assert "written" not in api.last_event
+    assert api.last_event.get("idle").data == {"i": 0}
+    assert api._written_during_warmup is None
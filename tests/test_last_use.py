@@ -0,0 +1,70 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from aw_server.last_use import LastUseTracker
+
+
+def _tracker(flush_interval=10):
+    writes = []
+    tracker = LastUseTracker(flush_interval=flush_interval, write=lambda w: writes.append(dict(w)))
+    return tracker, writes
+
+
+def test_first_use_of_day_is_written_once():
+    tracker, writes = _tracker()
+    user = {"mezon_user_id": "1", "last_used_at": None}
+    for _ in range(100):
+        tracker.touch(user)
+    assert writes == []
+    assert user["last_used_at"] is not None
+
+    assert tracker.flush() == 1
+    assert list(writes[0]) == ["1"]
+    # Nothing more to write today
+    tracker.touch(user)
+    assert tracker.flush() == 0
+    assert len(writes) == 1
+
+
+def test_used_today_already():
+    tracker, writes = _tracker()
+    user = {"mezon_user_id": "1", "last_used_at": datetime.now(timezone.utc).isoformat()}
+    tracker.touch(user)
+    assert tracker.flush() == 0
+
+    yesterday = datetime.now(timezone.utc) - timedelta(days=1)
+    user = {"mezon_user_id": "2", "last_used_at": yesterday}
+    tracker.touch(user)
+    assert tracker.flush() == 1
+    assert list(writes[0]) == ["2"]
+
+
+def test_batched_write():
+    tracker, writes = _tracker()
+    for i in range(10):
+        tracker.touch({"mezon_user_id": str(i)})
+    assert tracker.flush() == 10
+    assert len(writes) == 1
+    assert sorted(writes[0]) == [str(i) for i in range(10)]
+
+
+def test_write_through():
+    tracker, writes = _tracker(flush_interval=0)
+    tracker.touch({"mezon_user_id": "1"})
+    assert len(writes) == 1
+
+
+def test_failed_write_is_retried():
+    def fail(pending):
+        raise IOError("database is locked")
+
+    tracker = LastUseTracker(write=fail)
+    tracker.touch({"mezon_user_id": "1"})
+    with pytest.raises(IOError):
+        tracker.flush()
+
+    writes = []
+    tracker.write = writes.append
+    tracker.close()
+    assert list(writes[0]) == ["1"]
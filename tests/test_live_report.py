@@ -0,0 +1,88 @@
+import time
+from datetime import datetime, timedelta, timezone
+
+from aw_core.models import Event
+
+from aw_server.live_report import LiveReport, _Intervals
+
+EMAIL = "test.live"
+AFK_BUCKET = f"aw-watcher-afk_{EMAIL}"
+WINDOW_BUCKET = f"aw-watcher-window_{EMAIL}"
+
+
+def test_intervals():
+    intervals = _Intervals(bridge=5)
+    intervals.add(0, 10)
+    intervals.add(30, 40)
+    assert intervals.total == 20
+    # Overlapping and extending
+    intervals.add(5, 12)
+    assert intervals.total == 22
+    # Gap of less than the bridge is closed
+    intervals.add(15, 20)
+    assert intervals.starts == [0, 30]
+    assert intervals.total == 30
+    # Joins both
+    intervals.add(18, 35)
+    assert intervals.starts == [0]
+    assert intervals.total == 40
+
+    other = _Intervals(bridge=0)
+    other.add(-5, 5)
+    other.add(35, 100)
+    assert intervals.intersection(other) == 10
+    assert other.intersection(intervals) == 10
+
+
+def _follow(live_report, since):
+    today = since.date()
+    timeperiod = "/".join(
+        [(since - timedelta(days=1)).isoformat(), (since + timedelta(days=1)).isoformat()]
+    )
+    live_report.reconcile(
+        EMAIL, today, timeperiod, since, timedelta(hours=1), timedelta(minutes=5)
+    )
+    return today
+
+
+def test_live_report():
+    live_report = LiveReport(reconcile_interval=60)
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    today = now.date()
+    assert live_report.get(EMAIL, today) is None
+
+    # Not followed yet, ignored
+    live_report.add_events(AFK_BUCKET, [Event(timestamp=now, duration=60, data={"status": "not-afk"})])
+    today = _follow(live_report, now - timedelta(minutes=10))
+    assert live_report.get(EMAIL, today) == (timedelta(hours=1), timedelta(minutes=5))
+
+    # Only the part after the reconciliation is added
+    live_report.add_events(
+        AFK_BUCKET,
+        [
+            Event(timestamp=now - timedelta(minutes=11), duration=120, data={"status": "not-afk"}),
+            Event(timestamp=now - timedelta(minutes=5), duration=240, data={"status": "afk"}),
+        ],
+    )
+    live_report.add_events(
+        WINDOW_BUCKET,
+        [
+            Event(timestamp=now - timedelta(minutes=4), duration=60, data={"title": "KomuTracker - Google Chrome"}),
+            Event(timestamp=now - timedelta(minutes=3), duration=60, data={"title": "Other"}),
+        ],
+    )
+    spent_time, call_time = live_report.get(EMAIL, today)
+    assert spent_time == timedelta(hours=1, minutes=1)
+    assert call_time == timedelta(minutes=6)
+
+    # Deleting events forces a recomputation
+    live_report.discard(WINDOW_BUCKET)
+    assert live_report.get(EMAIL, today) is None
+
+
+def test_live_report_expires():
+    live_report = LiveReport(reconcile_interval=0.01)
+    today = _follow(live_report, datetime.now(timezone.utc))
+    assert live_report.get(EMAIL, today) is not None
+    time.sleep(0.02)
+    assert live_report.get(EMAIL, today) is None
@@ -0,0 +1,133 @@
+import json
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from aw_server.oauth2 import OAuth2Client
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Token and userinfo endpoints of a stand-in OAuth2 server"""
+
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers["Content-Length"])
+        params = dict(urllib.parse.parse_qsl(self.rfile.read(length).decode()))
+        if params.get("client_id") != "client":
+            return self._respond(401, {"error": "invalid_client"})
+        if self.path == "/oauth2/token":
+            if params.get("code") == "slow":
+                time.sleep(0.5)
+            return self._respond(200, {"access_token": "token-" + params["code"]})
+        if self.path == "/userinfo":
+            return self._respond(200, {"user_id": "1", "email": "john.doe@example.com"})
+        self._respond(404, {"error": "not_found"})
+
+    def _respond(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture()
+def stand_in():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    server.daemon_threads = True
+    server.connections = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _client(server, **kwargs):
+    host = "{}:{}".format(*server.server_address)
+    return OAuth2Client(host, "client", "secret", "http://localhost/callback", scheme="http", **kwargs)
+
+
+def test_keep_alive(stand_in):
+    client = _client(stand_in)
+    data = client.request("POST", "/oauth2/token", {"code": "abc"})
+    assert data == {"access_token": "token-abc"}
+    user = client.request("POST", "/userinfo", {"access_token": data["access_token"]})
+    assert user["email"] == "john.doe@example.com"
+    # Both calls went over the same connection
+    assert stand_in.connections == 1
+    stats = client.stats()
+    assert stats["requests"] == 2
+    assert stats["reused"] == 1
+    assert stats["latency_ms"]["max"] is not None
+    client.close()
+
+
+def test_error_status(stand_in):
+    client = _client(stand_in)
+    assert client.request("POST", "/unknown", {}) is None
+    client.client_id = "wrong"
+    assert client.request("POST", "/oauth2/token", {"code": "abc"}) is None
+    assert client.stats()["failures"] == 2
+
+
+def test_read_timeout(stand_in):
+    client = _client(stand_in, read_timeout=0.1)
+    assert client.request("POST", "/oauth2/token", {"code": "slow"}) is None
+    assert client.stats()["timeouts"] == 1
+    # The timed out connection isn't reused
+    assert client.request("POST", "/oauth2/token", {"code": "abc"}) is not None
+
+
+def test_stale_connection(stand_in):
+    client = _client(stand_in)
+    assert client.request("POST", "/oauth2/token", {"code": "abc"}) is not None
+    # The server drops the idle connection
+    client._idle[0].sock.shutdown(2)
+    assert client.request("POST", "/oauth2/token", {"code": "abc"}) is not None
+
+
+def test_reset_new_connection(stand_in):
+    client = _client(stand_in)
+    sent = []
+
+    def reset(conn, *args):
+        sent.append(conn)
+        raise ConnectionResetError()
+
+    # A call on a new connection isn't sent again
+    client._send = reset
+    assert client.request("POST", "/oauth2/token", {"code": "abc"}) is None
+    assert len(sent) == 1
+
+    def refuse():
+        raise ConnectionResetError()
+
+    client._connect = refuse
+    assert client.request("POST", "/oauth2/token", {"code": "abc"}) is None
+    assert client.stats()["failures"] == 2
+
+
+def test_bounded_concurrency(stand_in):
+    client = _client(stand_in, max_concurrency=1, queue_timeout=0.1)
+    results = []
+    slow = threading.Thread(
+        target=lambda: results.append(client.request("POST", "/oauth2/token", {"code": "slow"}))
+    )
+    slow.start()
+    time.sleep(0.1)
+    assert client.request("POST", "/oauth2/token", {"code": "abc"}) is None
+    slow.join()
+    assert results == [{"access_token": "token-slow"}]
+    assert client.stats()["rejected"] == 1
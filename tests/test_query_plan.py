@@ -0,0 +1,61 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from aw_core.models import Event
+from aw_datastore import Datastore, get_storage_methods
+from aw_query import query2
+from aw_query.exceptions import QueryException
+
+from aw_server.query_plan import compile_query, run_query
+
+QUERY = """
+events = query_bucket(bucket);
+events = filter_keyvals(events, "label", ["a"]);
+n = 1;
+RETURN = {"duration": sum_durations(events), "events": events, "n": n};
+"""
+
+
+@pytest.fixture(scope="module")
+def datastore():
+    db = Datastore(get_storage_methods()["memory"], testing=True)
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    for bucket_id in ["test-plan-1", "test-plan-2"]:
+        db.create_bucket(bucket_id, "test", "test", "test")
+        db[bucket_id].insert(
+            [
+                Event(
+                    timestamp=start + timedelta(minutes=i),
+                    duration=len(bucket_id) + i,
+                    data={"label": "a" if i % 2 else "b"},
+                )
+                for i in range(10)
+            ]
+        )
+    return db
+
+
+def test_plan_matches_query2(datastore):
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    end = start + timedelta(days=1)
+    for bucket_id in ["test-plan-1", "test-plan-2"]:
+        expected = query2.query(
+            "test", QUERY.replace("bucket)", f'"{bucket_id}")'), start, end, datastore
+        )
+        result = run_query("test", QUERY, start, end, datastore, {"bucket": bucket_id})
+        assert result == expected
+
+
+def test_plan_is_cached():
+    assert compile_query(QUERY) is compile_query(QUERY)
+
+
+def test_plan_errors(datastore):
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    with pytest.raises(QueryException):
+        run_query("test", QUERY, start, start, datastore)
+    with pytest.raises(QueryException):
+        run_query("test", QUERY, start, start, datastore, {"bucket": "x", "NAME": "y"})
+    with pytest.raises(QueryException):
+        compile_query("events = query_bucket(;")
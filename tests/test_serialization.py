@@ -0,0 +1,89 @@
+import json
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from bson import ObjectId
+
+from aw_core.models import Event
+
+from aw_server import serialization
+from aw_server.serialization import BACKENDS, dumps, set_backend
+
+
+@pytest.fixture(params=BACKENDS)
+def backend(request):
+    previous = serialization.get_backend()
+    set_backend(request.param)
+    yield request.param
+    set_backend(previous)
+
+
+def test_events(backend):
+    events = [
+        Event(
+            id=i,
+            timestamp=datetime(2024, 1, 1, 9, 0, i, 1000 * i, tzinfo=timezone.utc),
+            duration=timedelta(seconds=i, microseconds=500),
+            data={"app": "firefox", "title": "Ünïcode ✓"},
+        )
+        for i in range(3)
+    ]
+    assert json.loads(dumps(events)) == [e.to_json_dict() for e in events]
+    assert json.loads(dumps(events, indent=True)) == json.loads(dumps(events))
+
+
+def test_other_types(backend):
+    oid = ObjectId()
+    value = {
+        "naive": datetime(2024, 1, 1),
+        "oid": oid,
+        1: "not a string key",
+        "big": 2**70,
+    }
+    assert json.loads(dumps(value)) == {
+        "naive": "2024-01-01T00:00:00",
+        "oid": str(oid),
+        "1": "not a string key",
+        "big": 2**70,
+    }
+    with pytest.raises(TypeError):
+        dumps({"set": {1, 2}})
+
+
+def test_sort_keys_ensure_ascii(backend):
+    value = {"b": "Báo cáo ✓ 😀", "a": [{"z": 1, "y": None}]}
+    for indent in (False, True):
+        for sort_keys in (False, True):
+            for ensure_ascii in (False, True):
+                expected = json.dumps(
+                    value,
+                    indent=2 if indent else None,
+                    separators=None if indent else (",", ":"),
+                    sort_keys=sort_keys,
+                    ensure_ascii=ensure_ascii,
+                )
+                assert dumps(value, indent, sort_keys, ensure_ascii) == expected
+
+
+def test_set_backend():
+    with pytest.raises(ValueError):
+        set_backend("simplejson")
+    previous = serialization.get_backend()
+    set_backend("auto")
+    assert serialization.get_backend() == BACKENDS[0]
+    set_backend(previous)
+
+
+def test_jsonify(app, backend):
+    from flask import jsonify
+
+    with app.app_context():
+        r = jsonify({"timestamp": datetime(2024, 1, 1, tzinfo=timezone.utc), "duration": timedelta(seconds=90)})
+    assert r.json == {"timestamp": "2024-01-01T00:00:00+00:00", "duration": 90.0}
+
+    # JSON_SORT_KEYS and JSON_AS_ASCII are followed
+    with app.app_context():
+        r = jsonify({"title": "Báo cáo", "app": "Word"})
+    text = r.get_data(as_text=True)
+    assert text.index('"app"') < text.index('"title"')
+    assert '"B\\u00e1o c\\u00e1o"' in text
@@ -1,8 +1,11 @@
+import json
 import random
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 
 import pytest
 
+from aw_core.models import Event
+
 
 @pytest.fixture()
 def bucket(flask_client):
@@ -49,6 +52,88 @@ def test_heartbeats(flask_client, bucket, benchmark):
         assert r.status_code == 200
 
 
+def test_heartbeat_invalid(flask_client, bucket):
+    for payload in [
+        {"duration": 0, "data": {}},
+        {"timestamp": "not a timestamp", "duration": 0, "data": {}},
+        {"timestamp": datetime.now().isoformat(), "duration": "1", "data": {}},
+        {"timestamp": datetime.now().isoformat(), "data": []},
+        {"timestamp": datetime.now().isoformat(), "duration": 1e300, "data": {}},
+    ]:
+        r = flask_client.post(f"/api/0/buckets/{bucket}/heartbeat?pulsetime=1", json=payload)
+        assert r.status_code == 400
+    # Not valid JSON, but accepted by the json module
+    r = flask_client.post(
+        f"/api/0/buckets/{bucket}/heartbeat?pulsetime=1",
+        data=f'{{"timestamp": "{datetime.now().isoformat()}", "duration": NaN, "data": {{}}}}',
+        content_type="application/json",
+    )
+    assert r.status_code == 400
+
+
+def test_heartbeats_batch(flask_client, bucket):
+    start = datetime.now() - timedelta(days=1)
+    items = [
+        {
+            "bucket_id": bucket,
+            "pulsetime": 2,
+            "event": {
+                "timestamp": (start + timedelta(seconds=i)).isoformat(),
+                "duration": 0,
+                "data": {"label": "a" if i < 5 else "b"},
+            },
+        }
+        for i in range(10)
+    ]
+    items.append({"bucket_id": "test-missing", "pulsetime": 2, "event": items[0]["event"]})
+    items.append({"bucket_id": bucket, "event": items[0]["event"]})
+    items.append({"bucket_id": bucket, "pulsetime": 10**400, "event": items[0]["event"]})
+
+    r = flask_client.post("/api/0/heartbeats", json=items)
+    assert r.status_code == 200
+    statuses = [result["status"] for result in r.json]
+    assert statuses == ["inserted"] + 4 * ["merged"] + ["inserted"] + 4 * ["merged"] + 3 * ["error"]
+
+    r = flask_client.get(f"/api/0/buckets/{bucket}/events")
+    assert len(r.json) == 2
+    assert [e["duration"] for e in r.json] == [4, 4]
+
+
+def test_heartbeats_batch_non_finite(app, flask_client, bucket):
+    event = {"timestamp": datetime.now().isoformat(), "duration": 0, "data": {"label": "a"}}
+    valid = {"bucket_id": bucket, "pulsetime": 2, "event": event}
+    for item in (
+        {"bucket_id": bucket, "pulsetime": float("inf"), "event": event},
+        {"bucket_id": bucket, "pulsetime": 2, "event": dict(event, duration=float("nan"))},
+    ):
+        # As Infinity and NaN, which the app's JSON encoder would write as null
+        data = json.dumps([valid, item])
+        r = flask_client.post("/api/0/heartbeats", data=data, content_type="application/json")
+        assert r.status_code == 400
+    r = flask_client.get(f"/api/0/buckets/{bucket}/events")
+    assert r.json == []
+
+    # A bucket failing in ServerAPI.heartbeats doesn't fail the others
+    flask_client.post("/api/0/buckets/test-failing", json={"client": "test", "type": "test", "hostname": "test"})
+    try:
+        heartbeat = Event(timestamp=datetime.now(tz=timezone.utc), duration=0, data={"label": "a"})
+        results = app.api.heartbeats(
+            [
+                (bucket, heartbeat, 2),
+                ("test-failing", heartbeat, 2),
+                ("test-failing", heartbeat, float("inf")),
+            ]
+        )
+        assert [result["status"] for result in results] == ["inserted", "error", "error"]
+        assert results[1]["type"] == "HeartbeatFailed"
+        r = flask_client.get("/api/0/buckets/test-failing/events")
+        assert r.json == []
+    finally:
+        flask_client.delete("/api/0/buckets/test-failing")
+    r = flask_client.get(f"/api/0/buckets/{bucket}/events")
+    assert len(r.json) == 1
+
+
 def test_get_events(flask_client, bucket, benchmark):
     n_events = 100
     start_time = datetime.now() - timedelta(days=100)
@@ -89,3 +174,305 @@ def test_get_events(flask_client, bucket, benchmark):
 
 
 # TODO: Add benchmark for basic AFK-filtering query
+
+
+def test_heartbeat_write_behind():
+    from aw_core.models import Event
+    from aw_datastore import Datastore, get_storage_methods
+    from aw_server.api import ServerAPI
+
+    db = Datastore(get_storage_methods()["memory"], testing=True)
+    api = ServerAPI(db=db, testing=True, heartbeat_flush_interval=3600)
+    bucket_id = "test-write-behind"
+    api.create_bucket(bucket_id, "test", "test", "test")
+
+    start = datetime.now() - timedelta(days=1)
+    for i in range(10):
+        api.heartbeat(
+            bucket_id,
+            Event(timestamp=start + timedelta(seconds=i), data={"label": "a"}),
+            pulsetime=2,
+        )
+    # Only the first insert has reached the database, the merges are buffered
+    assert api.heartbeat_buffer.coalesced == 8
+    assert db[bucket_id].get(limit=1)[0].duration == timedelta(0)
+
+    # Reads through the API flush the bucket first
+    events = api.get_events(bucket_id)
+    assert len(events) == 1
+    assert events[0]["duration"] == 9
+
+    # Queries only flush the buckets they name
+    other_id = "test-other-bucket"
+    api.create_bucket(other_id, "test", "test", "test")
+    for bid in (bucket_id, other_id):
+        for i in range(10, 12):
+            api.heartbeat(
+                bid, Event(timestamp=start + timedelta(seconds=i), data={"label": "a"}), pulsetime=2
+            )
+    period = f"{start.isoformat()}/{(start + timedelta(hours=1)).isoformat()}"
+    api.query2("test", [f'RETURN = query_bucket("{bucket_id}");'], [period], False)
+    assert api.heartbeat_buffer.pending() == [other_id]
+
+    api.heartbeat_buffer.close()
+    api.delete_bucket(bucket_id)
+    api.delete_bucket(other_id)
+
+
+def test_query_cache(flask_client, bucket):
+    start = datetime.now(tz=timezone.utc) - timedelta(days=2)
+    timeperiods = [f"{start.isoformat()}/{(start + timedelta(hours=1)).isoformat()}"]
+    query = {
+        "timeperiods": timeperiods,
+        "query": [f'events = query_bucket("{bucket}");', "RETURN = sum_durations(events);"],
+    }
+
+    def insert(minutes):
+        r = flask_client.post(
+            f"/api/0/buckets/{bucket}/events",
+            json={
+                "timestamp": (start + timedelta(minutes=minutes)).isoformat(),
+                "duration": 60,
+                "data": {},
+            },
+        )
+        assert r.status_code == 200
+
+    insert(0)
+    stats = flask_client.get("/api/0/query/cache").json
+    r1 = flask_client.post("/api/0/query/", json=query)
+    r2 = flask_client.post("/api/0/query/", json=query)
+    assert r1.json == r2.json == [60]
+    assert flask_client.get("/api/0/query/cache").json["hits"] == stats["hits"] + 1
+
+    # A write into the cached period invalidates it
+    insert(10)
+    r3 = flask_client.post("/api/0/query/", json=query)
+    assert r3.json == [120]
+
+
+def test_query_cache_concurrent_write(monkeypatch):
+    from aw_core.models import Event
+    from aw_datastore import Datastore, get_storage_methods
+    from aw_server.api import ServerAPI
+
+    db = Datastore(get_storage_methods()["memory"], testing=True)
+    api = ServerAPI(db=db, testing=True)
+    bucket_id = "test-cache-race"
+    api.create_bucket(bucket_id, "test", "test", "test")
+    start = datetime.now(tz=timezone.utc) - timedelta(days=2)
+    timeperiods = [f"{start.isoformat()}/{(start + timedelta(hours=1)).isoformat()}"]
+    query = [f'RETURN = sum_durations(query_bucket("{bucket_id}"));']
+
+    bucket = db[bucket_id]
+    insert = bucket.insert
+
+    def insert_during_query(events):
+        # A query that runs while the events are being written, and doesn't see them
+        assert api.query2("test", query, timeperiods, True) == [timedelta(0)]
+        return insert(events)
+
+    monkeypatch.setattr(bucket, "insert", insert_during_query)
+    api.create_events(bucket_id, [Event(timestamp=start, duration=60, data={})])
+    # Its result wasn't cached
+    assert api.query2("test", query, timeperiods, True) == [timedelta(seconds=60)]
+
+
+def test_query_cache_ttl():
+    import time
+
+    from aw_datastore import Datastore, get_storage_methods
+    from aw_server.api import ServerAPI
+
+    db = Datastore(get_storage_methods()["memory"], testing=True)
+    api = ServerAPI(db=db, testing=True, query_cache_ttl=0.1)
+    bucket_id = "test-cache-ttl"
+    api.create_bucket(bucket_id, "test", "test", "test")
+    start = datetime.now(tz=timezone.utc) - timedelta(days=2)
+    timeperiods = [f"{start.isoformat()}/{(start + timedelta(hours=1)).isoformat()}"]
+    query = [f'RETURN = sum_durations(query_bucket("{bucket_id}"));']
+    assert api.query2("test", query, timeperiods, True) == [timedelta(0)]
+
+    # Written by another process sharing the database, which this one can't see
+    db[bucket_id].insert([Event(timestamp=start, duration=60, data={})])
+    assert api.query2("test", query, timeperiods, True) == [timedelta(0)]
+    time.sleep(0.15)
+    assert api.query2("test", query, timeperiods, True) == [timedelta(seconds=60)]
+
+
+def test_stateless_auth(app, flask_client):
+    user = {
+        "device_id": "test-device",
+        "email": "test.stateless@example.com",
+        "access_token": "test-token",
+        "mezon_user_id": "test-stateless",
+        "last_used_at": datetime.now(tz=timezone.utc).isoformat(),
+    }
+    app.api.user_cache.put(user["device_id"], user)
+    headers = {"Authorization": "Bearer test-token", "device_id": "test-device"}
+    r = flask_client.get("/api/0/auth/me", headers=headers)
+    assert r.status_code == 200
+    assert r.json["email"] == user["email"]
+    # The user isn't written to the session
+    assert "Set-Cookie" not in r.headers
+
+    r = flask_client.get("/api/0/auth/me", headers={**headers, "Authorization": "Bearer wrong"})
+    assert r.status_code == 401
+    app.api.user_cache.invalidate(user["device_id"])
+
+
+def test_logout_persists(app, monkeypatch):
+    api = app.api
+    users = {}
+    monkeypatch.setattr(
+        api.db, "get_user", lambda query: users.get(query.get("device_id")), raising=False
+    )
+    monkeypatch.setattr(
+        api.db, "save_user", lambda user: users.__setitem__(user["device_id"], user), raising=False
+    )
+    users["test-logout"] = {
+        "device_id": "test-logout",
+        "access_token": "test-token",
+        "mezon_user_id": "test-logout",
+        "last_used_at": datetime.now(tz=timezone.utc).isoformat(),
+    }
+    assert api.get_user_by_token("test-logout", "test-token") is not None
+    assert api.delete_user_token("test-logout")
+    assert not api.delete_user_token("test-logout")
+    assert api.get_user_by_token("test-logout", "test-token") is None
+    # Still logged out once the cached copy is gone (evicted, or after a restart)
+    api.user_cache.clear()
+    assert api.get_user_by_token("test-logout", "test-token") is None
+    assert api.get_user_token("test-logout") is None
+
+
+def test_export(flask_client, bucket):
+
+    start = datetime.now(tz=timezone.utc) - timedelta(days=1)
+    events = [
+        {"timestamp": (start + timedelta(seconds=i)).isoformat(), "duration": 1, "data": {"i": i}}
+        for i in range(25)
+    ]
+    r = flask_client.post(f"/api/0/buckets/{bucket}/events", json=events)
+    assert r.status_code == 200
+
+    r = flask_client.get(f"/api/0/buckets/{bucket}/export")
+    assert r.status_code == 200
+    assert r.is_streamed
+    export = r.json["buckets"][bucket]
+    assert export["id"] == bucket
+    assert sorted(e["data"]["i"] for e in export["events"]) == list(range(25))
+    assert all("id" not in e for e in export["events"])
+
+    r = flask_client.get(f"/api/0/buckets/{bucket}/export?format=ndjson")
+    assert r.status_code == 200
+    assert r.mimetype == "application/x-ndjson"
+    lines = [json.loads(line) for line in r.data.decode().splitlines()]
+    assert lines[0]["bucket"]["id"] == bucket
+    assert len([line for line in lines if "event" in line]) == 25
+
+    r = flask_client.get("/api/0/export")
+    assert bucket in r.json["buckets"]
+
+    assert flask_client.get("/api/0/export?format=xml").status_code == 400
+
+
+def test_import(flask_client):
+    import gzip
+    import io
+
+    bucket_id = "test-import"
+    lines = [
+        {
+            "bucket": {
+                "id": bucket_id,
+                "created": datetime.now(tz=timezone.utc).isoformat(),
+                "type": "test",
+                "client": "test",
+                "hostname": "test",
+            }
+        }
+    ] + [
+        {"event": {"timestamp": datetime.now(tz=timezone.utc).isoformat(), "duration": 1, "data": {"i": i}}}
+        for i in range(5)
+    ]
+    upload = gzip.compress("".join(json.dumps(line) + "\n" for line in lines).encode())
+    try:
+        r = flask_client.post(
+            "/api/0/import",
+            data={"file": (io.BytesIO(upload), "export.ndjson.gz")},
+            content_type="multipart/form-data",
+        )
+        assert r.status_code == 200
+        assert r.json["events"] == 5
+        # Done, so its checkpoint is gone
+        r = flask_client.get(f"/api/0/import/{r.json['import_id']}")
+        assert r.status_code == 404
+        r = flask_client.get(f"/api/0/buckets/{bucket_id}/events")
+        assert len(r.json) == 5
+    finally:
+        flask_client.delete(f"/api/0/buckets/{bucket_id}")
+
+
+def test_incremental_export(flask_client, bucket):
+
+    def export(**params):
+        r = flask_client.get(f"/api/0/buckets/{bucket}/export", query_string={"format": "ndjson", **params})
+        assert r.status_code == 200
+        lines = [json.loads(line) for line in r.data.decode().splitlines()]
+        return [line["event"] for line in lines if "event" in line], lines[-1]["cursor"]
+
+    start = datetime.now(tz=timezone.utc) - timedelta(hours=1)
+    events = [
+        {"timestamp": (start + timedelta(minutes=i)).isoformat(), "duration": 30, "data": {"i": i}}
+        for i in range(5)
+    ]
+    flask_client.post(f"/api/0/buckets/{bucket}/events", json=events)
+
+    exported, cursor = export(since=(start + timedelta(minutes=2)).isoformat())
+    assert [e["data"]["i"] for e in exported] == [2, 3, 4]
+    assert all("id" in e for e in exported)
+
+    # The memory storage has no global event ids, exports with a cursor have
+    # every event (see test_export.py for the peewee storage)
+    heartbeat = {"timestamp": (start + timedelta(minutes=4, seconds=40)).isoformat(), "duration": 0, "data": {"i": 4}}
+    flask_client.post(f"/api/0/buckets/{bucket}/heartbeat?pulsetime=60", json=heartbeat)
+    new_event = {"timestamp": (start + timedelta(minutes=10)).isoformat(), "duration": 1, "data": {"i": 10}}
+    flask_client.post(f"/api/0/buckets/{bucket}/events", json=[new_event])
+    exported, cursor = export(cursor=cursor)
+    assert [e["data"]["i"] for e in exported] == [0, 1, 2, 3, 4, 10]
+    assert exported[4]["duration"] == 40
+
+    for invalid in ("nonsense", "-1"):
+        r = flask_client.get(f"/api/0/buckets/{bucket}/export?cursor={invalid}")
+        assert r.status_code == 400
+
+
+def test_compression(flask_client, bucket):
+    import gzip
+
+    start = datetime.now(tz=timezone.utc) - timedelta(days=1)
+    events = [
+        {"timestamp": (start + timedelta(seconds=i)).isoformat(), "duration": 1, "data": {"app": "firefox", "i": i}}
+        for i in range(100)
+    ]
+    flask_client.post(f"/api/0/buckets/{bucket}/events", json=events)
+
+    r = flask_client.get(f"/api/0/buckets/{bucket}/events", headers={"Accept-Encoding": "gzip"})
+    assert r.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in r.headers["Vary"]
+    assert int(r.headers["Content-Length"]) == len(r.data)
+    assert len(json.loads(gzip.decompress(r.data))) == 100
+
+    # Streamed
+    r = flask_client.get(f"/api/0/buckets/{bucket}/export", headers={"Accept-Encoding": "gzip;q=1, br"})
+    assert r.headers["Content-Encoding"] == "gzip"
+    assert len(json.loads(gzip.decompress(r.data))["buckets"][bucket]["events"]) == 100
+
+    # Not accepted, or too small to be worth it
+    r = flask_client.get(f"/api/0/buckets/{bucket}/events", headers={"Accept-Encoding": "gzip;q=0"})
+    assert "Content-Encoding" not in r.headers
+    assert len(r.json) == 100
+    r = flask_client.get("/api/0/info", headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in r.headers
+    assert r.json["testing"]
@@ -0,0 +1,164 @@
+import time
+from datetime import date, datetime, timedelta, timezone
+
+import pytest
+
+from aw_core.models import Event
+from aw_datastore import Datastore, get_storage_methods
+
+from aw_server import bulk
+from aw_server.query_plan import run_query
+from aw_server.report_engine import ReportEngine
+from aw_server.tracker_report import TrackerReport, str_to_date, user_buckets
+
+EMAIL = "test.tracker"
+DAY = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+@pytest.fixture(scope="module")
+def datastore():
+    db = Datastore(get_storage_methods()["memory"], testing=True)
+    buckets = user_buckets(EMAIL)
+    for bucket_id in buckets.values():
+        db.create_bucket(bucket_id, "test", "test", "test")
+    start = DAY + timedelta(hours=8)
+    db[buckets["afk_bucket"]].insert(
+        [
+            Event(timestamp=start, duration=3600, data={"status": "not-afk"}),
+            Event(timestamp=start + timedelta(hours=1), duration=3600, data={"status": "afk"}),
+        ]
+    )
+    db[buckets["window_bucket"]].insert(
+        [
+            # In a call while afk
+            Event(
+                timestamp=start + timedelta(hours=1, minutes=10),
+                duration=600,
+                data={"app": "chrome", "title": "KomuTracker - Google Chrome"},
+            ),
+            # Not a call
+            Event(
+                timestamp=start + timedelta(hours=1, minutes=30),
+                duration=600,
+                data={"app": "chrome", "title": "Google - Google Chrome"},
+            ),
+        ]
+    )
+    return db
+
+
+@pytest.fixture(scope="module")
+def tracker_report(datastore):
+    def query2(name, query, timeperiods, cache, params=None):
+        return [
+            run_query(name, query, DAY, DAY + timedelta(days=1), datastore, params)
+            for _ in timeperiods
+        ]
+
+    return TrackerReport(datastore, query2)
+
+
+def test_get_times(tracker_report):
+    spent_time, call_time = tracker_report.get_times(EMAIL, ["2024-01-01"])
+    assert spent_time == timedelta(hours=1)
+    assert call_time == timedelta(minutes=10)
+
+
+def test_report_user_without_buckets(tracker_report):
+    rec = tracker_report.report_user("test.nobody", "2024/01/01")
+    assert rec["active_time"] == 0
+    assert rec["str_active_time"] == "0h0m0s"
+
+
+def test_report_engine_timeout():
+    def report_user(email, wfh):
+        if email == "slow":
+            time.sleep(0.5)
+        return {"email": email}
+
+    engine = ReportEngine(
+        report_user, lambda email, wfh: {"email": email, "error": "timeout"},
+        workers=2, user_timeout=0.1,
+    )
+    users = [("a", True), ("slow", True), ("b", True), ("c", True)]
+    results = list(engine.run(users))
+    assert sorted(i for i, _ in results) == [0, 1, 2, 3]
+    # The slow user doesn't hold up the others
+    assert results[-1] == (1, {"email": "slow", "error": "timeout"})
+    assert all("error" not in r for i, r in results if i != 1)
+
+
+def test_report_users(tracker_report):
+    users = [(EMAIL, True), ("test.nobody", False)]
+    reports = dict(tracker_report.report_users(users, "2024/01/01"))
+    assert reports[0]["spent_time"] == 3600
+    assert reports[1]["spent_time"] == 0
+    assert reports[1]["wfh"] is False
+
+
+def test_report_emails(tracker_report):
+    emails = [EMAIL, "test.nobody", EMAIL]
+    reports = dict(tracker_report.report_emails(emails, "2024/01/01"))
+    assert sorted(reports) == [0, 1, 2]
+    assert reports[0]["spent_time"] == 3600
+    for i, email in enumerate(emails):
+        assert reports[i] == tracker_report.report_user(email, "2024/01/01")
+
+
+def test_report_range(tracker_report, monkeypatch):
+    start, end = date(2024, 1, 1), date(2024, 1, 2)
+    saved = []
+    monkeypatch.setattr(
+        tracker_report.db.storage_strategy, "save_report", saved.append, raising=False
+    )
+    reports = tracker_report.report_range(start, end, [EMAIL], group="week")
+    assert len(reports) == 1
+    assert reports[0]["start"] == "2024-01-01"
+    assert reports[0]["end"] == "2024-01-02"
+    assert reports[0]["days"] == 2
+    assert reports[0]["spent_time"] == 3600
+    assert reports[0]["call_time"] == 600
+    # Computed days are written back
+    assert [rec["date"] for rec in saved] == ["2024/01/01", "2024/01/02"]
+
+    # Stored days are read with a single ranged read
+    stored = {(rec["email"], str_to_date(rec["date"])): dict(rec, id=i) for i, rec in enumerate(saved)}
+    monkeypatch.setattr(
+        tracker_report.db.storage_strategy,
+        "get_report",
+        lambda email, day: stored.get((email, day)),
+        raising=False,
+    )
+    calls = []
+    read = bulk.get_reports
+
+    def get_reports(db, start, end, emails):
+        calls.append((start, end, emails))
+        return read(db, start, end, emails)
+
+    monkeypatch.setattr(bulk, "get_reports", get_reports)
+    daily = tracker_report.report_range(start, end, [EMAIL], group="day")
+    assert [(r["start"], r["spent_time"]) for r in daily] == [("2024-01-01", 3600), ("2024-01-02", 0)]
+    assert calls == [(start, end, [EMAIL])]
+    assert len(saved) == 2
+
+
+def test_report_range_everyone(tracker_report, monkeypatch):
+    start, end = date(2024, 1, 1), date(2024, 1, 3)
+    storage = tracker_report.db.storage_strategy
+    listed = []
+
+    def get_use_tracker(day):
+        listed.append(day)
+        return [{"email": EMAIL + "@ncc.asia"}, {"email": EMAIL + "@ncc.asia"}]
+
+    monkeypatch.setattr(storage, "get_use_tracker", get_use_tracker, raising=False)
+    monkeypatch.setattr(storage, "save_report", lambda rec: None, raising=False)
+    monkeypatch.setattr(tracker_report, "_past_users", {})
+    reports = tracker_report.report_range(start, end, group="month")
+    assert [(r["email"], r["days"], r["spent_time"]) for r in reports] == [(EMAIL, 3, 3600)]
+    assert listed == [start, start + timedelta(days=1), end]
+
+    # The users of days that are over are only listed once
+    tracker_report.report_range(start, end, group="day")
+    assert len(listed) == 3
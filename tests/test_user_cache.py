@@ -0,0 +1,65 @@
+import time
+
+from aw_server.user_cache import FileInvalidation, UserCache
+
+
+def _cache(users, **kwargs):
+    loads = []
+
+    def load(device_id):
+        loads.append(device_id)
+        return users.get(device_id)
+
+    return UserCache(load, **kwargs), loads
+
+
+def test_loaded_on_demand():
+    users = {"d1": {"device_id": "d1", "access_token": "t1"}}
+    cache, loads = _cache(users)
+    assert loads == []
+    assert cache.get("d1")["access_token"] == "t1"
+    assert cache.get("d1")["access_token"] == "t1"
+    assert loads == ["d1"]
+    # Unknown devices are cached too
+    assert cache.get("d2") is None
+    assert cache.get("d2") is None
+    assert loads == ["d1", "d2"]
+
+
+def test_ttl():
+    users = {"d1": {"device_id": "d1", "access_token": "t1"}}
+    cache, loads = _cache(users, ttl=0.05)
+    cache.get("d1")
+    users["d1"] = {"device_id": "d1", "access_token": "t2"}
+    assert cache.get("d1")["access_token"] == "t1"
+    time.sleep(0.1)
+    assert cache.get("d1")["access_token"] == "t2"
+
+
+def test_max_size():
+    users = {f"d{i}": {"device_id": f"d{i}"} for i in range(10)}
+    cache, loads = _cache(users, max_size=3)
+    for i in range(10):
+        cache.get(f"d{i}")
+    assert cache.stats()["size"] == 3
+    cache.get("d0")
+    assert loads.count("d0") == 2
+
+
+def test_invalidation(tmp_path):
+    path = str(tmp_path / "invalidation")
+    users = {"d1": {"device_id": "d1", "access_token": "t1"}}
+    a, _ = _cache(users, invalidation=FileInvalidation(path, poll_interval=0))
+    b, b_loads = _cache(users, invalidation=FileInvalidation(path, poll_interval=0))
+    assert b.get("d1")["access_token"] == "t1"
+
+    # Saved through a
+    users["d1"] = {"device_id": "d1", "access_token": "t2"}
+    a.put("d1", users["d1"])
+    assert b.get("d1")["access_token"] == "t2"
+    assert b_loads == ["d1", "d1"]
+
+    # Logged out through a
+    users["d1"] = {"device_id": "d1", "access_token": None}
+    a.put("d1", users["d1"])
+    assert b.get("d1")["access_token"] is None